@@ -56,6 +56,7 @@ def k8s_deployed(revert_snapshot, request, config, hardware, underlay,
     If config.k8s.k8s_installed is not set, this fixture assumes
     that the k8s services were not installed, and do the following:
     - install k8s services
+    - wait for the deployments and daemonsets in kube-system
     - make snapshot with name 'k8s_deployed'
     - return K8SManager instance
 
@@ -67,6 +68,13 @@ def k8s_deployed(revert_snapshot, request, config, hardware, underlay,
     @pytest.mark.revert_snapshot("k8s_deployed")
     """
 
+    def stop_informers():
+        # Don't connect to the API just to stop the watch threads
+        if k8s_actions._api is not None:
+            k8s_actions.api.stop_informers()
+
+    request.addfinalizer(stop_informers)
+
     # Deploy Kubernetes cluster
     if not config.k8s.k8s_installed:
         # Workaround for dhclient not killed on non-dhcp interfaces
@@ -99,6 +107,7 @@ def k8s_deployed(revert_snapshot, request, config, hardware, underlay,
         steps_path = config.k8s_deploy.k8s_steps_path
         commands = underlay.read_template(steps_path)
         k8s_actions.install(commands)
+        k8s_actions.wait_kube_system_ready()
 
         hardware.create_snapshot(ext.SNAPSHOT.k8s_deployed)
         salt_deployed.sync_time()
@@ -159,7 +159,7 @@ def snapshot(request, hardware):
 
 
 @pytest.fixture(scope="session")
-def underlay_actions(config):
+def underlay_actions(request, config):
     """Fixture that provides SSH access to underlay objects.
 
     :param config: oslo_config object that keeps various parameters
@@ -170,7 +170,9 @@ def underlay_actions(config):
                                - provide SSH access to underlay nodes using
                                  node names or node IPs.
     """
-    return underlay_ssh_manager.UnderlaySSHManager(config)
+    underlay = underlay_ssh_manager.UnderlaySSHManager(config)
+    request.addfinalizer(underlay.close_connections)
+    return underlay
 
 
 @pytest.mark.revert_snapshot(ext.SNAPSHOT.underlay)
@@ -56,9 +56,9 @@ class Netchecker(object):
         return response
 
     @utils.retry(3, requests.exceptions.RequestException)
-    def wait_netchecker_pods_running(self, prefix):
-        for pod in self._api.pods.list(self._namespace, name_prefix=prefix):
-            pod.wait_running(timeout=600)
+    def wait_netchecker_pods_running(self, prefix, timeout=600):
+        pods = self._api.pods.list(self._namespace, name_prefix=prefix)
+        self._api.wait_all(pods, timeout=timeout)
 
     def check_network(self, works):
         if works:
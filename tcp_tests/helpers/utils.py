@@ -225,6 +225,7 @@ class YamlEditor(object):
         self.username = username
         self.__password = password
         self.__private_keys = private_keys or []
+        self.__keys = None
         self.__content = None
         self.__documents = [{}, ]
         self.__document_id = document_id
@@ -250,16 +251,27 @@ class YamlEditor(object):
     def content(self, new_content):
         self.__content = new_content
 
+    @property
+    def private_keys(self):
+        """Private keys parsed to paramiko.PKey objects
+
+        :rtype: list
+        """
+        if self.__keys is None:
+            self.__keys = [
+                key if isinstance(key, paramiko.PKey) else
+                paramiko.RSAKey.from_private_key(StringIO.StringIO(key))
+                for key in self.__private_keys]
+        return self.__keys
+
     def __get_file(self, mode="r"):
         if self.host:
-            keys = map(paramiko.RSAKey.from_private_key,
-                       map(StringIO.StringIO, self.__private_keys))
             remote = ssh_client.SSHClient(
                 host=self.host,
                 port=self.port,
                 username=self.username,
                 password=self.__password,
-                private_keys=keys)
+                private_keys=self.private_keys)
 
             return remote.open(self.__file_path, mode=mode)
         else:
@@ -53,29 +53,54 @@ class DrivetrainManager(ExecuteCommandsMixin):
         :param job_name: string
         :return: string, Result of passed job, "SUCCESS"| "FAILED" | "UNSTABLE"
         """
+        job = {'job_name': job_name}
+        for key in ('job_parameters', 'job_output_prefix'):
+            if key in kwargs:
+                job[key] = kwargs.pop(key)
+
+        results = self.start_jobs_on_cid_jenkins([job], **kwargs)
+        return list(results.values())[0]['result']
+
+    def start_jobs_on_cid_jenkins(self, jobs, **kwargs):
+        """
+        Starts several jobs at the same time on cluster Jenkins
+
+        Method accept any param:
+            start_timeout=1800,
+            build_timeout=3600 * 4,
+            verbose=False
+
+        :param jobs: list of dicts with the keys 'job_name' and optional
+                     'job_parameters', 'job_output_prefix'
+        :return: OrderedDict {(job_name, build_number): {
+                     'result': str, 'exit_code': int}}
+        """
         jenkins_url, jenkins_user, jenkins_pass = self.get_jenkins_creds(
             tgt='I@docker:client:stack:jenkins and cid01*')
 
-        job_result = run_jenkins_job.run_job(
+        results = run_jenkins_job.run_jobs(
             host=jenkins_url,
             username=jenkins_user,
             password=jenkins_pass,
-            job_name=job_name,
+            jobs=jobs,
             **kwargs)
 
-        (description, stages) = get_jenkins_job_stages.get_deployment_result(
-            host=jenkins_url,
-            username=jenkins_user,
-            password=jenkins_pass,
-            job_name=job_name,
-            build_number='lastBuild')
+        for (job_name, build_number), job_result in results.items():
+            (description, stages) = (
+                get_jenkins_job_stages.get_deployment_result(
+                    host=jenkins_url,
+                    username=jenkins_user,
+                    password=jenkins_pass,
+                    job_name=job_name,
+                    build_number=build_number))
 
-        LOG.info(description)
-        LOG.info('\n'.join(stages))
+            LOG.info(description)
+            LOG.info('\n'.join(stages))
 
-        if job_result != 'SUCCESS':
-            LOG.warning("{0}\n{1}".format(description, '\n'.join(stages)))
-        return job_result
+            if job_result['result'] != 'SUCCESS':
+                LOG.warning("{0}\n{1}".format(
+                    description, '\n'.join(stages)))
+        return results
 
     def start_job_on_cfg_jenkins(self):
         pass
@@ -86,21 +111,22 @@ class DrivetrainManager(ExecuteCommandsMixin):
 
         :return: tuple {jenkins_url, jenkins_user, jenkins_pass}
         """
-        jenkins_host = self._salt.get_single_pillar(
-            tgt=tgt, pillar="jenkins:client:master:host")
+        pillars = self._salt.get_single_pillars(
+            tgt=tgt, pillars=["jenkins:client:master:host",
+                              "jenkins:client:master:port",
+                              "jenkins:client:master:proto",
+                              "jenkins:client:master:username",
+                              "jenkins:client:master:password"])
+        jenkins_host = pillars["jenkins:client:master:host"]
         if jenkins_host is None:
             raise Exception(
                 "Can't find 'jenkins:client:master' pillar on {tgt} node."
                 .format(tgt=tgt))
-        jenkins_port = self._salt.get_single_pillar(
-            tgt=tgt, pillar="jenkins:client:master:port")
-        jenkins_protocol = self._salt.get_single_pillar(
-            tgt=tgt, pillar="jenkins:client:master:proto")
+        jenkins_port = pillars["jenkins:client:master:port"]
+        jenkins_protocol = pillars["jenkins:client:master:proto"]
         jenkins_url = '{0}://{1}:{2}'.format(jenkins_protocol,
                                              jenkins_host,
                                              jenkins_port)
-        jenkins_user = self._salt.get_single_pillar(
-            tgt=tgt, pillar="jenkins:client:master:username")
-        jenkins_pass = self._salt.get_single_pillar(
-            tgt=tgt, pillar="jenkins:client:master:password")
+        jenkins_user = pillars["jenkins:client:master:username"]
+        jenkins_pass = pillars["jenkins:client:master:password"]
         return jenkins_url, jenkins_user, jenkins_pass
@@ -1,12 +1,232 @@
 
+import collections
 import time
 
 from tcp_tests import logger
+from tcp_tests import settings
 from tcp_tests.helpers.log_helpers import pretty_repr
+from tcp_tests.helpers import utils
 
 LOG = logger.logger
 
 
+def count_failures(line):
+    """Count salt failures reported in the line of a command output
+
+    Workaround of exit code 0 from salt in case of failures.
+    """
+    failed = 0
+    if line.startswith("Failed:"):
+        failed += int(line.split("Failed:")[1])
+    if 'Minion did not return. [No response]' in line:
+        failed += 1
+    if 'Minion did not return. [Not connected]' in line:
+        failed += 1
+    if 'Salt request timed out. The master is not responding.' in line:
+        failed += 1
+    if line.startswith("[CRITICAL]"):
+        failed += 1
+    if 'Fatal' in line:
+        failed += 1
+    return failed
+
+
+class StreamResult(object):
+    """Result of the command executed with execute_stream()
+
+    Only the last 'tail_size' lines of stdout and stderr are kept.
+    """
+
+    def __init__(self, cmd, tail_size=None):
+        tail_size = tail_size or settings.STREAM_OUTPUT_TAIL_LINES
+        self.cmd = cmd
+        self.exit_code = None
+        self.failed = 0
+        self.aborted_on = None  # the line matched one of 'abort_on'
+        self.pid = None  # pid of the remote shell running the command
+        self.stdout_tail = collections.deque(maxlen=tail_size)
+        self.stderr_tail = collections.deque(maxlen=tail_size)
+
+    @property
+    def stdout_str(self):
+        return '\n'.join(self.stdout_tail)
+
+    @property
+    def stderr_str(self):
+        return '\n'.join(self.stderr_tail)
+
+
+STREAM_PID_MARKER = 'execute_stream pid: '
+
+
+def execute_stream(remote, cmd, timeout=None, abort_on=None, tail_size=None):
+    """Execute the command and process its output while it is running
+
+    Each line of the output is logged and checked with count_failures()
+    as soon as it is received, without keeping the whole output in memory.
+
+    The command is interrupted by killing the process group of the remote
+    shell. Salt jobs already published to the minions are not stopped
+    by that, they keep running until finished or killed with
+    'saltutil.kill_job'.
+
+    :param remote: SSHClient
+    :param cmd: str, command to execute
+    :param timeout: int, seconds to wait for the command
+    :param abort_on: list of strings, if a line of the output contains any
+                     of them, the command is interrupted
+    :param tail_size: int, number of the last lines of stdout and stderr
+                      to keep for the error report
+    :rtype: StreamResult
+    :raises: utils.TimeoutException
+    """
+    abort_on = abort_on or []
+    result = StreamResult(cmd, tail_size=tail_size)
+    # sshd starts the shell as a session leader, so its pid is the group id
+    # of all the processes of the command
+    chan, _, _, _ = remote.execute_async(
+        "echo '{0}'$$; {1}".format(STREAM_PID_MARKER, cmd))
+    deadline = time.time() + timeout if timeout else None
+    buffers = {'stdout': '', 'stderr': ''}
+    tails = {'stdout': result.stdout_tail, 'stderr': result.stderr_tail}
+
+    def feed(name, data, flush=False):
+        lines = (buffers[name] + data).split('\n')
+        buffers[name] = '' if flush else lines.pop()
+        for line in lines:
+            if flush and not line:
+                continue
+            if result.pid is None and line.startswith(STREAM_PID_MARKER):
+                result.pid = line[len(STREAM_PID_MARKER):].strip()
+                continue
+            LOG.info(line)
+            tails[name].append(line)
+            result.failed += count_failures(line)
+            if any(pattern in line for pattern in abort_on):
+                result.aborted_on = line
+
+    try:
+        while result.aborted_on is None:
+            received = False
+            if chan.recv_ready():
+                feed('stdout', chan.recv(65536))
+                received = True
+            if chan.recv_stderr_ready():
+                feed('stderr', chan.recv_stderr(65536))
+                received = True
+            if received:
+                continue
+            if chan.exit_status_ready():
+                break
+            if deadline and time.time() > deadline:
+                kill_stream(remote, result)
+                raise utils.TimeoutException(
+                    "Command '{0}' was not completed in {1} seconds"
+                    .format(cmd, timeout))
+            time.sleep(0.1)
+
+        if result.aborted_on is None:
+            # The output may be still on the way when the exit status
+            # arrives, like the 'Failed:' summary of salt, read it until EOF
+            for name, recv in (('stdout', chan.recv),
+                               ('stderr', chan.recv_stderr)):
+                data = recv(65536)
+                while data:
+                    feed(name, data)
+                    data = recv(65536)
+        feed('stdout', '', flush=True)
+        feed('stderr', '', flush=True)
+        if result.aborted_on is not None:
+            LOG.error("Command '{0}' is interrupted on the line: {1}"
+                      .format(cmd, result.aborted_on))
+            result.exit_code = -1
+            kill_stream(remote, result)
+        else:
+            result.exit_code = chan.recv_exit_status()
+    finally:
+        chan.close()
+    return result
+
+
+def kill_stream(remote, result):
+    """Kill the processes of the command started with execute_stream()"""
+    if result.pid is None:
+        LOG.warning("Can't kill the command '{0}', its pid is unknown"
+                    .format(result.cmd))
+        return
+    kill = remote.execute('kill -TERM -- -{0}'.format(result.pid))
+    if kill['exit_code'] != 0:
+        LOG.warning("Can't kill the command '{0}': {1}"
+                    .format(result.cmd, kill['stderr_str']))
+
+
+class SaltAsyncStep(object):
+    """Salt 'do' step executed with local_async, see command2_parallel()"""
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    SKIPPED = 'skipped'  # failed, but skip_fail is True
+    FAILED = 'failed'
+
+    def __init__(self, step, msg):
+        self.step = step
+        self.msg = msg
+        # Required fields
+        self.do = step['do']
+        self.target = step['target']
+        state = step.get('state')
+        states = step.get('states')
+        # Optional fields
+        self.args = step.get('args')
+        self.kwargs = step.get('kwargs')
+        self.description = step.get('description', self.do)
+        self.id = step.get('id', self.description)
+        self.requires = set(step.get('requires', []))
+        retry = step.get('retry', {'count': 1, 'delay': 1})
+        self.retry_count = retry.get('count', 1)
+        self.retry_delay = retry.get('delay', 1)
+        self.skip_fail = step.get('skip_fail', False)
+        self.timeout = step.get('timeout', None)
+        self.check_missing = step.get('check_missing', False)
+
+        if not bool(state) ^ bool(states):
+            raise ValueError("You should use state or states in step")
+        if self.do in ('enforceStates', 'runStates'):
+            self.states = list(state or states)
+        else:
+            self.states = [state or states]
+
+        self.status = self.PENDING
+        self.minions = None  # set of minions matched by self.target
+        # ids of all the steps this step depends on, directly or through
+        # the other steps, see command2_parallel()
+        self.all_requires = set(self.requires)
+        self.try_number = 0
+        self.not_before = 0  # don't start the next try before this time
+        self.state_index = 0
+        self.results = []  # [(result, fails), ...] for the current try
+        self.jid = None
+        self.job_minions = None
+        self.lost_minions = set()  # don't run the job and didn't return
+        self.next_find_job = None
+        self.started = None
+
+    @property
+    def done(self):
+        return self.status in (self.SUCCEEDED, self.SKIPPED, self.FAILED)
+
+    def call(self):
+        """Get salt function and its arguments for the current state
+
+        :rtype: tuple (fun, args, kwargs, check_result)
+        """
+        state = self.states[self.state_index]
+        if self.do in ('enforceState', 'enforceStates'):
+            return 'state.sls', state, None, True
+        return state, self.args, self.kwargs, False
+
+
 class ExecuteCommandsMixin(object):
     """docstring for ExecuteCommands"""
 
@@ -45,10 +265,37 @@ class ExecuteCommandsMixin(object):
                                    # without failure even if count number
                                    # is reached.
                                    # If False - rise an exception (default)
+                'stream': bool,  # Process the output while the command
+                                 # is running, keeping only the tail of
+                                 # the output for the error report.
+                                 # Default is STREAM_COMMANDS_OUTPUT.
+                'abort_on': list,  # Strings in the output which mean that
+                                   # the command should be interrupted
+                                   # (with 'stream' only).
+            },
+            ...
+            {
+                # Salt steps:
+                'do': 'enforceState|enforceStates|runState|runStates',
+                'target': 'salt target',
+                'state': 'state name' or 'states': [list of states],
+                # Optional:
+                'args': list, 'kwargs': dict,  # for runState(s)
+                'retry', 'skip_fail': the same as for 'cmd',
+                'timeout': int,
+                'async': False|True|'events',  # Submit states with
+                                   # local_async and wait for the minions
+                                   # by polling the job (True) or using
+                                   # salt-api /events ('events').
+                'check_missing': bool,  # Fail the step if some of the
+                                   # targeted minions didn't return.
+                                   # Only the failed minions are retried.
+                'parallel': bool,  # see command2_parallel()
             },
             ...
         ]
         """
+        parallel_steps = []
         for n, step in enumerate(commands):
             # Required fields
             action_cmd = step.get('cmd')
@@ -66,6 +313,15 @@ class ExecuteCommandsMixin(object):
             msg = "[ {0} #{1} ] {2}".format(label, n + 1, description)
             log_msg = "\n\n{0}\n{1}".format(msg, '=' * len(msg))
 
+            # Sequential 'do' steps with 'parallel: true' are executed
+            # together, see command2_parallel()
+            if action_do and step.get('parallel'):
+                parallel_steps.append((step, msg))
+                continue
+            if parallel_steps:
+                self.command2_parallel(parallel_steps)
+                parallel_steps = []
+
             if action_cmd:
                 self.execute_command(step, msg)
             elif action_do:
@@ -77,6 +333,9 @@ class ExecuteCommandsMixin(object):
                 LOG.info(log_msg)
                 self.action_download(step)
 
+        if parallel_steps:
+            self.command2_parallel(parallel_steps)
+
     def execute_command(self, step, msg, return_res=None):
         # Required fields
         cmd = step.get('cmd')
@@ -88,6 +347,8 @@ class ExecuteCommandsMixin(object):
         retry_delay = retry.get('delay', 1)
         skip_fail = step.get('skip_fail', False)
         timeout = step.get('timeout', None)
+        stream = step.get('stream', settings.STREAM_COMMANDS_OUTPUT)
+        abort_on = step.get('abort_on', None)
 
         with self.__underlay.remote(node_name=node_name) as remote:
 
@@ -102,27 +363,21 @@ class ExecuteCommandsMixin(object):
                 LOG.info("\n\n{0}\n{1}".format(
                     msg + retry_msg, '=' * len(msg + retry_msg)))
 
-                result = remote.execute(cmd, timeout=timeout, verbose=True)
+                if return_res or not stream:
+                    result = remote.execute(cmd, timeout=timeout,
+                                            verbose=True)
+                    failed = sum(count_failures(s) for s in
+                                 result['stdout'] + result['stderr'])
+                else:
+                    result = execute_stream(remote, cmd, timeout=timeout,
+                                            abort_on=abort_on)
+                    failed = result.failed
+                if getattr(self, '_salt', None):
+                    # Pillars or grains may be refreshed by the command
+                    self._salt.invalidate_cache_after_command(cmd)
                 if return_res:
                     return result
 
-                # Workaround of exit code 0 from salt in case of failures
-                failed = 0
-                for s in result['stdout'] + result['stderr']:
-                    if s.startswith("Failed:"):
-                        failed += int(s.split("Failed:")[1])
-                    if 'Minion did not return. [No response]' in s:
-                        failed += 1
-                    if 'Minion did not return. [Not connected]' in s:
-                        failed += 1
-                    if ('Salt request timed out. The master is not responding.'
-                            in s):
-                        failed += 1
-                    if s.startswith("[CRITICAL]"):
-                        failed += 1
-                    if 'Fatal' in s:
-                        failed += 1
-
                 if result.exit_code != 0:
                     time.sleep(retry_delay)
                 elif failed != 0:
@@ -162,10 +417,14 @@ class ExecuteCommandsMixin(object):
         retry_delay = retry.get('delay', 1)
         skip_fail = step.get('skip_fail', False)
         timeout = step.get('timeout', None)
+        async_mode = step.get('async', False)
+        # Fail the step if some of the targeted minions didn't return
+        check_missing = step.get('check_missing', False)
 
         if not bool(state) ^ bool(states):
             raise ValueError("You should use state or states in step")
 
+        try_target = target
         for x in range(retry_count, 0, -1):
             time.sleep(3)
 
@@ -173,15 +432,28 @@ class ExecuteCommandsMixin(object):
                          .format(retry_count - x + 1,
                                  retry_count,
                                  skip_fail,
-                                 target))
+                                 try_target))
             LOG.info("\n\n{0}\n{1}".format(
                 msg + retry_msg, '=' * len(msg + retry_msg)))
 
-            method = getattr(self._salt, self._salt._map[do])
-            command_ret = method(tgt=target, state=state or states,
-                                 args=args, kwargs=kwargs, timeout=timeout)
-            command_ret = command_ret if \
-                isinstance(command_ret, list) else [command_ret]
+            if async_mode:
+                command_ret, missing = self.__command2_async(
+                    SaltAsyncStep(step, msg), try_target,
+                    events=(async_mode == 'events'))
+            else:
+                expected = (self.__target_minions(try_target)
+                            if check_missing else [])
+                method = getattr(self._salt, self._salt._map[do])
+                command_ret = method(tgt=try_target, state=state or states,
+                                     args=args, kwargs=kwargs,
+                                     timeout=timeout)
+                command_ret = command_ret if \
+                    isinstance(command_ret, list) else [command_ret]
+                missing = self.missing_minions(expected, command_ret)
+            if missing and not check_missing:
+                LOG.warning("Minions {0} did not return, ignored without "
+                            "'check_missing'".format(missing))
+                missing = []
             results = [(r['return'][0], f) for r, f in command_ret]
 
             # FIMME: Change to debug level
@@ -191,9 +463,19 @@ class ExecuteCommandsMixin(object):
                          pretty_repr([r for r, f in results])))
 
             all_fails = [f for r, f in results if f]
-            if all_fails:
-                LOG.error("States finished with failures.\n{}".format(
-                    all_fails))
+            if all_fails or missing:
+                if all_fails:
+                    LOG.error("States finished with failures.\n{}".format(
+                        all_fails))
+                if missing:
+                    LOG.error("Minions {0} did not return".format(missing))
+                # Retry only on the failed minions and the minions which
+                # didn't return, don't re-apply the states on the others.
+                # If the targeted minions are unknown, the minions which
+                # didn't return are unknown too, so retry the whole target.
+                if missing is not None:
+                    try_target = self.failed_minions_target(all_fails,
+                                                            missing)
                 time.sleep(retry_delay)
             else:
                 break
@@ -203,6 +485,256 @@ class ExecuteCommandsMixin(object):
                 raise Exception("Step '{0}' failed"
                                 .format(description))
 
+    def __target_minions(self, target):
+        """Get the minions matched by the target, or None if it failed"""
+        try:
+            return self._salt.target_minions(target)
+        except Exception as e:
+            LOG.warning("Can't get the minions matched by '{0}', the whole "
+                        "target is retried on failures: {1}"
+                        .format(target, e))
+            return None
+
+    @staticmethod
+    def missing_minions(expected, command_ret):
+        """Get the minions which didn't return for any of the states
+
+        :param expected: list of the targeted minion ids, or None
+        :param command_ret: list of tuples (result, fails) for the states
+        :rtype: list of minion ids, or None if 'expected' is None
+        """
+        if expected is None:
+            return None
+        missing = set()
+        for r, _ in command_ret:
+            returned = r['return'][0] if r.get('return') else {}
+            if not isinstance(returned, dict):
+                returned = {}
+            missing.update(set(expected) - set(returned))
+        return sorted(missing)
+
+    @staticmethod
+    def failed_minions_target(all_fails, missing=None):
+        """Get compound target for the failed and non-returned minions
+
+        :param all_fails: list of dicts {<minion_id>: [failed tasks]}
+                          returned by check_result()
+        :param missing: list of minion ids which didn't return
+        :rtype: str, 'L@<minion1>,<minion2>,...'
+        """
+        minions = set(missing or [])
+        for fails in all_fails:
+            minions.update(fails.keys())
+        return 'L@' + ','.join(sorted(minions))
+
+    def __command2_async(self, job, target, events=False):
+        """Execute the step states with run_and_wait()
+
+        :param job: SaltAsyncStep
+        :param target: str, salt target to use instead of job.target
+        :param events: bool, use salt-api /events to wait for the minions
+        :rtype: tuple ([(result, fails), ...], missing), 'missing' is
+                a list of minions which didn't return for any state
+        """
+        command_ret = []
+        missing = set()
+        for index in range(len(job.states)):
+            job.state_index = index
+            fun, args, kwargs, check = job.call()
+            r, state_missing = self._salt.run_and_wait(
+                tgt=target, fun=fun, args=args, kwargs=kwargs,
+                timeout=job.timeout, events=events)
+            f = None
+            if check and r['return'][0]:
+                f = self._salt.check_result(r)
+            missing.update(state_missing)
+            command_ret.append((r, f))
+        return command_ret, sorted(missing)
+
+    def command2_parallel(self, steps):
+        """Execute salt 'do' steps concurrently
+
+        Each state is submitted with local_async, and the results are
+        polled with lookup_result. A step is started when:
+        - all the steps from its 'requires' list are completed, and
+        - its target doesn't overlap with the targets of running steps,
+          because salt doesn't run states on the same minion concurrently,
+        - its target doesn't overlap with the targets of the previous
+          steps which are not started yet (unless this step is required
+          by them), so the steps on the same minions are executed in
+          the order they are listed.
+        States from 'states' list of a step are executed one by one.
+        The results are checked with check_result(); 'retry', 'skip_fail'
+        and 'timeout' work the same way as in command2().
+
+        :param steps: list of tuples (step, msg), steps have the same keys
+                      as for command2(), and the following optional keys:
+        steps = [
+            ...
+            {
+                'id': str,  # name of the step to use in 'requires',
+                            # default is the step description
+                'requires': list,  # ids of the steps that should be
+                                   # completed before this step
+                'parallel': True,
+            },
+            ...
+        ]
+        """
+        jobs = [SaltAsyncStep(step, msg) for step, msg in steps]
+        by_id = dict((job.id, job) for job in jobs)
+        for job in jobs:
+            if job.requires - set(by_id):
+                raise ValueError("Step '{0}' requires unknown steps: {1}"
+                                 .format(job.id,
+                                         list(job.requires - set(by_id))))
+        for job in jobs:
+            required = list(job.requires)
+            while required:
+                for dep_id in by_id[required.pop()].requires:
+                    if dep_id not in job.all_requires:
+                        job.all_requires.add(dep_id)
+                        required.append(dep_id)
+
+        while True:
+            completed = set(job.id for job in jobs
+                            if job.status in (SaltAsyncStep.SUCCEEDED,
+                                              SaltAsyncStep.SKIPPED))
+            failed = [job for job in jobs
+                      if job.status == SaltAsyncStep.FAILED]
+            running = [job for job in jobs
+                       if job.status == SaltAsyncStep.RUNNING]
+            busy = set()
+            for job in running:
+                busy |= job.minions
+
+            # Don't start new steps after a failure,
+            # only wait for already running steps
+            waiting = []
+            if not failed:
+                # Previous steps that are not started yet
+                pending = []
+                for job in jobs:
+                    if job.status != SaltAsyncStep.PENDING:
+                        continue
+                    if job.minions is None:
+                        job.minions = set(
+                            self._salt.target_minions(job.target))
+                    can_start = (
+                        not job.requires - completed and
+                        time.time() >= job.not_before and
+                        not job.minions & busy and
+                        not any(job.minions & prev.minions and
+                                job.id not in prev.all_requires
+                                for prev in pending))
+                    if not can_start:
+                        if time.time() < job.not_before:
+                            waiting.append(job)
+                        pending.append(job)
+                        continue
+                    self.__submit_async_step(job)
+                    busy |= job.minions
+                    running.append(job)
+
+            if not running and not waiting:
+                break
+
+            time.sleep(settings.SALT_ASYNC_POLL_INTERVAL)
+            for job in running:
+                self.__poll_async_step(job)
+
+        failed = [job for job in jobs if job.status == SaltAsyncStep.FAILED]
+        if failed:
+            raise Exception("Step '{0}' failed".format(
+                "', '".join(job.description for job in failed)))
+        not_started = [job for job in jobs if not job.done]
+        if not_started:
+            raise Exception("Steps '{0}' were not started, please check "
+                            "the 'requires' of the steps".format(
+                                "', '".join(job.id for job in not_started)))
+
+    def __submit_async_step(self, job):
+        if job.state_index == 0:
+            job.try_number += 1
+            job.results = []
+            retry_msg = (' (try {0} of {1}, skip_fail={2}, target={3})'
+                         .format(job.try_number,
+                                 job.retry_count,
+                                 job.skip_fail,
+                                 job.target))
+            LOG.info("\n\n{0}\n{1}".format(
+                job.msg + retry_msg, '=' * len(job.msg + retry_msg)))
+        fun, args, kwargs, _ = job.call()
+        job.jid, job.job_minions = self._salt.run_async(
+            tgt=job.target, fun=fun, args=args, kwargs=kwargs,
+            timeout=job.timeout)
+        LOG.info("Step '{0}': started '{1}' with jid {2} on {3}".format(
+            job.id, fun if args is None else args, job.jid,
+            job.job_minions))
+        job.started = time.time()
+        job.lost_minions = set()
+        job.next_find_job = job.started + settings.SALT_FIND_JOB_INTERVAL
+        job.status = SaltAsyncStep.RUNNING
+
+    def __poll_async_step(self, job):
+        r, missing = self._salt.get_async_result(job.jid, job.job_minions)
+        timeout = job.timeout or settings.SALT_ASYNC_JOB_TIMEOUT
+        if missing and time.time() >= job.next_find_job:
+            r, missing, lost = self._salt.get_lost_minions(job.jid,
+                                                           job.job_minions)
+            job.lost_minions.update(lost)
+            job.next_find_job = time.time() + settings.SALT_FIND_JOB_INTERVAL
+        if set(missing) - job.lost_minions and \
+                time.time() - job.started < timeout:
+            return
+
+        _, _, _, check = job.call()
+        f = None
+        if check and r['return'][0]:
+            f = self._salt.check_result(r)
+        if missing and job.check_missing:
+            LOG.error("Step '{0}': minions {1} did not return, lost "
+                      "minions: {2}".format(job.id, missing,
+                                            sorted(job.lost_minions)))
+            f = f or {}
+            for minion in missing:
+                f[minion] = ['Minion did not return']
+        elif missing:
+            LOG.warning("Step '{0}': minions {1} did not return, ignored "
+                        "without 'check_missing'".format(job.id, missing))
+        job.results.append((r, f))
+
+        job.state_index += 1
+        if job.state_index < len(job.states):
+            self.__submit_async_step(job)
+            return
+        job.state_index = 0
+
+        # FIMME: Change to debug level
+        LOG.info(" === States output of '{0}' ==============\n"
+                 "{1}\n"
+                 " =========================================".format(
+                     job.id, pretty_repr([r['return'][0]
+                                          for r, f in job.results])))
+
+        all_fails = [f for r, f in job.results if f]
+        if not all_fails:
+            job.status = SaltAsyncStep.SUCCEEDED
+            return
+
+        LOG.error("States of '{0}' finished with failures.\n{1}".format(
+            job.id, all_fails))
+        if job.try_number < job.retry_count:
+            # Retry only on the failed minions
+            job.target = self.failed_minions_target(all_fails)
+            job.minions = set(job.target[len('L@'):].split(','))
+            job.status = SaltAsyncStep.PENDING
+            job.not_before = time.time() + job.retry_delay
+        elif job.skip_fail:
+            job.status = SaltAsyncStep.SKIPPED
+        else:
+            job.status = SaltAsyncStep.FAILED
+
     def action_upload(self, step):
         """Upload from local host to environment node
 
@@ -1,28 +1,151 @@
 from __future__ import print_function
+import copy
 import datetime
+import hashlib
+from multiprocessing import pool as mp_pool
+import os
+import random
+import threading
 import time
 
 import jenkins
 import json
 import requests
 
-from devops.helpers import helpers
+from devops import error
 
+from requests.exceptions import ChunkedEncodingError
 from requests.exceptions import ConnectionError
+from requests.exceptions import HTTPError
+from requests.exceptions import Timeout
+
+
+class PollingStrategy(object):
+    '''Polling with exponential backoff and jitter
+
+    The first probe is made immediately, the next one after
+    ``first_interval`` seconds, then the interval is multiplied by
+    ``factor`` up to ``max_interval``. Each interval is randomly
+    changed by up to ``jitter`` * interval to spread the requests
+    from several waiters.
+    '''
+
+    def __init__(self, first_interval=1, factor=1.5, max_interval=30,
+                 jitter=0.1):
+        self.first_interval = first_interval
+        self.factor = factor
+        self.max_interval = max(max_interval, first_interval)
+        self.jitter = jitter
+
+    def intervals(self):
+        '''Generate intervals between the probes, sec'''
+        interval = self.first_interval
+        while True:
+            yield interval * (1 + random.uniform(-self.jitter, self.jitter))
+            interval = min(interval * self.factor, self.max_interval)
+
+    def wait(self, predicate, timeout, timeout_msg='Timeout reached'):
+        '''Wait until predicate returns True-like value
+
+        :param predicate: callable without arguments
+        :param timeout: ``int``, timeout waiting the predicate, sec
+        :param timeout_msg: ``str``, message for the exception
+        :returns: the predicate result
+        :raises: devops.error.TimeoutError
+        '''
+        deadline = time.time() + timeout
+        for interval in self.intervals():
+            result = predicate()
+            if result:
+                return result
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise error.TimeoutError(timeout_msg)
+            time.sleep(min(interval, remaining))
 
 
 class JenkinsClient(object):
 
-    def __init__(self, host=None, username='admin', password='r00tme'):
+    # Only the required fields are requested for the cached metadata
+    JOBS_LIST = 'api/json?tree=jobs[name,url,color]'
+    JOB_PARAMS = ('%(folder_url)sjob/%(short_name)s/api/json?tree=property'
+                  '[parameterDefinitions[name,defaultParameterValue[value]]]')
+    # Cache for the jobs metadata which is rarely changed, shared by all
+    # the clients because a new client is created for each job run:
+    # {(username, url): {'data': obj, 'expires': timestamp,
+    #                    'etag': str, 'last_modified': str}}
+    __metadata = {}
+    __metadata_lock = threading.Lock()
+
+    def __init__(self, host=None, username='admin', password='r00tme',
+                 polling=None, metadata_ttl=300):
         host = host or 'http://172.16.44.33:8081'
         self.__client = jenkins.Jenkins(
             host,
             username=username,
             password=password)
         self.__client._session.verify = False
+        self.polling = polling or PollingStrategy()
+        # {(name, build_id): {'started_at': timestamp, 'time_to_queue': sec,
+        #                     'time_to_start': sec, 'duration': sec}}
+        self.build_metrics = {}
+        self.username = username
+        self.metadata_ttl = metadata_ttl
+
+    def __get_metadata(self, url):
+        '''Get the JSON from url, cached for self.metadata_ttl seconds
+
+        After the TTL is expired, the cached data is revalidated with
+        If-None-Match / If-Modified-Since headers if Jenkins has returned
+        ETag / Last-Modified for it.
+        '''
+        key = (self.username, url)
+        with self.__metadata_lock:
+            cached = self.__metadata.get(key)
+        if cached and cached['expires'] > time.time():
+            return copy.deepcopy(cached['data'])
+
+        headers = {}
+        if cached and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        response = self.__send_request(url, headers=headers, stream=False)
+        if response.status_code == 304 and cached:
+            # The cached entries are never modified in place, so they
+            # can be read without the lock
+            with self.__metadata_lock:
+                self.__metadata[key] = dict(
+                    cached, expires=time.time() + self.metadata_ttl)
+            return copy.deepcopy(cached['data'])
+        response.raise_for_status()
+
+        data = response.json()
+        with self.__metadata_lock:
+            self.__metadata[key] = {
+                'data': data,
+                'expires': time.time() + self.metadata_ttl,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+        return copy.deepcopy(data)
+
+    def invalidate_metadata(self):
+        '''Drop the cached jobs metadata of this Jenkins'''
+        host = self.__client._build_url('')
+        with self.__metadata_lock:
+            for key in list(self.__metadata):
+                if key[0] == self.username and key[1].startswith(host):
+                    del self.__metadata[key]
 
     def jobs(self):
-        return self.__client.get_jobs()
+        '''Get the list of the top level jobs, cached'''
+        jobs = self.__get_metadata(
+            self.__client._build_url(self.JOBS_LIST)).get('jobs', [])
+        for job in jobs:
+            job['fullname'] = job['name']
+        return jobs
 
     def find_jobs(self, name):
         return filter(lambda x: name in x['fullname'], self.jobs())
@@ -37,7 +160,14 @@ class JenkinsClient(object):
         return self.__client.get_build_info(name, build_id)
 
     def job_params(self, name):
-        job = self.job_info(name)
+        '''Get the job parameters definitions, cached'''
+        folder_url, short_name = self.__client._get_job_folder(name)
+        try:
+            job = self.__get_metadata(
+                self.__client._build_url(self.JOB_PARAMS, locals()))
+        except (HTTPError, jenkins.NotFoundException):
+            raise jenkins.JenkinsException(
+                'job[{}] does not exist'.format(name))
         job_params = next(
             p for p in job['property'] if
             'hudson.model.ParametersDefinitionProperty' == p['_class'])
@@ -52,48 +182,60 @@ class JenkinsClient(object):
         return def_params
 
     def run_build(self, name, params=None, timeout=600, verbose=False):
-        params = params or self.make_defults_params(name)
-        num = self.__client.build_job(name, params)
-        time.sleep(2)  # wait while job is started
+        return self.run_builds([(name, params)],
+                               timeout=timeout, verbose=verbose)[0]
+
+    def run_builds(self, jobs, timeout=600, verbose=False):
+        '''Trigger several builds and wait until all of them are started
 
-        def is_build_queued():
+        All the queue items and builds are checked in the same polling loop.
+
+        :param jobs: list of (``str`` job name, ``dict`` params or None)
+        :param timeout: ``int``, timeout waiting all the builds to start, sec
+        :param verbose: ``bool``, print the waiting details
+        :returns: list of (``str`` job name, ``int`` build id), in the
+                  order of the jobs
+        '''
+        builds = []
+        for name, params in jobs:
+            params = params or self.make_defults_params(name)
+            builds.append({
+                'name': name,
+                'triggered': time.time(),
+                'num': self.__client.build_job(name, params),
+                'queued': None,
+                'build_id': None,
+                'started': None,
+            })
+
+        def is_build_queued(build):
             try:
-                item = self.__client.get_queue_item(num)
+                item = self.__client.get_queue_item(build['num'])
                 ts = item['inQueueSince'] / 1000
                 since_time = datetime.datetime.fromtimestamp(ts)
                 print("Build in the queue since {}".format(since_time))
                 return True
             except jenkins.JenkinsException:
                 if verbose:
-                    print("Build have not been queued {} yet".format(num))
+                    print("Build have not been queued {} yet".format(
+                        build['num']))
 
-        helpers.wait(
-            is_build_queued,
-            timeout=timeout,
-            interval=30,
-            timeout_msg='Timeout waiting to queue the build '
-                        'for {} job'.format(name))
-
-        def is_blocked():
-            queued = self.__client.get_queue_item(num)
+        def get_build_id(build):
+            queued = self.__client.get_queue_item(build['num'])
             status = not queued['blocked']
             if not status and verbose:
-                print("pending the job [{}] : {}".format(name, queued['why']))
-            return (status and
+                print("pending the job [{}] : {}".format(build['name'],
+                                                         queued['why']))
+            if (status and
                     'executable' in (queued or {}) and
-                    'number' in (queued['executable'] or {}))
-
-        helpers.wait(
-            is_blocked,
-            timeout=timeout,
-            interval=30,
-            timeout_msg='Timeout waiting to run the job [{}]'.format(name))
-        build_id = self.__client.get_queue_item(num)['executable']['number']
+                    'number' in (queued['executable'] or {})):
+                return queued['executable']['number']
 
-        def is_build_started():
+        def is_build_started(build):
+            name, build_id = build['name'], build['build_id']
             try:
-                build = self.__client.get_build_info(name, build_id)
-                ts = float(build['timestamp']) / 1000
+                info = self.__client.get_build_info(name, build_id)
+                ts = float(info['timestamp']) / 1000
                 start_time = datetime.datetime.fromtimestamp(ts)
                 print("the build {} in {} have started at {} UTC".format(
                     build_id, name, start_time))
@@ -102,23 +244,60 @@ class JenkinsClient(object):
                 if verbose:
                     print("the build {} in {} have not strated yet".format(
                         build_id, name))
-        helpers.wait(
-            is_build_started,
-            timeout=timeout,
-            interval=30,
-            timeout_msg='Timeout waiting to run build of '
-                        'the job [{}]'.format(name))
 
-        return name, build_id
+        def all_started():
+            for build in builds:
+                if build['queued'] is None and is_build_queued(build):
+                    build['queued'] = time.time()
+                if build['queued'] is not None and build['build_id'] is None:
+                    build['build_id'] = get_build_id(build)
+                if (build['build_id'] is not None and
+                        build['started'] is None and
+                        is_build_started(build)):
+                    build['started'] = time.time()
+            return all(build['started'] is not None for build in builds)
+
+        def not_started():
+            return ', '.join(
+                '[{}]'.format(build['name'])
+                for build in builds if build['started'] is None)
+
+        try:
+            self.polling.wait(
+                all_started,
+                timeout=timeout,
+                timeout_msg='Timeout waiting to run the build')
+        except error.TimeoutError:
+            raise error.TimeoutError(
+                'Timeout waiting to run the build of the jobs: {}'
+                .format(not_started()))
+
+        for build in builds:
+            name, build_id = build['name'], build['build_id']
+            self.build_metrics[(name, build_id)] = {
+                'started_at': build['started'],
+                'time_to_queue': build['queued'] - build['triggered'],
+                'time_to_start': build['started'] - build['triggered'],
+                'duration': None,
+            }
+            if verbose:
+                print("Build {} in {} queued in {:.1f}s, started in {:.1f}s"
+                      .format(build_id, name,
+                              build['queued'] - build['triggered'],
+                              build['started'] - build['triggered']))
+        return [(build['name'], build['build_id']) for build in builds]
 
     def wait_end_of_build(self, name, build_id, timeout=600, interval=5,
-                          verbose=False, job_output_prefix=''):
+                          verbose=False, job_output_prefix='',
+                          console_driven=False):
         '''Wait until the specified build is finished
 
         :param name: ``str``, job name
         :param build_id: ``int``, build id
         :param timeout: ``int``, timeout waiting the job, sec
-        :param interval: ``int``, interval of polling the job result, sec
+        :param interval: ``int``, first interval of polling the job result,
+                         sec; next intervals grow up to
+                         self.polling.max_interval
         :param verbose: ``bool``, print the job console updates during waiting
         :param job_output_prefix: ``str``, print the prefix for each console
                                   output line, with the pre-defined
@@ -126,44 +305,145 @@ class JenkinsClient(object):
                                   - '{name}' : the current job name
                                   - '{build_id}' : the current build-id
                                   - '{time}' : the current time
-        :returns: requests object with headers and console output,  ``obj``
+        :param console_driven: ``bool``, detect the end of the build using
+                               only the progressive console output headers
+                               (X-More-Data, X-Text-Size), and get the build
+                               info once after that. Makes one request per
+                               polling iteration instead of two in verbose
+                               mode.
+        :returns: build info, ``dict``
         '''
-        start = [0]
-        time_str = time.strftime("%H:%M:%S")
-        prefix = "\n" + job_output_prefix.format(job_name=name,
-                                                 build_number=build_id,
-                                                 time=time_str)
-        if verbose:
-            print(prefix, end='')
-
-        def building():
-            try:
-                status = not self.build_info(name, build_id)['building']
-            except ConnectionError:
-                status = False
+        return self.wait_end_of_builds(
+            [(name, build_id)], timeout=timeout, interval=interval,
+            verbose=verbose, job_output_prefix=job_output_prefix,
+            console_driven=console_driven)[(name, build_id)]
 
-            if verbose:
-                time_str = time.strftime("%H:%M:%S")
-                prefix = "\n" + job_output_prefix.format(
-                    job_name=name, build_number=build_id, time=time_str)
-                res = self.get_progressive_build_output(name,
-                                                        build_id,
-                                                        start=start[0])
-                if 'X-Text-Size' in res.headers:
-                    text_size = int(res.headers['X-Text-Size'])
-                    if start[0] < text_size:
+    def wait_end_of_builds(self, builds, timeout=600, interval=5,
+                           verbose=False, job_output_prefix='',
+                           console_driven=False):
+        '''Wait until all the specified builds are finished
+
+        All the builds are checked in the same polling loop, the console
+        output of the builds is multiplexed using job_output_prefix.
+
+        :param builds: list of (``str`` job name, ``int`` build id)
+        :param job_output_prefix: ``str`` or ``dict`` {(job name, build id)
+                                  or job name: ``str``}
+        :returns: ``dict`` {(job name, build id): build info}
+
+        See wait_end_of_build() for the rest of parameters.
+        '''
+        started = time.time()
+        watched = []
+        for name, build_id in builds:
+            if isinstance(job_output_prefix, dict):
+                output_prefix = job_output_prefix.get(
+                    (name, build_id), job_output_prefix.get(name, ''))
+            else:
+                output_prefix = job_output_prefix
+            watched.append({
+                'name': name,
+                'build_id': build_id,
+                'prefix': output_prefix,
+                'start': 0,
+                'info': None,
+                'console_closed': False,
+                'done': False,
+            })
+
+        def get_prefix(build):
+            time_str = time.strftime("%H:%M:%S")
+            return "\n" + build['prefix'].format(
+                job_name=build['name'], build_number=build['build_id'],
+                time=time_str)
+
+        if verbose and len(watched) == 1:
+            print(get_prefix(watched[0]), end='')
+
+        def console_updated(build):
+            """Print the new console output, return True if there is more"""
+            res = self.get_progressive_build_output(build['name'],
+                                                    build['build_id'],
+                                                    start=build['start'])
+            if 'X-Text-Size' in res.headers:
+                text_size = int(res.headers['X-Text-Size'])
+                if build['start'] < text_size:
+                    if verbose:
+                        prefix = get_prefix(build)
                         text = res.content.decode('utf-8',
                                                   errors='backslashreplace')
+                        if len(watched) > 1:
+                            # Start each chunk from a new line to not mix
+                            # the output of different builds
+                            text = "\n" + text.rstrip("\n")
                         print(text.replace("\n", prefix), end='')
-                        start[0] = text_size
+                    build['start'] = text_size
+            # Jenkins sets 'X-More-Data: true' while the log is open
+            return res.headers.get('X-More-Data', '').lower() == 'true'
+
+        def building(build):
+            try:
+                build['info'] = self.build_info(build['name'],
+                                                build['build_id'])
+                status = not build['info']['building']
+            except ConnectionError:
+                status = False
+
+            if verbose and not build['console_closed']:
+                try:
+                    build['console_closed'] = not console_updated(build)
+                except ConnectionError:
+                    pass
             return status
 
-        helpers.wait(
-            building,
+        def console_closed(build):
+            try:
+                build['console_closed'] = not console_updated(build)
+            except ConnectionError:
+                pass
+            return build['console_closed']
+
+        def all_finished():
+            for build in watched:
+                if build['done']:
+                    continue
+                if console_driven and not build['console_closed']:
+                    # Get the build info only after the log is closed
+                    if not console_closed(build):
+                        continue
+                # The console log may be closed a moment before the build
+                # is marked as completed, so check the build info until then
+                build['done'] = building(build)
+                if build['done']:
+                    metrics = self.build_metrics.setdefault(
+                        (build['name'], build['build_id']), {})
+                    metrics['duration'] = time.time() - metrics.get(
+                        'started_at', started)
+            return all(build['done'] for build in watched)
+
+        polling = PollingStrategy(first_interval=interval,
+                                  factor=self.polling.factor,
+                                  max_interval=self.polling.max_interval,
+                                  jitter=self.polling.jitter)
+        polling.wait(
+            all_finished,
             timeout=timeout,
-            interval=interval,
-            timeout_msg=('Timeout waiting the job {0}:{1} in {2} sec.'
-                         .format(name, build_id, timeout)))
+            timeout_msg=('Timeout waiting the job {0} in {1} sec.'
+                         .format(', '.join(
+                             '{0}:{1}'.format(name, build_id)
+                             for name, build_id in builds), timeout)))
+        return dict(((build['name'], build['build_id']), build['info'])
+                    for build in watched)
+
+    def get_build_metrics(self, name, build_id):
+        '''Get timings of the build started with run_build()
+
+        :returns: ``dict`` with 'time_to_queue', 'time_to_start' (since
+                  the build was triggered) and 'duration' (since the build
+                  was started until wait_end_of_build() has detected the
+                  end of the build), sec; 'started_at' is a timestamp
+        '''
+        return self.build_metrics.get((name, build_id), {})
 
     def get_build_output(self, name, build_id):
         return self.__client.get_build_console_output(name, build_id)
@@ -210,8 +490,18 @@ class JenkinsClient(object):
         response = self.__client.jenkins_open(req)
         return json.loads(response)
 
+    def __artifact_url(self, name, build_id, artifact_path):
+        folder_url, short_name = self.__client._get_job_folder(name)
+
+        DOWNLOAD_URL = ('%(folder_url)sjob/%(short_name)s/%(build_id)s/'
+                        'artifact/%(artifact_path)s')
+        return self.__client._build_url(DOWNLOAD_URL, locals())
+
     def get_artifact(self, name, build_id, artifact_path, destination_name):
-        '''Wait until the specified build is finished
+        '''Get the artifact content
+
+        The whole artifact is kept in memory, use download_artifact()
+        for big files.
 
         :param name: ``str``, job name
         :param build_id: ``str``, build id or "lastBuild"
@@ -220,15 +510,150 @@ class JenkinsClient(object):
         :param artifact_path: ``str``, destination path and filename
                               on the local filesystem where to save
                               the artifact content
-        :returns: requests object with headers and console output,  ``obj``
+        :returns: the artifact content, ``str``
         '''
-        folder_url, short_name = self.__client._get_job_folder(name)
-
-        DOWNLOAD_URL = ('%(folder_url)sjob/%(short_name)s/%(build_id)s/'
-                        'artifact/%(artifact_path)s')
         req = requests.Request(
                 'GET',
-                self.__client._build_url(DOWNLOAD_URL, locals()))
+                self.__artifact_url(name, build_id, artifact_path))
 
         response = self.__client.jenkins_request(req)
         return response.content
+
+    def __send_request(self, url, headers=None, stream=True):
+        '''Send GET request, don't read the response body if stream'''
+        self.__client._maybe_add_auth()
+        session = self.__client._session
+        req = session.prepare_request(
+            requests.Request('GET', url, headers=headers))
+        settings = session.merge_environment_settings(
+            req.url, {}, stream, session.verify, None)
+        settings['timeout'] = self.__client.timeout
+        response = session.send(req, **settings)
+        if response.status_code == 404:
+            response.close()
+            raise jenkins.NotFoundException(
+                'Requested item could not be found: {}'.format(url))
+        if response.status_code in (401, 403):
+            response.close()
+            raise jenkins.JenkinsException(
+                'Error in request. Possibly authentication failed '
+                '[{}]: {}'.format(response.status_code, response.reason))
+        return response
+
+    def download_artifact(self, name, build_id, artifact_path,
+                          destination_name, checksum=None,
+                          checksum_type='sha256', retries=5,
+                          chunk_size=1024 * 1024):
+        '''Download the artifact to the file without keeping it in memory
+
+        The artifact is saved to '<destination_name>.<build number>.part'
+        chunk by chunk and renamed to destination_name when completed.
+        If the connection is dropped, the download is resumed from the last
+        saved byte using HTTP Range header, with If-Range header set to
+        the ETag or Last-Modified of the first response, so the server
+        sends the whole artifact again if it was changed. An existing
+        '.part' file left from the previous try for the same build is
+        resumed as well. If the server replies to the Range request with
+        the whole artifact, the download is started over.
+
+        :param name: ``str``, job name
+        :param build_id: ``str``, build id or "lastBuild"
+        :param artifact_path: ``str``, path and filename of the artifact
+                              relative to the job URL
+        :param destination_name: ``str``, destination path and filename
+                                 on the local filesystem
+        :param checksum: ``str``, expected hex digest of the artifact,
+                         not checked if None
+        :param checksum_type: ``str``, hashlib algorithm for the checksum
+        :param retries: ``int``, how many times to resume the download
+        :param chunk_size: ``int``, size of the chunk written at once, bytes
+        :returns: downloaded size, bytes
+        :raises: jenkins.NotFoundException if there is no such artifact
+        '''
+        if not str(build_id).isdigit():
+            # 'lastBuild' and similar may point to another build when
+            # the download is resumed
+            build = self.job_info(name).get(build_id)
+            if not build:
+                raise jenkins.NotFoundException(
+                    'job[{}] has no build {}'.format(name, build_id))
+            build_id = build['number']
+        url = self.__artifact_url(name, build_id, artifact_path)
+        part_name = '{0}.{1}.part'.format(destination_name, build_id)
+        validator = None  # ETag or Last-Modified of the artifact
+
+        for attempt in range(retries + 1):
+            offset = (os.path.getsize(part_name)
+                      if os.path.exists(part_name) else 0)
+            headers = {}
+            if offset:
+                headers['Range'] = 'bytes={}-'.format(offset)
+                if validator:
+                    headers['If-Range'] = validator
+            try:
+                response = self.__send_request(url, headers=headers)
+                try:
+                    if response.status_code == 416:
+                        # Range not satisfiable: the file is completed
+                        break
+                    response.raise_for_status()
+                    validator = (response.headers.get('ETag') or
+                                 response.headers.get('Last-Modified') or
+                                 validator)
+                    # The server ignores the Range header if the artifact
+                    # was changed or doesn't support ranges, start over then
+                    mode = 'ab' if response.status_code == 206 else 'wb'
+                    if offset and mode == 'wb':
+                        print("Download of {} is started over".format(url))
+                    with open(part_name, mode) as f:
+                        for chunk in response.iter_content(chunk_size):
+                            f.write(chunk)
+                finally:
+                    response.close()
+                break
+            except (ConnectionError, ChunkedEncodingError, Timeout,
+                    HTTPError) as e:
+                if attempt >= retries:
+                    raise
+                print("Download of {} is interrupted: {}, resuming"
+                      .format(url, e))
+                time.sleep(min(2 ** attempt, 30))
+
+        if checksum:
+            digest = hashlib.new(checksum_type)
+            with open(part_name, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    digest.update(chunk)
+            if digest.hexdigest().lower() != checksum.lower():
+                os.remove(part_name)
+                raise Exception(
+                    "Checksum mismatch for {0}: expected {1} {2}, got {3}"
+                    .format(url, checksum_type, checksum,
+                            digest.hexdigest()))
+
+        os.rename(part_name, destination_name)
+        return os.path.getsize(destination_name)
+
+    def download_artifacts(self, artifacts, max_workers=4, **kwargs):
+        '''Download several artifacts in parallel
+
+        :param artifacts: list of dicts with download_artifact() arguments:
+                          'name', 'build_id', 'artifact_path',
+                          'destination_name' and optional 'checksum'
+        :param max_workers: ``int``, max number of parallel downloads
+        :param kwargs: common arguments for download_artifact()
+        :returns: list of downloaded sizes, in the order of artifacts
+        '''
+        def download(artifact):
+            params = dict(kwargs)
+            params.update(artifact)
+            return self.download_artifact(**params)
+
+        if len(artifacts) <= 1:
+            return [download(artifact) for artifact in artifacts]
+        thread_pool = mp_pool.ThreadPool(min(max_workers, len(artifacts)))
+        try:
+            return thread_pool.map(download, artifacts)
+        finally:
+            thread_pool.close()
+            thread_pool.join()
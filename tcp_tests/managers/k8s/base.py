@@ -15,8 +15,15 @@
 import yaml
 import requests
 import os
+import time
+
+from devops.helpers import helpers
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+from urllib3.exceptions import HTTPError
 
 from tcp_tests import logger
+from tcp_tests import settings
 
 LOG = logger.logger
 
@@ -84,6 +91,88 @@ class K8sBaseResource(object):
         self._delete(**kwargs)
         return self
 
+    @staticmethod
+    def _is_ready(data):
+        """Default condition for K8sCluster.wait_all()"""
+        raise NotImplementedError
+
+    def wait(self, predicate, timeout=60, interval=5, timeout_msg=None,
+             use_watch=None):
+        """Wait until predicate(data) is True for the resource data
+
+        Changes of the resource are received with the watch API starting
+        from the resourceVersion of the current data, so the condition is
+        checked as soon as the resource is changed. If the watch fails,
+        the resource is read every 'interval' seconds.
+
+        :param predicate: callable, gets the resource data (V1Pod, ...)
+        :param timeout: int, sec
+        :param interval: int, polling interval for the fallback, sec
+        :param use_watch: bool, settings.K8S_WATCH_ENABLED if None
+        :rtype: self
+        :raises: devops.error.TimeoutError
+        """
+        timeout_msg = timeout_msg or (
+            'Timeout waiting for {0} {1} in {2} sec'.format(
+                self.resource_type, self.name, timeout))
+        if use_watch is None:
+            use_watch = settings.K8S_WATCH_ENABLED
+        deadline = time.time() + timeout
+
+        if use_watch:
+            try:
+                if self.__watch_until(predicate, deadline):
+                    return self
+            except (ApiException, HTTPError, ValueError) as e:
+                LOG.warning("Watch of {0} {1} failed, fallback to "
+                            "polling: {2}".format(self.resource_type,
+                                                  self.name, e))
+
+        helpers.wait(lambda: predicate(self.read()),
+                     timeout=max(deadline - time.time(), 0),
+                     interval=interval,
+                     timeout_msg=timeout_msg)
+        return self
+
+    def __watch_until(self, predicate, deadline):
+        """Check predicate on each change of the resource until deadline
+
+        :returns: True if the predicate is True, False on the deadline
+        """
+        data = self.read()
+        if predicate(data):
+            return True
+        resource_version = data.metadata.resource_version
+        field_selector = 'metadata.name={}'.format(self.name)
+
+        while time.time() < deadline:
+            w = watch.Watch(return_type=type(data).__name__)
+            for event in w.stream(
+                    self._manager._list, self.namespace,
+                    field_selector=field_selector,
+                    resource_version=resource_version,
+                    timeout_seconds=max(int(deadline - time.time()), 1)):
+                if event['type'] == 'ERROR':
+                    if event['raw_object'].get('code') == 410:
+                        # resourceVersion is too old, start from the
+                        # current state of the resource
+                        w.stop()
+                        data = self.read()
+                        if predicate(data):
+                            return True
+                        resource_version = data.metadata.resource_version
+                        break
+                    raise ValueError(event['raw_object'].get('message'))
+                data = event['object']
+                resource_version = data.metadata.resource_version
+                if event['type'] == 'DELETED':
+                    continue
+                self._update_cache(data)
+                if predicate(data):
+                    w.stop()
+                    return True
+        return False
+
     def __eq__(self, other):
         if not isinstance(other, K8sBaseResource):
             return NotImplemented
@@ -96,6 +185,13 @@ class K8sBaseResource(object):
 
 class K8sBaseManager(object):
     resource_class = None
+    # False for the cluster-scoped resources, like nodes
+    namespaced = True
+    # Default number of items requested in one page by list()/list_all()
+    list_limit = 500
+    # Times to start the paginated listing again if the continue token
+    # is expired before all the pages are read
+    list_restarts = 3
 
     def __init__(self, cluster):
         self._cluster = cluster
@@ -120,19 +216,137 @@ class K8sBaseManager(object):
                      item.metadata.name.startswith(name_prefix)]
         return items
 
-    def __list_to_resource(self, items):
-        return [self.__resource_from_data(item) for item in items]
+    def __iter_resources(self, list_func, name_prefix=None, limit=None,
+                         **kwargs):
+        """Generate resources from the list_func results page by page
+
+        :param limit: int, max number of items in the page;
+                      self.list_limit if None, 0 to get all the items at once
+        """
+        if limit is None:
+            limit = self.list_limit
+        if limit:
+            kwargs['limit'] = limit
+        restarts = self.list_restarts
+        # (namespace, name) of the generated resources, to skip them
+        # if the listing is started again
+        seen = set()
+        while True:
+            try:
+                result = list_func(**kwargs)
+            except ApiException as e:
+                if e.status != 410 or '_continue' not in kwargs or (
+                        restarts <= 0):
+                    raise
+                LOG.warning("Listing of {0} expired, starting again: {1}"
+                            .format(self.resource_type, e.reason))
+                restarts -= 1
+                del kwargs['_continue']
+                continue
+            for item in self.__list_filter(result.items,
+                                           name_prefix=name_prefix):
+                key = (item.metadata.namespace, item.metadata.name)
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield self.__resource_from_data(item)
+            next_page = getattr(result.metadata, '_continue', None)
+            if not limit or not next_page:
+                break
+            kwargs['_continue'] = next_page
 
-    def list(self, namespace=None, name_prefix=None, **kwargs):
+    @property
+    def informer(self):
+        """K8sInformer if it is enabled for the resource type, or None"""
+        return self._cluster.get_informer(self)
+
+    @staticmethod
+    def __informer_query(label_selector=None, field_selector=None):
+        """Convert the selectors to K8sInformer.list() arguments
+
+        Only the label equality and spec.nodeName can be looked up
+        in the informer.
+
+        :rtype: dict, or None if the selectors are not supported
+        """
+        query = {}
+        if label_selector is not None:
+            if '(' in label_selector or '!' in label_selector:
+                return None
+            query['labels'] = {}
+            for requirement in label_selector.split(','):
+                label, sep, value = requirement.replace(
+                    '==', '=').partition('=')
+                if not sep or '=' in value:
+                    return None
+                query['labels'][label.strip()] = value.strip()
+        if field_selector is not None:
+            field, sep, value = field_selector.replace(
+                '==', '=').partition('=')
+            if (field.strip() != 'spec.nodeName' or not value.strip() or
+                    ',' in value):
+                return None
+            query['node_name'] = value.strip()
+        return query
+
+    def iter_list(self, namespace=None, name_prefix=None,
+                  label_selector=None, field_selector=None, limit=None,
+                  **kwargs):
+        """Generate the resources from the namespace
+
+        The resources are requested page by page with 'limit' items in
+        each, so the whole list is not kept in memory. If the continue
+        token of the next page is expired, the listing is started again,
+        skipping the resources that were already generated.
+
+        :param namespace: str, default namespace of the cluster if None
+        :param name_prefix: str, filter by name on the client side
+        :param label_selector: str, like 'app=netchecker,tier!=test'
+        :param field_selector: str, like 'spec.nodeName=ctl01'
+        :param limit: int, items in a page, self.list_limit if None
+        :rtype: iterator of K8sBaseResource
+        """
         namespace = namespace or self._cluster.default_namespace
-        items = self._list(namespace=namespace, **kwargs).items
-        items = self.__list_filter(items, name_prefix=name_prefix)
-        return self.__list_to_resource(items)
+        query = self.__informer_query(label_selector, field_selector)
+        if self.informer is not None and not kwargs and query is not None:
+            return iter(self.informer.list(
+                namespace=namespace if self.namespaced else None,
+                name_prefix=name_prefix, **query))
+        if label_selector is not None:
+            kwargs['label_selector'] = label_selector
+        if field_selector is not None:
+            kwargs['field_selector'] = field_selector
+        return self.__iter_resources(
+            lambda **kw: self._list(namespace=namespace, **kw),
+            name_prefix=name_prefix, limit=limit, **kwargs)
+
+    def iter_list_all(self, name_prefix=None, label_selector=None,
+                      field_selector=None, limit=None, **kwargs):
+        """Generate the resources from all namespaces, see iter_list()"""
+        query = self.__informer_query(label_selector, field_selector)
+        if self.informer is not None and not kwargs and query is not None:
+            return iter(self.informer.list(name_prefix=name_prefix, **query))
+        if label_selector is not None:
+            kwargs['label_selector'] = label_selector
+        if field_selector is not None:
+            kwargs['field_selector'] = field_selector
+        return self.__iter_resources(
+            self._list_all, name_prefix=name_prefix, limit=limit, **kwargs)
+
+    def list(self, namespace=None, name_prefix=None, **kwargs):
+        """Get the list of the resources from the namespace
+
+        :rtype: list of K8sBaseResource, see iter_list() for the arguments
+        """
+        return list(self.iter_list(namespace=namespace,
+                                   name_prefix=name_prefix, **kwargs))
 
     def list_all(self, name_prefix=None, **kwargs):
-        items = self._list_all(**kwargs).items
-        items = self.__list_filter(items, name_prefix=name_prefix)
-        return self.__list_to_resource(items)
+        """Get the list of the resources from all the namespaces
+
+        :rtype: list of K8sBaseResource, see iter_list() for the arguments
+        """
+        return list(self.iter_list_all(name_prefix=name_prefix, **kwargs))
 
 
 def read_yaml_str(yaml_str):
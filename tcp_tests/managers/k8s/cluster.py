@@ -12,9 +12,30 @@
 #    License for the specific language governing permissions and limitations
 
 
+import base64
+import json
+from multiprocessing import pool as mp_pool
+import os
+import pipes
+import posixpath
+import shlex
+import tarfile
+import tempfile
+import threading
+import time
+
+from devops import error
+from devops.helpers import exec_result
 import kubernetes
 from kubernetes import client
+from kubernetes.stream import stream
+from kubernetes.stream.ws_client import ERROR_CHANNEL
+import six
+
+from tcp_tests import logger
+from tcp_tests import settings
 
+from tcp_tests.managers.k8s.base import K8sBaseResource
 from tcp_tests.managers.k8s.componentstatuses import \
     K8sComponentStatusManager
 from tcp_tests.managers.k8s.daemonsets import K8sDaemonSetManager
@@ -44,12 +65,22 @@ from tcp_tests.managers.k8s.replicasets import K8sReplicaSetManager
 from tcp_tests.managers.k8s.networkpolicies import K8sNetworkPolicyManager
 from tcp_tests.managers.k8s.clusterrolebindings import \
     K8sClusterRoleBindingManager
+from tcp_tests.managers.k8s.informer import K8sInformer
+
+LOG = logger.logger
 
 
 class K8sCluster(object):
     def __init__(self, schema="https", user=None, password=None, ca=None,
-                 host='localhost', port='443', default_namespace='default'):
+                 host='localhost', port='443', default_namespace='default',
+                 informers=None):
+        """
+        :param informers: list of the managers names, like 'pods', to keep
+                          the resources of in the local cache, see
+                          enable_informer()
+        """
         self.default_namespace = default_namespace
+        self._informers = {}
 
         api_server = '{0}://{1}:{2}'.format(schema, host, port)
 
@@ -85,6 +116,12 @@ class K8sCluster(object):
         loader = kubernetes.config.kube_config.KubeConfigLoader(config_data)
         loader.load_and_set(configuration)
         api_client = client.ApiClient(configuration=configuration)
+        self.api_client = api_client
+        # stream() replaces the request method of the ApiClient while the
+        # exec is running, so the exec calls use their own ApiClient to not
+        # break the concurrent requests to the API
+        self.api_exec = client.CoreV1Api(
+            client.ApiClient(configuration=configuration))
 
         self.api_core = client.CoreV1Api(api_client)
         self.api_apps = client.AppsV1Api(api_client)
@@ -116,3 +153,369 @@ class K8sCluster(object):
         self.replicasets = K8sReplicaSetManager(self)
         self.networkpolicies = K8sNetworkPolicyManager(self)
         self.clusterrolebindings = K8sClusterRoleBindingManager(self)
+
+        for name in informers or []:
+            self.enable_informer(name)
+
+    def enable_informer(self, manager):
+        """Keep all the resources of the manager in the local cache
+
+        The manager list() and list_all() calls without extra API
+        arguments are served from the cache after that, if the label
+        selector has only equality requirements and the field selector
+        is empty or 'spec.nodeName=<node>'.
+
+        :param manager: K8sBaseManager or its attribute name, like 'pods'
+        :rtype: K8sInformer
+        """
+        if isinstance(manager, str):
+            manager = getattr(self, manager)
+        if manager.resource_type not in self._informers:
+            self._informers[manager.resource_type] = K8sInformer(manager)
+        return self._informers[manager.resource_type].start()
+
+    def get_informer(self, manager):
+        """Returns started K8sInformer for the manager, or None"""
+        informer = self._informers.get(manager.resource_type)
+        if informer is not None and informer.started:
+            return informer
+        return None
+
+    def stop_informers(self):
+        for informer in self._informers.values():
+            informer.stop()
+
+    @staticmethod
+    def __exit_code(status):
+        """Get the exit code from the exec status on the error channel"""
+        if not status:
+            return -1
+        if status.get('status') == 'Success':
+            return 0
+        for cause in (status.get('details') or {}).get('causes', []):
+            if cause.get('reason') == 'ExitCode':
+                return int(cause['message'])
+        return -1
+
+    def __exec(self, namespace, pod_name, command, container=None,
+               timeout=None, on_stdout=None):
+        """Run the command in the pod over the exec websocket
+
+        :param command: list, the command and its arguments
+        :param on_stdout: callable, gets the stdout chunks as they come
+                          instead of collecting them
+        :rtype: tuple (stdout, stderr, exit_code), stdout is empty
+                if on_stdout is set
+        """
+        kwargs = {}
+        if container:
+            kwargs['container'] = container
+        resp = stream(self.api_exec.connect_get_namespaced_pod_exec,
+                      pod_name, namespace, command=command,
+                      stdin=False, stdout=True, stderr=True, tty=False,
+                      _preload_content=False, **kwargs)
+        stdout = []
+        stderr = []
+        on_stdout = on_stdout or stdout.append
+        deadline = time.time() + timeout if timeout else None
+        try:
+            while resp.is_open():
+                resp.update(timeout=1)
+                if resp.peek_stdout():
+                    on_stdout(resp.read_stdout())
+                if resp.peek_stderr():
+                    stderr.append(resp.read_stderr())
+                if deadline is not None and time.time() > deadline:
+                    raise error.TimeoutError(
+                        "Command '{0}' in {1}/{2} is not finished in {3}s"
+                        .format(' '.join(command), namespace, pod_name,
+                                timeout))
+            on_stdout(resp.read_stdout())
+            stderr.append(resp.read_stderr())
+            status = json.loads(resp.read_channel(ERROR_CHANNEL) or '{}')
+        finally:
+            resp.close()
+        return ''.join(stdout), ''.join(stderr), self.__exit_code(status)
+
+    def execute(self, namespace, pod_name, cmd, container=None,
+                timeout=None, expected=None, raise_on_err=True):
+        """Execute the command in the pod over the K8S API
+
+        Unlike 'kubectl exec' on the controller, the command is started
+        through the websocket of the API server, without SSH and kubectl.
+        No shell is started for the command, like with 'kubectl exec',
+        so the pipelines and redirections are not supported; pass
+        ['/bin/sh', '-c', cmd] if the container has a shell.
+
+        :param namespace: str
+        :param pod_name: str
+        :param cmd: list of the command arguments, or str which is split
+                    into the arguments like the shell does
+        :param container: str, the first container of the pod if None
+        :param timeout: int, seconds
+        :param expected: list of the expected exit codes, [0] if None
+        :param raise_on_err: bool, raise if the exit code is not expected
+        :rtype: ExecResult
+        :raises: devops.error.DevopsCalledProcessError,
+                 devops.error.TimeoutError
+        """
+        expected = expected or [0]
+        if isinstance(cmd, six.string_types):
+            command = shlex.split(cmd)
+        else:
+            command = list(cmd)
+        cmd = ' '.join(pipes.quote(arg) for arg in command)
+        LOG.info("K8S API exec in {0}/{1}: {2}".format(
+            namespace, pod_name, cmd))
+        stdout, stderr, exit_code = self.__exec(
+            namespace, pod_name, command, container=container,
+            timeout=timeout)
+        result = exec_result.ExecResult(
+            cmd=cmd, stdout=stdout.splitlines(True),
+            stderr=stderr.splitlines(True), exit_code=exit_code)
+        if raise_on_err and result['exit_code'] not in expected:
+            raise error.DevopsCalledProcessError(
+                cmd, result['exit_code'], expected=expected,
+                stdout=result['stdout'], stderr=result['stderr'])
+        return result
+
+    @staticmethod
+    def __check_tar_member(member):
+        """Reject the members which would be extracted out of dest_dir"""
+        paths = [member.name]
+        if member.issym() or member.islnk():
+            paths.append(member.linkname)
+        for path in paths:
+            if os.path.isabs(path) or '..' in path.split('/'):
+                raise ValueError(
+                    "Unsafe path '{0}' in the archive of {1}".format(
+                        path, member.name))
+
+    def copy_from_pod(self, namespace, pod_name, src_path, dest_dir,
+                      container=None, raise_on_err=True):
+        """Copy the file or directory from the pod to the local dest_dir
+
+        The path is packed with tar inside the container and transferred
+        over the exec stream, which is decoded as UTF-8 by the client,
+        so the archive is encoded with base64 by the shell pipeline in
+        the container. It is decoded into a temporary file as it comes,
+        the members with absolute paths or '..' are rejected.
+        Contents of a directory are copied right into dest_dir, like
+        'kubectl cp' does.
+
+        :param src_path: str, absolute path in the container
+        :param dest_dir: str, local directory, created if missing
+        :rtype: list of the copied paths, relative to dest_dir
+        :raises: devops.error.DevopsCalledProcessError if nothing is
+                 copied, ValueError on the unsafe archive members
+        """
+        src_path = posixpath.normpath(src_path.rstrip('/') or '/')
+        cmd = ("if [ -d {0} ]; then tar cf - -C {0} .; else "
+               "tar cf - -C {1} {2}; fi | base64".format(
+                   pipes.quote(src_path),
+                   pipes.quote(posixpath.dirname(src_path)),
+                   pipes.quote(posixpath.basename(src_path))))
+        LOG.info("K8S API copy from {0}/{1}:{2}".format(
+            namespace, pod_name, src_path))
+        with tempfile.TemporaryFile() as archive:
+            encoded = ['']
+
+            def decode(chunk):
+                data = encoded[0] + ''.join(chunk.split())
+                size = len(data) // 4 * 4
+                archive.write(base64.b64decode(data[:size]))
+                encoded[0] = data[size:]
+
+            _, stderr, exit_code = self.__exec(
+                namespace, pod_name, ['/bin/sh', '-c', cmd],
+                container=container, on_stdout=decode)
+            archive.seek(0)
+            try:
+                tar = tarfile.open(fileobj=archive, mode='r:')
+            except tarfile.ReadError:
+                tar = None
+            try:
+                members = tar.getmembers() if tar else []
+                if not members:
+                    if raise_on_err:
+                        raise error.DevopsCalledProcessError(
+                            cmd, exit_code, stdout=[],
+                            stderr=stderr.splitlines(True))
+                    LOG.warning("Nothing is copied from {0}/{1}:{2}: {3}"
+                                .format(namespace, pod_name, src_path,
+                                        stderr))
+                    return []
+                for member in members:
+                    self.__check_tar_member(member)
+                if not os.path.isdir(dest_dir):
+                    os.makedirs(dest_dir)
+                for member in members:
+                    tar.extract(member, dest_dir)
+                return [member.name for member in members]
+            finally:
+                if tar:
+                    tar.close()
+
+    def run(self, namespace, name, image, port, replicas=1):
+        """Create the deployment like 'kubectl run' does
+
+        :rtype: K8sDeployment
+        """
+        labels = {'run': name}
+        body = {
+            'apiVersion': 'apps/v1',
+            'kind': 'Deployment',
+            'metadata': {'name': name, 'labels': labels},
+            'spec': {
+                'replicas': replicas,
+                'selector': {'matchLabels': labels},
+                'template': {
+                    'metadata': {'labels': labels},
+                    'spec': {
+                        'containers': [{
+                            'name': name,
+                            'image': image,
+                            'ports': [{'containerPort': int(port)}],
+                        }],
+                    },
+                },
+            },
+        }
+        return self.deployments.create(namespace=namespace, body=body)
+
+    def expose(self, resource, service_name=None, port=None,
+               service_type='ClusterIP'):
+        """Create the service for the resource like 'kubectl expose' does
+
+        :param resource: K8sBaseResource, like pod or deployment
+        :param port: int, the first container port of the resource if None
+        :rtype: K8sService
+        """
+        data = resource.read()
+        if resource.resource_type == 'pod':
+            selector = data.metadata.labels
+            containers = data.spec.containers
+        else:
+            selector = data.spec.selector
+            # label selector of the deployments, replicasets, etc.
+            selector = getattr(selector, 'match_labels', selector)
+            template = getattr(data.spec, 'template', None)
+            containers = template.spec.containers if template else []
+        if not port:
+            port = [p.container_port for c in containers
+                    for p in (c.ports or [])][0]
+        body = {
+            'apiVersion': 'v1',
+            'kind': 'Service',
+            'metadata': {
+                'name': service_name or resource.name,
+                'labels': data.metadata.labels,
+            },
+            'spec': {
+                'type': service_type,
+                'selector': selector,
+                'ports': [{'port': int(port), 'targetPort': int(port)}],
+            },
+        }
+        return self.services.create(namespace=resource.namespace, body=body)
+
+    def annotate(self, resource, annotations, overwrite=False):
+        """Set the resource annotations like 'kubectl annotate' does
+
+        :param annotations: dict, or str like 'key1=value1 key2-',
+                            the annotations with None values are removed
+        :param overwrite: bool, allow to change the existing annotations
+        :rtype: K8sBaseResource
+        """
+        if not isinstance(annotations, dict):
+            parsed = {}
+            for item in annotations.split():
+                if item.endswith('-'):
+                    parsed[item[:-1]] = None
+                else:
+                    key, value = item.split('=', 1)
+                    parsed[key] = value
+            annotations = parsed
+        if not overwrite:
+            current = resource.read().metadata.annotations or {}
+            for key, value in annotations.items():
+                if value is not None and current.get(key, value) != value:
+                    raise ValueError(
+                        "{0} {1} already has annotation '{2}', use "
+                        "overwrite=True to change it".format(
+                            resource.resource_type, resource.name, key))
+        return resource.patch({'metadata': {'annotations': annotations}})
+
+    def wait_all(self, resources, condition=None, timeout=600, interval=5,
+                 max_workers=None):
+        """Wait until the condition is True for all the resources
+
+        The resources are waited for in parallel with the single deadline,
+        so the wait takes as long as the slowest resource. Each resource
+        is reported to the log when it becomes ready.
+
+        :param resources: list of K8sBaseResource, like pods, deployments
+                          and daemonsets
+        :param condition: callable, gets the resource data (V1Pod, ...);
+                          _is_ready() of the resource if None
+        :param timeout: int, sec, for all the resources
+        :param interval: int, polling interval if the watch fails, sec
+        :param max_workers: int, settings.K8S_WAIT_MAX_WORKERS if None
+        :rtype: list of K8sBaseResource
+        :raises: devops.error.TimeoutError if some resources are not ready,
+                 ValueError if there is no condition for some resources,
+                 other errors of the waiting as is
+        """
+        resources = list(resources)
+        if not resources:
+            return resources
+        if condition is None:
+            no_condition = set(
+                resource.resource_type for resource in resources
+                if type(resource)._is_ready is K8sBaseResource._is_ready)
+            if no_condition:
+                raise ValueError(
+                    "No default readiness condition for {0}, the condition "
+                    "is required".format(', '.join(sorted(no_condition))))
+        started = time.time()
+        deadline = started + timeout
+        lock = threading.Lock()
+        ready = []
+
+        def wait(resource):
+            # The other errors are raised by thread_pool.map()
+            try:
+                resource.wait(condition or resource._is_ready,
+                              timeout=max(deadline - time.time(), 0),
+                              interval=interval)
+            except error.TimeoutError as e:
+                return e
+            with lock:
+                ready.append(resource)
+                LOG.info("{0} {1}/{2} is ready in {3:.0f}s ({4} of {5})"
+                         .format(resource.resource_type, resource.namespace,
+                                 resource.name, time.time() - started,
+                                 len(ready), len(resources)))
+            return None
+
+        workers = min(max_workers or settings.K8S_WAIT_MAX_WORKERS,
+                      len(resources))
+        thread_pool = mp_pool.ThreadPool(workers)
+        try:
+            results = thread_pool.map(wait, resources)
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+        failed = [(resource, result)
+                  for resource, result in zip(resources, results)
+                  if result is not None]
+        if failed:
+            raise error.TimeoutError(
+                "{0} of {1} resources are not ready in {2} sec:\n{3}".format(
+                    len(failed), len(resources), timeout,
+                    "\n".join("{0} {1}/{2}: {3}".format(
+                        resource.resource_type, resource.namespace,
+                        resource.name, result)
+                        for resource, result in failed)))
+        return resources
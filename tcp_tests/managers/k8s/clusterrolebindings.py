@@ -42,6 +42,7 @@ class K8sClusterRoleBinding(K8sBaseResource):
 
 class K8sClusterRoleBindingManager(K8sBaseManager):
     resource_class = K8sClusterRoleBinding
+    namespaced = False
 
     @property
     def api(self):
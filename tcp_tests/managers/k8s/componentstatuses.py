@@ -25,6 +25,7 @@ class K8sComponentStatus(K8sBaseResource):
 
 class K8sComponentStatusManager(K8sBaseManager):
     resource_class = K8sComponentStatus
+    namespaced = False
 
     @property
     def api(self):
@@ -41,6 +41,23 @@ class K8sDaemonSet(K8sBaseResource):
         self._manager.api.delete_namespaced_daemon_set(
             self.name, self.namespace, client.V1DeleteOptions(), **kwargs)
 
+    @staticmethod
+    def _is_ready(ds):
+        # The status of a just created or updated daemonset is not
+        # counted yet until the controller observes its generation
+        status = ds.status
+        if (status.observed_generation or 0) < ds.metadata.generation:
+            return False
+        desired = status.desired_number_scheduled
+        return ((status.updated_number_scheduled or 0) == desired and
+                status.number_ready == desired)
+
+    def is_ready(self):
+        return self._is_ready(self.read())
+
+    def wait_ready(self, timeout=120, interval=5):
+        return self.wait(self._is_ready, timeout=timeout, interval=interval)
+
 
 class K8sDaemonSetManager(K8sBaseManager):
     resource_class = K8sDaemonSet
@@ -14,8 +14,6 @@
 
 from kubernetes import client
 
-from devops.helpers import helpers
-
 from tcp_tests.managers.k8s.base import K8sBaseResource
 from tcp_tests.managers.k8s.base import K8sBaseManager
 
@@ -43,14 +41,15 @@ class K8sDeployment(K8sBaseResource):
         self._manager.api.delete_namespaced_deployment(
             self.name, self.namespace, client.V1DeleteOptions(), **kwargs)
 
-    def is_ready(self):
-        dep = self.read()
+    @staticmethod
+    def _is_ready(dep):
         return dep.status.available_replicas == dep.status.replicas
 
+    def is_ready(self):
+        return self._is_ready(self.read())
+
     def wait_ready(self, timeout=120, interval=5):
-        helpers.wait(lambda: self.is_ready(),
-                     timeout=timeout, interval=interval)
-        return self
+        return self.wait(self._is_ready, timeout=timeout, interval=interval)
 
 
 class K8sDeploymentManager(K8sBaseManager):
@@ -0,0 +1,197 @@
+#    Copyright 2019 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import bisect
+from collections import defaultdict
+import threading
+
+from kubernetes import watch
+
+from tcp_tests import logger
+
+LOG = logger.logger
+
+
+class K8sInformer(object):
+    """Local cache of all the resources of one type
+
+    The resources are listed once for all namespaces, then a background
+    thread watches the changes and updates the cache. Lookups by
+    namespace, name prefix, labels and node name are served from memory.
+    """
+
+    watch_timeout = 300
+    retry_interval = 5
+
+    def __init__(self, manager):
+        self._manager = manager
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__thread = None
+        self.__watch = None
+        self.__item_type = None
+        self.__resource_version = None
+        # {(namespace, name): data}
+        self.__items = {}
+        # sorted list of (namespace, name) for namespace/prefix lookups
+        self.__keys = []
+        # {(label, value): set of keys}
+        self.__by_label = defaultdict(set)
+        # {node_name: set of keys}
+        self.__by_node = defaultdict(set)
+
+    @staticmethod
+    def __key(data):
+        return (data.metadata.namespace or '', data.metadata.name)
+
+    @staticmethod
+    def __node_name(data):
+        spec = getattr(data, 'spec', None)
+        return getattr(spec, 'node_name', None)
+
+    def __add(self, data):
+        key = self.__key(data)
+        self.__remove(key)
+        self.__items[key] = data
+        bisect.insort(self.__keys, key)
+        for label in (data.metadata.labels or {}).items():
+            self.__by_label[label].add(key)
+        node_name = self.__node_name(data)
+        if node_name:
+            self.__by_node[node_name].add(key)
+
+    def __remove(self, key):
+        data = self.__items.pop(key, None)
+        if data is None:
+            return
+        del self.__keys[bisect.bisect_left(self.__keys, key)]
+        for label in (data.metadata.labels or {}).items():
+            self.__by_label[label].discard(key)
+        node_name = self.__node_name(data)
+        if node_name:
+            self.__by_node[node_name].discard(key)
+
+    def __relist(self):
+        result = self._manager._list_all()
+        self.__item_type = type(result).__name__[:-len('List')]
+        with self.__lock:
+            self.__items = {}
+            self.__keys = []
+            self.__by_label = defaultdict(set)
+            self.__by_node = defaultdict(set)
+            for data in result.items:
+                self.__add(data)
+            self.__resource_version = result.metadata.resource_version
+        LOG.debug("Informer for {0}: listed {1} items".format(
+            self._manager.resource_type, len(result.items)))
+
+    def __apply(self, event):
+        data = event['object']
+        with self.__lock:
+            if event['type'] == 'DELETED':
+                self.__remove(self.__key(data))
+            else:
+                self.__add(data)
+            self.__resource_version = data.metadata.resource_version
+
+    def __run(self):
+        while not self.__stopped.is_set():
+            try:
+                self.__watch = watch.Watch(return_type=self.__item_type)
+                for event in self.__watch.stream(
+                        self._manager._list_all,
+                        resource_version=self.__resource_version,
+                        timeout_seconds=self.watch_timeout):
+                    if self.__stopped.is_set():
+                        break
+                    if event['type'] == 'ERROR':
+                        if event['raw_object'].get('code') == 410:
+                            # resourceVersion is too old
+                            self.__relist()
+                            break
+                        raise ValueError(event['raw_object'].get('message'))
+                    self.__apply(event)
+            except Exception as e:
+                if self.__stopped.is_set():
+                    break
+                LOG.warning("Informer for {0}: watch failed, relisting: {1}"
+                            .format(self._manager.resource_type, e))
+                self.__stopped.wait(self.retry_interval)
+                try:
+                    self.__relist()
+                except Exception as e:
+                    LOG.warning("Informer for {0}: list failed: {1}".format(
+                        self._manager.resource_type, e))
+
+    @property
+    def started(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self):
+        """List the resources and start watching them"""
+        if self.started:
+            return self
+        self.__stopped.clear()
+        self.__relist()
+        self.__thread = threading.Thread(
+            target=self.__run,
+            name='k8s-informer-{}'.format(self._manager.resource_type))
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__watch is not None:
+            self.__watch.stop()
+
+    def list_data(self, namespace=None, name_prefix=None, labels=None,
+                  node_name=None):
+        """Find the resources data in the cache
+
+        :param namespace: str, any namespace if None
+        :param name_prefix: str
+        :param labels: dict, all the labels should match
+        :param node_name: str, for the resources with spec.node_name
+        :rtype: list of the resources data, sorted by namespace and name
+        """
+        with self.__lock:
+            if namespace is not None:
+                start = bisect.bisect_left(self.__keys,
+                                           (namespace, name_prefix or ''))
+                keys = []
+                for key in self.__keys[start:]:
+                    if key[0] != namespace or not key[1].startswith(
+                            name_prefix or ''):
+                        break
+                    keys.append(key)
+            elif name_prefix is not None:
+                keys = [key for key in self.__keys
+                        if key[1].startswith(name_prefix)]
+            else:
+                keys = list(self.__keys)
+
+            keys = set(keys)
+            for label in (labels or {}).items():
+                keys &= self.__by_label.get(label, set())
+            if node_name is not None:
+                keys &= self.__by_node.get(node_name, set())
+            return [self.__items[key] for key in sorted(keys)]
+
+    def list(self, namespace=None, name_prefix=None, labels=None,
+             node_name=None):
+        """Find the resources in the cache, see list_data()"""
+        return [self._manager.get(data=data) for data in self.list_data(
+            namespace=namespace, name_prefix=name_prefix, labels=labels,
+            node_name=node_name)]
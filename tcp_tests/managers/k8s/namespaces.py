@@ -40,6 +40,7 @@ class K8sNamespace(K8sBaseResource):
 
 class K8sNamespaceManager(K8sBaseManager):
     resource_class = K8sNamespace
+    namespaced = False
 
     @property
     def api(self):
@@ -40,6 +40,7 @@ class K8sNode(K8sBaseResource):
 
 class K8sNodeManager(K8sBaseManager):
     resource_class = K8sNode
+    namespaced = False
 
     @property
     def api(self):
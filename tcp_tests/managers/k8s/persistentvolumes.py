@@ -42,6 +42,7 @@ class K8sPersistentVolume(K8sBaseResource):
 
 class K8sPersistentVolumeManager(K8sBaseManager):
     resource_class = K8sPersistentVolume
+    namespaced = False
 
     @property
     def api(self):
@@ -14,8 +14,6 @@
 
 from kubernetes import client
 
-from devops.helpers import helpers
-
 from tcp_tests.managers.k8s.base import K8sBaseResource
 from tcp_tests.managers.k8s.base import K8sBaseManager
 
@@ -43,15 +41,18 @@ class K8sPod(K8sBaseResource):
         self._manager.api.delete_namespaced_pod(
             self.name, self.namespace, client.V1DeleteOptions(), **kwargs)
 
+    @staticmethod
+    def _is_ready(pod):
+        return pod.status.phase == 'Running'
+
     def wait_phase(self, phases, timeout=60, interval=3):
         if isinstance(phases, str):
             phases = [phases]
 
-        helpers.wait(lambda: self.read().status.phase in phases,
-                     timeout=timeout, interval=interval,
-                     timeout_msg='Timeout waiting, pod {0} phase is not in '
-                                 '"{1}"'.format(self.name, phases))
-        return self
+        return self.wait(lambda pod: pod.status.phase in phases,
+                         timeout=timeout, interval=interval,
+                         timeout_msg='Timeout waiting, pod {0} phase is not '
+                                     'in "{1}"'.format(self.name, phases))
 
     def wait_running(self, timeout=600, interval=3):
         return self.wait_phase('Running', timeout=timeout, interval=interval)
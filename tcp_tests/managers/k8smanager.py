@@ -14,12 +14,14 @@
 
 import os
 import requests
+import shutil
+import tempfile
 import yaml
 
-from devops.helpers import helpers
 from devops.error import DevopsCalledProcessError
 
 from tcp_tests import logger
+from tcp_tests import settings
 from tcp_tests.helpers import ext
 from tcp_tests.helpers.utils import retry
 from tcp_tests.managers.execute_commands import ExecuteCommandsMixin
@@ -52,12 +54,13 @@ class K8SManager(ExecuteCommandsMixin):
         self.__config.k8s.kube_host = self.get_proxy_api()
 
     def get_proxy_api(self):
-        k8s_proxy_ip_pillars = self._salt.get_pillar(
+        pillars = self._salt.get_pillars(
             tgt='I@haproxy:proxy:enabled:true and I@kubernetes:master',
-            pillar='haproxy:proxy:listen:k8s_secure:binds:address')
-        k8s_hosts = self._salt.get_pillar(
-            tgt='I@haproxy:proxy:enabled:true and I@kubernetes:master',
-            pillar='kubernetes:pool:apiserver:host')
+            pillars=['haproxy:proxy:listen:k8s_secure:binds:address',
+                     'kubernetes:pool:apiserver:host'])
+        k8s_proxy_ip_pillars = pillars[
+            'haproxy:proxy:listen:k8s_secure:binds:address']
+        k8s_hosts = pillars['kubernetes:pool:apiserver:host']
         k8s_proxy_ip = set([ip
                             for item in k8s_proxy_ip_pillars
                             for node, ip in item.items() if ip])
@@ -83,7 +86,8 @@ class K8SManager(ExecuteCommandsMixin):
             password=self.__config.k8s_deploy.kubernetes_admin_password,
             ca=ca_result['stdout'][0],
             host=self.__config.k8s.kube_host,
-            port=self.__config.k8s.kube_apiserver_port)
+            port=self.__config.k8s.kube_apiserver_port,
+            informers=settings.K8S_INFORMERS)
 
     @property
     def api(self):
@@ -184,6 +188,21 @@ class K8SManager(ExecuteCommandsMixin):
     def run_sample_deployment(self, name, **kwargs):
         return K8SSampleDeployment(self, name, **kwargs)
 
+    def wait_sample_deployments(self, samples, timeout=300, interval=5):
+        """Wait until all the K8SSampleDeployment are ready in parallel"""
+        self.api.wait_all([sample.deployment for sample in samples],
+                          timeout=timeout, interval=interval)
+        return samples
+
+    def wait_kube_system_ready(self, timeout=600, interval=5):
+        """Wait for all the deployments and daemonsets in kube-system"""
+        resources = self.api.deployments.list(namespace='kube-system')
+        resources.extend(self.api.daemonsets.list(namespace='kube-system'))
+        LOG.info("Waiting for {0} deployments and daemonsets in kube-system"
+                 .format(len(resources)))
+        return self.api.wait_all(resources, timeout=timeout,
+                                 interval=interval)
+
     def get_pod_ips_from_container(self, pod_name, exclude_local=True,
                                    namespace='default'):
         """ Get ips from container using 'ip a'
@@ -191,9 +210,11 @@ class K8SManager(ExecuteCommandsMixin):
 
             :return: list of IP adresses
         """
-        cmd = "ip a|grep \"inet \"|awk '{{print $2}}'"
-        result = self.kubectl.cli_exec(namespace, pod_name, cmd)['stdout']
-        ips = [line.strip().split('/')[0] for line in result]
+        result = self.api.execute(namespace, pod_name, ['ip', 'a'])['stdout']
+        # Parse 'inet <ip>/<prefix> ...' here, the container may have
+        # no grep and awk
+        ips = [line.split()[1].split('/')[0] for line in result
+               if line.strip().startswith('inet ')]
         if exclude_local:
             ips = [ip for ip in ips if not ip.startswith("127.")]
         return ips
@@ -301,8 +322,8 @@ class K8SManager(ExecuteCommandsMixin):
         sonobuoy_pod = self.api.pods.get('sonobuoy', 'heptio-sonobuoy')
         sonobuoy_pod.wait_running()
 
-        def sonobuoy_status():
-            annotations = sonobuoy_pod.read().metadata.annotations
+        def sonobuoy_status(pod):
+            annotations = pod.metadata.annotations
             json_status = annotations['sonobuoy.hept.io/status']
             status = yaml.safe_load(json_status)['status']
             if status != 'running':
@@ -310,8 +331,8 @@ class K8SManager(ExecuteCommandsMixin):
             return yaml.safe_load(json_status)['status']
 
         LOG.info("Waiting for CNCF to complete")
-        helpers.wait(
-            lambda: sonobuoy_status() == 'complete',
+        sonobuoy_pod.wait(
+            lambda pod: sonobuoy_status(pod) == 'complete',
             interval=120, timeout=timeout,
             timeout_msg="Timeout for CNCF reached."
         )
@@ -351,15 +372,14 @@ class K8SManager(ExecuteCommandsMixin):
 
         self.conformance_node = self.determine_conformance_node(target)
 
-        def cnf_status():
-            pod = cnf_pod.read()
+        def cnf_status(pod):
             status = pod.status.phase
             LOG.info("Conformance status: {}".format(status))
             return status
 
         LOG.info("Waiting for Conformance to complete")
-        helpers.wait(
-            lambda: cnf_status() in ('Succeeded', 'Failed'),
+        cnf_pod.wait(
+            lambda pod: cnf_status(pod) in ('Succeeded', 'Failed'),
             interval=120, timeout=timeout,
             timeout_msg="Timeout for Conformance reached."
         )
@@ -421,12 +441,23 @@ class K8SManager(ExecuteCommandsMixin):
                     container_id, file_path, out_dir)
                 remote.check_call(cmd, raise_on_err=False)
             else:
-                # system is k8s
+                # system is k8s, copy the files over the K8S API to the
+                # local temporary directory and upload them to the node
                 pod_name = kwargs.get('pod_name')
                 pod_namespace = kwargs.get('pod_namespace')
-                cmd = 'kubectl cp \"{0}/{1}:/{2}\" \"{3}\"'.format(
-                    pod_namespace, pod_name, file_path, out_dir)
-                remote.check_call(cmd, raise_on_err=False)
+                tmp_dir = tempfile.mkdtemp()
+                try:
+                    self.api.copy_from_pod(
+                        pod_namespace, pod_name, '/' + file_path, tmp_dir,
+                        raise_on_err=False)
+                    for name in os.listdir(tmp_dir):
+                        source = os.path.join(tmp_dir, name)
+                        # upload() puts the directory contents to target
+                        target = (os.path.join(out_dir, name)
+                                  if os.path.isdir(source) else out_dir)
+                        remote.upload(source, target)
+                finally:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
 
     def download_k8s_logs(self, files):
         """
@@ -538,7 +569,11 @@ class K8SManager(ExecuteCommandsMixin):
 
 
 class K8SKubectlCli(object):
-    """ Contain kubectl cli commands and api wrappers"""
+    """ Contain kubectl cli commands and api wrappers
+
+    The cli_* methods run kubectl on the controller node over SSH, the
+    wrappers use the K8S API directly.
+    """
     def __init__(self, manager):
         self._manager = manager
 
@@ -548,9 +583,8 @@ class K8SKubectlCli(object):
         return self._manager.controller_check_call(cmd)
 
     def run(self, namespace, name, image, port, replicas=1):
-        self.cli_run(namespace, name, image, port, replicas)
-        return self._manager.api.deployments.get(
-            namespace=namespace, name=name)
+        return self._manager.api.run(namespace, name, image, port,
+                                     replicas=replicas)
 
     def cli_expose(self, namespace, resource_type, resource_name,
                    service_name=None, port='', service_type='ClusterIP'):
@@ -562,11 +596,8 @@ class K8SKubectlCli(object):
 
     def expose(self, resource, service_name=None,
                port='', service_type='ClusterIP'):
-        self.cli_expose(resource.namespace, resource.resource_type,
-                        resource.name, service_name=service_name,
-                        port=port, service_type=service_type)
-        return self._manager.api.services.get(
-            namespace=resource.namespace, name=service_name or resource.name)
+        return self._manager.api.expose(resource, service_name=service_name,
+                                        port=port, service_type=service_type)
 
     def cli_exec(self, namespace, pod_name, cmd, container=''):
         kubectl_cmd = "kubectl -n {0} exec --container={1} {2} -- {3}".format(
@@ -575,7 +606,13 @@ class K8SKubectlCli(object):
 
     # def exec(...), except exec is statement in python
     def execute(self, pod, cmd, container=''):
-        return self.cli_exec(pod.namespace, pod.name, cmd, container=container)
+        if set(cmd) & set('|&;<>()$`'):
+            # The shell of the controller runs the rest of the pipeline
+            # or the redirection after 'kubectl exec', keep it there
+            return self.cli_exec(pod.namespace, pod.name, cmd,
+                                 container=container)
+        return self._manager.api.execute(pod.namespace, pod.name, cmd,
+                                         container=container)
 
     def cli_annotate(self, namespace, resource_type, resource_name,
                      annotations, overwrite=False):
@@ -586,9 +623,8 @@ class K8SKubectlCli(object):
         return self._manager.controller_check_call(cmd)
 
     def annotate(self, resource, annotations, overwrite=False):
-        return self.cli_annotate(resource.namespace, resource.resource_type,
-                                 resource.name, annotations,
-                                 overwrite=overwrite)
+        return self._manager.api.annotate(resource, annotations,
+                                          overwrite=overwrite)
 
 
 class K8SVirtlet(object):
@@ -598,9 +634,15 @@ class K8SVirtlet(object):
         self._namespace = namespace
 
     def get_virtlet_node_pod(self, node_name):
+        informer = self._manager.api.pods.informer
+        if informer is not None:
+            pods = informer.list(namespace=self._namespace,
+                                 name_prefix='virtlet-', node_name=node_name)
+            return pods[0] if pods else None
         for pod in self._manager.api.pods.list(
                 namespace=self._namespace, name_prefix='virtlet-'):
-            if pod.read().spec.node_name == node_name:
+            # The listed pods already have the spec
+            if pod.read(cached=True).spec.node_name == node_name:
                 return pod
         return None
 
@@ -647,8 +689,13 @@ class K8SSampleDeployment(object):
         self._index = 1  # used to generate svc name
         self._svc = None  # hold last created svc
 
+    @property
+    def deployment(self):
+        return self._deployment
+
     def wait_ready(self, timeout=300, interval=5):
-        self._deployment.wait_ready(timeout=timeout, interval=interval)
+        self._manager.api.wait_all([self._deployment], timeout=timeout,
+                                   interval=interval)
         return self
 
     def svc(self):
@@ -12,12 +12,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import copy
+import json
+import time
+
 import netaddr
 import pkg_resources
+import requests
 
 from collections import defaultdict
 
-from datetime import datetime
 from pepper import libpepper
 from tcp_tests.helpers import utils
 from tcp_tests import logger
@@ -27,6 +31,141 @@ from tcp_tests.managers.execute_commands import ExecuteCommandsMixin
 LOG = logger.logger
 
 
+class SaltApiClient(libpepper.Pepper):
+    """Salt API client which keeps the authentication session
+
+    - all requests to salt-api are sent through a single requests.Session,
+      so the HTTP connection is kept alive between the requests;
+    - the token is refreshed 'refresh_margin' seconds before it expires,
+      using the token lifetime ('expire' - 'start') returned by /login,
+      or when salt-api responds with 401;
+    - self.stats: counters of 'logins' and 'refreshes'.
+    """
+    # Used if /login didn't return the token 'start' and 'expire'
+    default_token_lifetime = 5 * 60
+
+    def __init__(self, api_url, username, password, eauth='pam',
+                 refresh_margin=60, timeout=None):
+        super(SaltApiClient, self).__init__(api_url)
+        self.username = username
+        self.password = password
+        self.eauth = eauth
+        self.refresh_margin = refresh_margin
+        self.timeout = timeout
+        self.stats = {'logins': 0, 'refreshes': 0}
+        self.__token_deadline = None
+        self.__session = requests.Session()
+        self.__session.headers.update({
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+        })
+
+    def __send(self, path, data):
+        url = '{0}/{1}'.format(self.api_url.rstrip('/'), path.lstrip('/'))
+        headers = {}
+        if self.auth and 'token' in self.auth:
+            headers['X-Auth-Token'] = self.auth['token']
+        try:
+            resp = self.__session.post(url, data=json.dumps(data),
+                                       headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise libpepper.PepperException(str(e))
+        if resp.status_code == 401:
+            raise libpepper.PepperException('Authentication denied')
+        if resp.status_code == 500:
+            raise libpepper.PepperException('Server error.')
+        if not resp.ok:
+            raise libpepper.PepperException(
+                "Unexpected response from {0}: {1} {2}".format(
+                    url, resp.status_code, resp.content))
+        return resp.json()
+
+    def login(self, username=None, password=None, eauth=None, **kwargs):
+        """Authenticate in salt-api and remember the token lifetime"""
+        self.username = username or self.username
+        self.password = password or self.password
+        self.eauth = eauth or self.eauth
+        if self.auth:
+            LOG.info("Refreshing Salt API authentication token")
+            self.stats['refreshes'] += 1
+        else:
+            LOG.info("Authentication in Salt API")
+        self.stats['logins'] += 1
+        self.auth = {}
+        self.auth = self.__send('/login', {
+            'username': self.username,
+            'password': self.password,
+            'eauth': self.eauth,
+        }).get('return', [{}])[0]
+        # 'start' and 'expire' are timestamps on the salt master, which
+        # clock may differ from the local one, so use only the lifetime.
+        lifetime = (self.auth.get('expire', 0) - self.auth.get('start', 0)
+                    or self.default_token_lifetime)
+        self.__token_deadline = time.time() + lifetime - self.refresh_margin
+        LOG.debug("Salt API token expires in {0:.0f} seconds"
+                  .format(lifetime))
+        return self.auth
+
+    def invalidate(self):
+        """Force the authentication on the next request
+
+        The HTTP connection to salt-api is kept.
+        """
+        self.__token_deadline = None
+
+    def __check_token(self):
+        if self.__token_deadline is None or \
+                time.time() >= self.__token_deadline:
+            self.login()
+
+    def events(self, timeout=None):
+        """Subscribe to the salt-api /events stream (Server-Sent Events)
+
+        The request is sent before the method returns, so the events
+        of the jobs submitted after the call are not lost.
+
+        :param timeout: seconds to wait for the next event, after that
+                        the stream raises requests.RequestException
+        :rtype: generator of dicts {'tag': str, 'data': dict}
+        """
+        self.__check_token()
+        url = '{0}/events'.format(self.api_url.rstrip('/'))
+        for attempt in range(2):
+            resp = self.__session.get(
+                url, stream=True, timeout=timeout,
+                headers={'Accept': 'text/event-stream',
+                         'X-Auth-Token': self.auth['token']})
+            if resp.status_code != 401:
+                break
+            resp.close()
+            if attempt:
+                raise libpepper.PepperException('Authentication denied')
+            LOG.info("Salt API token was rejected, re-authenticating")
+            self.login()
+        resp.raise_for_status()
+        return self.__iter_events(resp)
+
+    @staticmethod
+    def __iter_events(resp):
+        try:
+            for line in resp.iter_lines():
+                if line.startswith('data:'):
+                    yield json.loads(line[len('data:'):])
+        finally:
+            resp.close()
+
+    def req(self, path, data=None):
+        self.__check_token()
+        try:
+            return self.__send(path, data)
+        except libpepper.PepperException as e:
+            if 'Authentication denied' not in str(e):
+                raise
+            LOG.info("Salt API token was rejected, re-authenticating")
+            self.login()
+            return self.__send(path, data)
+
+
 class SaltManager(ExecuteCommandsMixin):
     """docstring for SaltManager"""
 
@@ -38,6 +177,18 @@ class SaltManager(ExecuteCommandsMixin):
         'runState': 'run_state',
         'runStates': 'run_states',
     }
+    # Salt functions that change pillars or grains on the minions,
+    # the cache of pillars or grains is dropped after calling them.
+    # States may do anything, so both caches are dropped after state.*
+    _pillar_refresh_funs = ('saltutil.refresh_pillar', 'saltutil.sync_all',
+                            'saltutil.sync_pillar', 'reclass.')
+    _grains_refresh_funs = ('saltutil.refresh_grains', 'saltutil.sync_grains',
+                            'saltutil.sync_all', 'grains.setval',
+                            'grains.set', 'grains.append', 'grains.delval')
+    # Both caches are dropped after the shell commands containing these
+    # words, because they may refresh or change the pillars or grains
+    _cache_refresh_words = ('saltutil', 'refresh_pillar', 'refresh_grains',
+                            'sync_', 'reclass', 'state.', 'grains.')
 
     def __init__(self, config, underlay, host=None, port='6969',
                  username=None, password=None):
@@ -49,6 +200,8 @@ class SaltManager(ExecuteCommandsMixin):
         self.__user = username or settings.SALT_USER
         self.__password = password or settings.SALT_PASSWORD
         self._salt = self
+        # {('pillar'|'grains', tgt, key): (timestamp, value)}
+        self.__cache = {}
 
         super(SaltManager, self).__init__(config=config, underlay=underlay)
 
@@ -69,6 +222,10 @@ class SaltManager(ExecuteCommandsMixin):
     def change_creds(self, username, password):
         self.__user = username
         self.__password = password
+        if self.__api:
+            self.__api.username = username
+            self.__api.password = password
+            self.__api.invalidate()
 
     @property
     def port(self):
@@ -85,40 +242,224 @@ class SaltManager(ExecuteCommandsMixin):
 
     @property
     def api(self):
-        def login():
-            LOG.info("Authentication in Salt API")
-            self.__api.login(
-                username=self.__user,
-                password=self.__password,
-                eauth='pam')
-            return datetime.now()
-
         if self.__api:
-            if (datetime.now() - self.__session_start).seconds < 5 * 60:
-                return self.__api
-            else:
-                # FIXXME: Change to debug
-                LOG.info("Session's expired")
-                self.__session_start = login()
-                return self.__api
+            return self.__api
 
         url = "http://{host}:{port}".format(
             host=self.host, port=self.port)
         LOG.info("Connecting to Salt API {0}".format(url))
-        self.__api = libpepper.Pepper(url)
-        self.__session_start = login()
+        self.__api = SaltApiClient(url, username=self.__user,
+                                   password=self.__password, eauth='pam')
         return self.__api
 
     def local(self, tgt, fun, args=None, kwargs=None, timeout=None):
+        self.__invalidate_cache_after(fun, args)
         return self.api.local(tgt, fun, args, kwargs, timeout=timeout,
                               expr_form='compound')
 
     def local_async(self, tgt, fun, args=None, kwargs=None, timeout=None):
-        return self.api.local_async(tgt, fun, args, kwargs, timeout=timeout)
+        self.__invalidate_cache_after(fun, args)
+        return self.api.local_async(tgt, fun, args, kwargs, timeout=timeout,
+                                    expr_form='compound')
+
+    def __invalidate_cache_after(self, fun, args=None):
+        if fun.startswith('state.'):
+            self.invalidate_cache()
+        elif fun.startswith('cmd.'):
+            self.invalidate_cache_after_command(args)
+        else:
+            if fun.startswith(self._pillar_refresh_funs):
+                self.invalidate_cache('pillar')
+            if fun.startswith(self._grains_refresh_funs):
+                self.invalidate_cache('grains')
+
+    def invalidate_cache_after_command(self, command):
+        """Drop cached pillars and grains if the command may change them
+
+        :param command: str or list of str, shell command or its args
+        """
+        if not command:
+            return
+        if not isinstance(command, (list, tuple)):
+            command = [command]
+        command = ' '.join(str(c) for c in command)
+        if any(word in command for word in self._cache_refresh_words):
+            self.invalidate_cache()
+
+    def invalidate_cache(self, kind=None):
+        """Drop cached pillars and/or grains
+
+        Should be called after the pillars were refreshed on the minions
+        not through this SaltManager, for example with 'salt' CLI.
+
+        :param kind: 'pillar', 'grains' or None to drop both
+        """
+        if kind is None:
+            self.__cache.clear()
+            return
+        for key in list(self.__cache):
+            if key[0] == kind:
+                del self.__cache[key]
+
+    def __cache_get(self, kind, tgt, key):
+        cached = self.__cache.get((kind, tgt, key))
+        if cached is None:
+            return None
+        timestamp, value = cached
+        if time.time() - timestamp > settings.SALT_CACHE_TTL:
+            del self.__cache[(kind, tgt, key)]
+            return None
+        return copy.deepcopy(value)
+
+    def __cache_set(self, kind, tgt, key, value):
+        if settings.SALT_CACHE_TTL > 0:
+            self.__cache[(kind, tgt, key)] = (time.time(),
+                                              copy.deepcopy(value))
 
     def lookup_result(self, jid):
         return self.api.lookup_jid(jid)
 
+    def run_async(self, tgt, fun, args=None, kwargs=None, timeout=None):
+        """Submit a job to the minions without waiting for the result
+
+        :rtype: tuple (jid, list of targeted minion ids)
+        """
+        r = self.local_async(tgt=tgt, fun=fun, args=args, kwargs=kwargs,
+                             timeout=timeout)
+        job = r.get('return', [{}])[0]
+        if not job or not job.get('minions'):
+            raise LookupError("No minions selected "
+                              "for the target '{0}'".format(tgt))
+        return job['jid'], sorted(job['minions'])
+
+    def run_and_wait(self, tgt, fun, args=None, kwargs=None, timeout=None,
+                     events=False):
+        """Submit a job and wait until all the targeted minions return
+
+        :param timeout: seconds to wait for the minions,
+                        default is settings.SALT_ASYNC_JOB_TIMEOUT
+        :param events: if True, watch the minions returns in the salt-api
+                       /events stream, else poll lookup_result() every
+                       settings.SALT_ASYNC_POLL_INTERVAL seconds.
+                       If the stream is interrupted, the returns are
+                       checked with lookup_result() and the stream is
+                       opened again.
+        The minions which have not returned are checked with
+        get_lost_minions() every settings.SALT_FIND_JOB_INTERVAL seconds,
+        the job is not waited for on the minions which are lost.
+
+        :rtype: tuple (result, missing) as get_async_result() returns
+        """
+        timeout = timeout or settings.SALT_ASYNC_JOB_TIMEOUT
+        deadline = time.time() + timeout
+        next_find_job = time.time() + settings.SALT_FIND_JOB_INTERVAL
+
+        def open_events():
+            # The stream is interrupted if there are no events for
+            # SALT_ASYNC_POLL_INTERVAL seconds or until the next check,
+            # so the job is checked on time even if the bus is quiet
+            wait = min(deadline, next_find_job) - time.time()
+            return self.api.events(timeout=max(
+                1, min(settings.SALT_ASYNC_POLL_INTERVAL, wait)))
+
+        stream = open_events() if events else None
+        jid, minions = self.run_async(tgt=tgt, fun=fun, args=args,
+                                      kwargs=kwargs, timeout=timeout)
+        LOG.info("Started job {0} '{1}' on {2}".format(
+            jid, fun if args is None else args, minions))
+        ret_tag = 'salt/job/{0}/ret/'.format(jid)
+        returned = set()
+        lost = set()
+
+        while True:
+            if stream is not None:
+                try:
+                    for event in stream:
+                        if event.get('tag', '').startswith(ret_tag):
+                            returned.add(event['data']['id'])
+                            LOG.debug("Job {0}: {1} of {2} minions returned"
+                                      .format(jid, len(returned),
+                                              len(minions)))
+                        if returned | lost >= set(minions) or \
+                                time.time() >= min(deadline, next_find_job):
+                            break
+                except requests.RequestException as e:
+                    LOG.debug("Salt API events stream is interrupted: {0}"
+                              .format(e))
+                stream.close()
+
+            r, missing = self.get_async_result(jid, minions)
+            if missing and time.time() >= next_find_job:
+                r, missing, job_lost = self.get_lost_minions(jid, minions)
+                lost.update(job_lost)
+                next_find_job = time.time() + settings.SALT_FIND_JOB_INTERVAL
+            if not set(missing) - lost or time.time() >= deadline:
+                return r, missing
+
+            if events:
+                stream = open_events()
+            else:
+                time.sleep(settings.SALT_ASYNC_POLL_INTERVAL)
+
+    def target_minions(self, tgt):
+        """Get minion ids matched by the target
+
+        The minions are matched by salt master using its minion data
+        cache, no job is sent to the minions. If the cache is empty
+        (minion_data_cache is disabled), the target is matched with
+        a 'test.ping' job, without waiting for the minions response.
+        """
+        r = self.api.runner('cache.grains', tgt=tgt, expr_form='compound')
+        minions = r.get('return', [{}])[0]
+        if minions:
+            return sorted(minions)
+        LOG.debug("Salt master minion data cache is empty, matching "
+                  "the target '{0}' with test.ping".format(tgt))
+        return self.run_async(tgt=tgt, fun='test.ping')[1]
+
+    def get_async_result(self, jid, minions):
+        """Get the job results returned by the minions so far
+
+        :param jid: str, job id returned by run_async()
+        :param minions: list of minion ids targeted by the job
+        :rtype: tuple (result, missing), where 'result' has the same
+                format as local() returns, and 'missing' is a list of
+                minions which have not returned yet.
+        """
+        r = self.lookup_result(jid)
+        returned = r.get('return', [{}])[0] or {}
+        if 'outputter' in returned and 'data' in returned:
+            # jobs.lookup_jid returns the output format for states
+            returned = returned['data']
+        missing = sorted(set(minions) - set(returned))
+        return {'return': [returned]}, missing
+
+    def get_lost_minions(self, jid, minions):
+        """Check the minions that have not returned with saltutil.find_job
+
+        :param jid: str, job id returned by run_async()
+        :param minions: list of minion ids targeted by the job
+        :rtype: tuple (result, missing, lost), where 'result' and
+                'missing' are the same as get_async_result() returns,
+                and 'lost' is a list of minions from 'missing' which
+                don't run the job anymore or don't respond.
+        """
+        r, missing = self.get_async_result(jid, minions)
+        if not missing:
+            return r, missing, []
+        found = self.local(tgt='L@' + ','.join(missing),
+                           fun='saltutil.find_job', args=jid,
+                           timeout=settings.SALT_FIND_JOB_TIMEOUT)
+        running = [minion for minion, job
+                   in (found.get('return', [{}])[0] or {}).items() if job]
+        # The minions could return while find_job was executed
+        r, missing = self.get_async_result(jid, minions)
+        lost = sorted(set(missing) - set(running))
+        if lost:
+            LOG.warning("Job {0}: minions {1} did not return and don't run "
+                        "the job anymore".format(jid, lost))
+        return r, missing, lost
+
     def check_result(self, r):
         if len(r.get('return', [])) == 0:
             raise LookupError("Result is empty or absent")
@@ -169,9 +510,37 @@ class SaltManager(ExecuteCommandsMixin):
         return rets
 
     def get_pillar(self, tgt, pillar):
+        value = self.__cache_get('pillar', tgt, pillar)
+        if value is not None:
+            return value
         result = self.local(tgt=tgt, fun='pillar.get', args=pillar)
+        self.__cache_set('pillar', tgt, pillar, result['return'])
         return result['return']
 
+    def get_pillars(self, tgt, pillars):
+        """Get several pillars from the minions with a single request
+
+        :param pillars: list of pillar keys, like 'linux:system:name'
+        :rtype: dict {<pillar>: <the same value as get_pillar() returns>}
+        """
+        values = {}
+        for pillar in pillars:
+            value = self.__cache_get('pillar', tgt, pillar)
+            if value is not None:
+                values[pillar] = value
+        missing = [pillar for pillar in pillars if pillar not in values]
+        if missing:
+            result = self.local(tgt=tgt, fun='pillar.item', args=missing)
+            minions = result['return'][0]
+            for pillar in missing:
+                value = [{minion: (minions[minion].get(pillar, '')
+                                   if isinstance(minions[minion], dict)
+                                   else minions[minion])
+                          for minion in minions}]
+                self.__cache_set('pillar', tgt, pillar, value)
+                values[pillar] = value
+        return values
+
     def get_single_pillar(self, tgt, pillar):
         """Get a scalar value from a single node
 
@@ -179,6 +548,19 @@ class SaltManager(ExecuteCommandsMixin):
         """
 
         result = self.get_pillar(tgt, pillar)
+        return self.__single_node_value(tgt, result)
+
+    def get_single_pillars(self, tgt, pillars):
+        """Get several pillars from a single node with a single request
+
+        :rtype: dict {<pillar>: <pillar value>}
+        """
+        results = self.get_pillars(tgt, pillars)
+        return {pillar: self.__single_node_value(tgt, results[pillar])
+                for pillar in pillars}
+
+    @staticmethod
+    def __single_node_value(tgt, result):
         nodes = result[0].keys()
 
         if not nodes:
@@ -191,7 +573,11 @@ class SaltManager(ExecuteCommandsMixin):
         return result[0][nodes[0]]
 
     def get_grains(self, tgt, grains):
+        value = self.__cache_get('grains', tgt, grains)
+        if value is not None:
+            return value
         result = self.local(tgt=tgt, fun='grains.get', args=grains)
+        self.__cache_set('grains', tgt, grains, result['return'])
         return result['return']
 
     def get_ssh_data(self):
@@ -289,7 +675,7 @@ class SaltManager(ExecuteCommandsMixin):
         # Force authentication update on the next API access
         # because previous authentication most probably is not valid
         # before or after time sync.
-        self.__api = None
+        self.api.invalidate()
         if not settings.SKIP_SYNC_TIME:
             cmd = ('chmod -x /usr/sbin/ntpd'
                    'service ntp stop;'
@@ -310,9 +696,10 @@ class SaltManager(ExecuteCommandsMixin):
                 tgt,
                 'cmd.run', cmd, timeout=360)  # noqa
         new_time_res = self.run_state(tgt, 'cmd.run', 'date')
-        for node_name, time in sorted(new_time_res[0]['return'][0].items()):
-            LOG.info("{0}: {1}".format(node_name, time))
-        self.__api = None
+        for node_name, node_time in sorted(
+                new_time_res[0]['return'][0].items()):
+            LOG.info("{0}: {1}".format(node_name, node_time))
+        self.api.invalidate()
 
     def create_env_salt(self):
         """Creates static utils/env_salt file"""
@@ -87,16 +87,30 @@ class SLManager(ExecuteCommandsMixin):
                 in self.__underlay.node_names() if 'mon' in node_name]
 
     def get_service_info_from_node(self, node_name):
-        service_stat_dict = {}
-        with self.__underlay.remote(node_name=node_name) as node_remote:
-            result = node_remote.execute(
-                "docker service ls --format '{{.Name}}:{{.Replicas}}'")
+        return self.get_service_info_from_nodes([node_name])[node_name]
+
+    def get_service_info_from_nodes(self, node_names):
+        """Get docker services replicas from the nodes in parallel
+
+        :param node_names: list of strings, names of nodes
+        :rtype: dict {<node_name>: {<service_name>: <replicas>}}
+        """
+        results = self.__underlay.check_call_many(
+            "docker service ls --format '{{.Name}}:{{.Replicas}}'",
+            node_names=node_names, expected=None, raise_on_err=False)
+        services = {}
+        for node_name in node_names:
+            result = results[node_name]
+            if isinstance(result, Exception):
+                raise result
             LOG.debug("Service ls result {0} from node {1}".format(
                 result['stdout'], node_name))
+            service_stat_dict = {}
             for line in result['stdout']:
                 tmp = line.split(':')
                 service_stat_dict.update({tmp[0]: tmp[1]})
-        return service_stat_dict
+            services[node_name] = service_stat_dict
+        return services
 
     def setup_sl_functional_tests(self, node_to_run,
                                   repo_path='/root/stacklight-pytest',
@@ -223,8 +237,9 @@ class SLManager(ExecuteCommandsMixin):
         :param nodes: list of strings, names of nodes to check
         :param expected_services: list of strings, names of services to find
         """
+        nodes_services = self.get_service_info_from_nodes(nodes)
         for node in nodes:
-            services_status = self.get_service_info_from_node(node)
+            services_status = nodes_services[node]
             assert set(services_status) >= set(expected_services), \
                 'Some services are missed on node {0}. ' \
                 'Current service list: {1}\nExpected service list: {2}' \
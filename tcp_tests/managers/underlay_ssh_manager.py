@@ -12,13 +12,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import itertools
+from multiprocessing import pool as mp_pool
 import os
 import random
 import StringIO
+import threading
+import time
 
 from devops.helpers import helpers
 from devops.helpers import ssh_client
 from devops.helpers import subprocess_runner
+from paramiko import pkey
 from paramiko import rsakey
 import yaml
 
@@ -30,6 +36,218 @@ from tcp_tests.helpers import utils
 LOG = logger.logger
 
 
+class PooledSSHClient(object):
+    """SSHClient from the SSHConnectionPool, checked out by the caller
+
+       All the attributes are taken from the pooled SSHClient. The client
+       is marked as used while this object exists, so the pool doesn't
+       close it as idle; it is released back to the pool when the object
+       is deleted, usually right after the caller's 'with' block or
+       function is finished.
+    """
+
+    def __init__(self, pool, key, client):
+        self.__pool = pool
+        self.__key = key
+        self.__client = client
+
+    def __getattr__(self, name):
+        return getattr(self.__client, name)
+
+    def __enter__(self):
+        self.__client.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self.__client.__exit__(exc_type, exc_val, exc_tb)
+
+    def __del__(self):
+        try:
+            self.__pool.release(self.__key, self.__client)
+        except Exception:
+            # the pool may be already destroyed on the interpreter exit
+            pass
+
+    def __repr__(self):
+        return repr(self.__client)
+
+
+class SSHConnectionPool(object):
+    """Keep opened SSH connections to reuse them between remote() calls
+
+       Connections are keyed by (host, port, login).
+       Before a pooled connection is returned, it is checked:
+       - if the transport is not active anymore, or
+       - if the connection was idle for more than 'check_interval' seconds
+         and doesn't respond to a short command,
+       then the connection is re-established (for example, after a node
+       reboot or an environment snapshot revert).
+       Connections that were idle for more than 'idle_timeout' seconds
+       are closed and removed from the pool. A connection is idle when
+       none of the PooledSSHClient objects returned for it exists, the
+       idle time is counted from the release of the last one.
+
+       self.stats: dict with counters of 'hits', 'misses', 'reconnects'
+                   and 'evictions'.
+    """
+
+    def __init__(self, idle_timeout=None, check_interval=None):
+        if idle_timeout is None:
+            idle_timeout = settings.SSH_POOL_IDLE_TIMEOUT
+        if check_interval is None:
+            check_interval = settings.SSH_POOL_CHECK_INTERVAL
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.stats = {'hits': 0, 'misses': 0, 'reconnects': 0,
+                      'evictions': 0}
+        # {(host, port, login): {'client': SSHClient, 'last_used': float,
+        #                        'in_use': int}}
+        self.__connections = {}
+        self.__key_locks = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def __set_keepalive(client):
+        client._ssh.get_transport().set_keepalive(
+            settings.SSH_SERVER_ALIVE_INTERVAL)
+
+    @staticmethod
+    def __is_active(client):
+        transport = client._ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def __is_alive(self, client, idle_time):
+        if not self.__is_active(client):
+            return False
+        if idle_time < self.check_interval:
+            return True
+        try:
+            client.execute('cd ~', timeout=5)
+            return True
+        except Exception as e:
+            LOG.debug("SSH connection {0} is broken: {1}".format(client, e))
+            return False
+
+    def __evict_idle(self, now):
+        for key, entry in list(self.__connections.items()):
+            if entry['in_use']:
+                continue
+            if now - entry['last_used'] > self.idle_timeout:
+                LOG.debug("Closing idle SSH connection to {0}".format(key))
+                del self.__connections[key]
+                self.stats['evictions'] += 1
+                try:
+                    entry['client'].close()
+                except Exception as e:
+                    LOG.debug("Error while closing SSH connection to "
+                              "{0}: {1}".format(key, e))
+
+    def __count(self, name):
+        with self.__lock:
+            self.stats[name] += 1
+
+    def get(self, host, port, auth):
+        """Get an opened SSHClient from the pool or create a new one
+
+        :param host: str, IP address or hostname
+        :param port: int
+        :param auth: ssh_client.SSHAuth object
+        :rtype: PooledSSHClient
+        """
+        key = (host, port, auth.username)
+        now = time.time()
+        with self.__lock:
+            self.__evict_idle(now)
+            key_lock = self.__key_locks.setdefault(key, threading.Lock())
+
+        # Connecting may take a while, so don't block other keys
+        with key_lock:
+            entry = self.__connections.get(key)
+            if entry is None:
+                self.__count('misses')
+                client = ssh_client.SSHClient(host=host, port=port, auth=auth)
+                self.__set_keepalive(client)
+                entry = {'client': client, 'last_used': now, 'in_use': 0}
+                with self.__lock:
+                    self.__connections[key] = entry
+            else:
+                self.__count('hits')
+                client = entry['client']
+                # Don't run the check command on the connection that is
+                # used by someone else right now, only check the transport
+                if entry['in_use']:
+                    alive = self.__is_active(client)
+                else:
+                    alive = self.__is_alive(client, now - entry['last_used'])
+                if not alive:
+                    LOG.info("Reconnecting SSH to {0}:{1}".format(host, port))
+                    self.__count('reconnects')
+                    client.reconnect()
+                    self.__set_keepalive(client)
+            with self.__lock:
+                entry['in_use'] += 1
+                entry['last_used'] = time.time()
+            return PooledSSHClient(self, key, client)
+
+    def release(self, key, client):
+        """Mark the client returned by get() as not used by the caller"""
+        with self.__lock:
+            entry = self.__connections.get(key)
+            if entry is not None and entry['client'] is client:
+                entry['in_use'] = max(entry['in_use'] - 1, 0)
+                entry['last_used'] = time.time()
+
+    def close(self):
+        """Close all pooled connections"""
+        with self.__lock:
+            for key, entry in self.__connections.items():
+                try:
+                    entry['client'].close()
+                except Exception as e:
+                    LOG.debug("Error while closing SSH connection to "
+                              "{0}: {1}".format(key, e))
+            self.__connections.clear()
+
+
+class PrefixTrie(object):
+    """Trie of strings to look up all the strings starting with a prefix
+
+       Strings are returned in the order they were added.
+    """
+
+    def __init__(self):
+        self.__root = {}
+        self.__counter = itertools.count()
+
+    def add(self, word):
+        if word is None:
+            return
+        node = self.__root
+        for char in word:
+            node = node.setdefault(char, {})
+        if None not in node:
+            # None key marks the end of a word and keeps its order number
+            node[None] = (next(self.__counter), word)
+
+    def startswith(self, prefix):
+        """Get list of words that start with the prefix"""
+        node = self.__root
+        for char in prefix:
+            if char not in node:
+                return []
+            node = node[char]
+        words = []
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            for char, child in node.items():
+                if char is None:
+                    words.append(child)
+                else:
+                    nodes.append(child)
+        return [word for _, word in sorted(words)]
+
+
 class UnderlaySSHManager(object):
     """Keep the list of SSH access credentials to Underlay nodes.
 
@@ -75,9 +293,11 @@ class UnderlaySSHManager(object):
        self.node_names(): list of node names registered in underlay.
        self.remote(): SSHClient object by a node name (w/wo address pool)
                       or by a hostname.
+                      SSH connections are reused between calls, see
+                      SSHConnectionPool.
     """
     __config = None
-    config_ssh = None
+    __config_ssh = None
 
     def __init__(self, config):
         """Read config.underlay.ssh object
@@ -85,11 +305,64 @@ class UnderlaySSHManager(object):
            :param config_ssh: dict
         """
         self.__config = config
-        if self.config_ssh is None:
-            self.config_ssh = []
+        self.__ssh_pool = SSHConnectionPool()
+        self.config_ssh = []
 
         self.add_config_ssh(self.__config.underlay.ssh)
 
+    @property
+    def config_ssh(self):
+        return self.__config_ssh
+
+    @config_ssh.setter
+    def config_ssh(self, config_ssh):
+        """Replace SSH access credentials and drop the parsed keys cache"""
+        self.__config_ssh = config_ssh
+        # {<private key text>: paramiko.RSAKey}
+        self.__keys_cache = {}
+        # {(login, password, (<private key>, ...)): ssh_client.SSHAuth}
+        self.__ssh_auth_cache = {}
+        self.__build_indexes()
+
+    def __build_indexes(self):
+        """Index self.config_ssh items to avoid scanning the whole list
+
+        Each index keeps the list of matched config_ssh items in the
+        original order, so lookups return the same items as the linear
+        search over config_ssh.
+        """
+        # {<node_name>: [ssh_data, ...]}, ordered by the first node_name
+        self.__by_node_name = collections.OrderedDict()
+        # {<minion_id>: [ssh_data, ...]}, ordered by the first minion_id
+        self.__by_minion_id = collections.OrderedDict()
+        self.__by_host = {}
+        self.__by_role = {}
+        # {(<node_name|minion_id|role>, <address_pool>): [ssh_data, ...]}
+        self.__by_node_name_pool = {}
+        self.__by_minion_id_pool = {}
+        self.__by_role_pool = {}
+        self.__node_names_trie = PrefixTrie()
+        self.__minion_ids_trie = PrefixTrie()
+        for ssh_data in self.config_ssh:
+            self.__index_add(ssh_data)
+
+    def __indexes(self, ssh_data):
+        pool = ssh_data['address_pool']
+        yield self.__by_node_name, ssh_data['node_name']
+        yield self.__by_minion_id, ssh_data['minion_id']
+        yield self.__by_host, ssh_data['host']
+        yield self.__by_node_name_pool, (ssh_data['node_name'], pool)
+        yield self.__by_minion_id_pool, (ssh_data['minion_id'], pool)
+        for role in set(ssh_data['roles']):
+            yield self.__by_role, role
+            yield self.__by_role_pool, (role, pool)
+
+    def __index_add(self, ssh_data):
+        for index, key in self.__indexes(ssh_data):
+            index.setdefault(key, []).append(ssh_data)
+        self.__node_names_trie.add(ssh_data['node_name'])
+        self.__minion_ids_trie.add(ssh_data['minion_id'])
+
     def add_config_ssh(self, config_ssh):
 
         if config_ssh is None:
@@ -116,7 +389,10 @@ class UnderlaySSHManager(object):
                 keys = self.__get_keys(remote)
                 ssh_data['keys'].extend(keys)
 
+            # Parse the private keys once, to reuse them in remote()
+            self.__ssh_auth(ssh_data)
             self.config_ssh.append(ssh_data)
+            self.__index_add(ssh_data)
 
     def remove_config_ssh(self, config_ssh):
         if config_ssh is None:
@@ -137,6 +413,9 @@ class UnderlaySSHManager(object):
                 'roles': ssh.get('roles', []),
             }
             self.config_ssh.remove(ssh_data)
+        # Removing an item may change the order of the node names,
+        # so the indexes are built again to keep it as in config_ssh
+        self.__build_indexes()
 
     def __get_keys(self, remote):
         keys = []
@@ -147,44 +426,59 @@ class UnderlaySSHManager(object):
                 keys.append(rsakey.RSAKey.from_private_key(f))
         return keys
 
+    def __parse_key(self, key):
+        if isinstance(key, pkey.PKey):
+            return key
+        if key not in self.__keys_cache:
+            self.__keys_cache[key] = rsakey.RSAKey(
+                file_obj=StringIO.StringIO(key))
+        return self.__keys_cache[key]
+
+    def __ssh_auth(self, ssh_data, username=None):
+        """Get cached SSHAuth object for the node credentials
+
+        :param ssh_data: dict, node SSH access credentials
+        :param username: str, login to use instead of ssh_data['login']
+        :rtype: ssh_client.SSHAuth
+        """
+        username = username or ssh_data['login']
+        auth_key = (username, ssh_data['password'], tuple(ssh_data['keys']))
+        if auth_key not in self.__ssh_auth_cache:
+            self.__ssh_auth_cache[auth_key] = ssh_client.SSHAuth(
+                username=username,
+                password=ssh_data['password'],
+                keys=[self.__parse_key(key) for key in ssh_data['keys']])
+        return self.__ssh_auth_cache[auth_key]
+
     def __ssh_data(self, node_name=None, host=None, address_pool=None,
                    node_role=None, minion_id=None):
 
+        # Without address_pool, the last matched item is used
+        # for node_name, node_role and minion_id.
         ssh_data = None
 
         if host is not None:
-            for ssh in self.config_ssh:
-                if host == ssh['host']:
-                    ssh_data = ssh
-                    break
-
-        elif node_name is not None:
-            for ssh in self.config_ssh:
-                if node_name == ssh['node_name']:
-                    if address_pool is not None:
-                        if address_pool == ssh['address_pool']:
-                            ssh_data = ssh
-                            break
-                    else:
-                        ssh_data = ssh
-        elif node_role is not None:
-            for ssh in self.config_ssh:
-                if node_role in ssh['roles']:
-                    if address_pool is not None:
-                        if address_pool == ssh['address_pool']:
-                            ssh_data = ssh
-                            break
-                    else:
-                        ssh_data = ssh
-        elif minion_id is not None:
-            for ssh in self.config_ssh:
-                if minion_id == ssh['minion_id']:
-                    if address_pool is not None:
-                        if address_pool == ssh['address_pool']:
-                            ssh_data = ssh
-                            break
-                    else:
-                        ssh_data = ssh
+            items = self.__by_host.get(host)
+            if items:
+                ssh_data = items[0]
+        else:
+            for key, index, pool_index in (
+                    (node_name, self.__by_node_name,
+                     self.__by_node_name_pool),
+                    (node_role, self.__by_role, self.__by_role_pool),
+                    (minion_id, self.__by_minion_id,
+                     self.__by_minion_id_pool)):
+                if key is None:
+                    continue
+                if address_pool is not None:
+                    items = pool_index.get((key, address_pool))
+                    if items:
+                        ssh_data = items[0]
+                else:
+                    items = index.get(key)
+                    if items:
+                        ssh_data = items[-1]
+                break
 
         if ssh_data is None:
             LOG.debug("config_ssh - {}".format(self.config_ssh))
@@ -196,20 +490,12 @@ class UnderlaySSHManager(object):
     def node_names(self):
         """Get list of node names registered in config.underlay.ssh"""
 
-        names = []  # List is used to keep the original order of names
-        for ssh in self.config_ssh:
-            if ssh['node_name'] not in names:
-                names.append(ssh['node_name'])
-        return names
+        return list(self.__by_node_name)
 
     def minion_ids(self):
         """Get list of minion ids registered in config.underlay.ssh"""
 
-        ids = []  # List is used to keep the original order of ids
-        for ssh in self.config_ssh:
-            if ssh['minion_id'] not in ids:
-                ids.append(ssh['minion_id'])
-        return ids
+        return list(self.__by_minion_id)
 
     def host_by_node_name(self, node_name, address_pool=None):
         ssh_data = self.__ssh_data(node_name=node_name,
@@ -239,11 +525,13 @@ class UnderlaySSHManager(object):
         """
         ssh_data = self.__ssh_data(node_name=node_name, host=host,
                                    address_pool=address_pool)
-        ssh_auth = ssh_client.SSHAuth(
-            username=username or ssh_data['login'],
-            password=ssh_data['password'],
-            keys=[rsakey.RSAKey(file_obj=StringIO.StringIO(key))
-                  for key in ssh_data['keys']])
+        ssh_auth = self.__ssh_auth(ssh_data, username=username)
+
+        if settings.SSH_POOL_ENABLED:
+            return self.__ssh_pool.get(
+                host=ssh_data['host'],
+                port=ssh_data['port'] or 22,
+                auth=ssh_auth)
 
         client = ssh_client.SSHClient(
             host=ssh_data['host'],
@@ -254,6 +542,20 @@ class UnderlaySSHManager(object):
 
         return client
 
+    @property
+    def ssh_pool_stats(self):
+        """Counters of the SSH connections pool
+
+        :rtype: dict with 'hits', 'misses', 'reconnects', 'evictions'
+        """
+        return dict(self.__ssh_pool.stats)
+
+    def close_connections(self):
+        """Close all SSH connections kept in the pool"""
+        LOG.debug("SSH connections pool stats: {0}"
+                  .format(self.ssh_pool_stats))
+        self.__ssh_pool.close()
+
     def local(self):
         """Get Subprocess instance for local operations like:
 
@@ -293,6 +595,92 @@ class UnderlaySSHManager(object):
             error_info=error_info, expected=expected,
             raise_on_err=raise_on_err)
 
+    def check_call_many(
+            self, cmd,
+            node_names=None, roles=None, prefix=None, address_pool=None,
+            max_workers=None, sudo=False,
+            verbose=False, timeout=None,
+            error_info=None,
+            expected=None, raise_on_err=True):
+        """Execute command on several nodes in parallel
+
+        Nodes are selected by one of 'node_names', 'roles' or 'prefix'
+        (see get_target_node_names()), the command is executed on up to
+        'max_workers' nodes at the same time.
+
+        :type cmd: str
+        :param node_names: list of node names
+        :param roles: list of node roles, nodes that have any of these
+                      roles are selected
+        :param prefix: str, nodes which names start with prefix are selected
+        :type address_pool: str
+        :param max_workers: int, size of the thread pool.
+                            Default is settings.SSH_MAX_WORKERS
+        :param sudo: bool, execute the command with sudo
+        :param timeout: int, timeout of the command on each node
+        :type verbose: bool
+        :type error_info: str
+        :type expected: list
+        :param raise_on_err: bool, if True then raise an exception with
+                             the summary of all failed nodes after the
+                             command is completed on all the nodes.
+                             If False, exceptions are returned in the
+                             result map instead of ExecResult objects.
+        :rtype: dict {<node_name>: ExecResult}
+        :raises: Exception
+        """
+        if node_names is None:
+            if roles is not None:
+                node_names = [name for name in self.node_names()
+                              if set(roles) & set(self.node_roles(name))]
+            elif prefix is not None:
+                node_names = self.get_target_node_names(target=prefix)
+            else:
+                raise ValueError("One of 'node_names', 'roles' or 'prefix' "
+                                 "should be specified!")
+        if not node_names:
+            LOG.warning("No nodes selected to execute '{0}'".format(cmd))
+            return {}
+
+        check_call = self.sudo_check_call if sudo else self.check_call
+
+        def call(node_name):
+            try:
+                return node_name, check_call(
+                    cmd, node_name=node_name, address_pool=address_pool,
+                    verbose=verbose, timeout=timeout, error_info=error_info,
+                    expected=expected, raise_on_err=raise_on_err)
+            except Exception as e:
+                LOG.error("Command '{0}' failed on {1}: {2}"
+                          .format(cmd, node_name, e))
+                return node_name, e
+
+        workers = min(max_workers or settings.SSH_MAX_WORKERS,
+                      len(node_names))
+        thread_pool = mp_pool.ThreadPool(workers)
+        try:
+            results = dict(thread_pool.map(call, node_names))
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+        failed = {node_name: result for node_name, result in results.items()
+                  if isinstance(result, Exception)}
+        if failed and raise_on_err:
+            raise Exception(
+                "Command '{0}' failed on {1} of {2} nodes:\n{3}".format(
+                    cmd, len(failed), len(node_names),
+                    "\n".join("{0}: {1}".format(node_name, failed[node_name])
+                              for node_name in sorted(failed))))
+        return results
+
+    def node_roles(self, node_name):
+        """Get list of roles of the node registered in config.underlay.ssh"""
+        roles = []
+        for ssh in self.__by_node_name.get(node_name, []):
+            roles.extend(r for r in ssh['roles'] if r not in roles)
+        return roles
+
     def apt_install_package(self, packages=None, node_name=None, host=None,
                             **kwargs):
         """Method to install packages on ubuntu nodes
@@ -398,7 +786,7 @@ class UnderlaySSHManager(object):
             port=ssh_data['port'] or 22,
             username=ssh_data['login'],
             password=ssh_data['password'],
-            private_keys=ssh_data['keys'])
+            private_keys=[self.__parse_key(key) for key in ssh_data['keys']])
 
     def read_template(self, file_path):
         """Read yaml as a jinja template"""
@@ -576,12 +964,8 @@ class UnderlaySSHManager(object):
 
     def get_target_node_names(self, target='gtw01.'):
         """Get all node names which names starts with <target>"""
-        return [node_name for node_name
-                in self.node_names()
-                if node_name.startswith(target)]
+        return self.__node_names_trie.startswith(target)
 
     def get_target_minion_ids(self, target='gtw01.'):
         """Get all minion ids which names starts with <target>"""
-        return [minion_id for minion_id
-                in self.minion_ids()
-                if minion_id.startswith(target)]
+        return self.__minion_ids_trie.startswith(target)
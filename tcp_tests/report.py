@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 import datetime
+import json
+import os
+import sqlite3
 import sys
 import logging
+import threading
+import time
 from collections import defaultdict, OrderedDict
+from multiprocessing import pool as mp_pool
 
 import jira
 import argparse
@@ -10,11 +16,133 @@ import argparse
 from testrail import TestRail
 from testrail.test import Test
 # from testrail_api import APIClient
-from functools32 import lru_cache
 
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
 LOG = logging.getLogger(__name__)
 
+# Max number of runs processed at the same time
+MAX_WORKERS = 8
+# TestRail Cloud allows up to 180 API requests per minute per instance.
+# On 429 status the testrail library waits for Retry-After and retries.
+TESTRAIL_REQUESTS_PER_MINUTE = 180
+
+
+class RateLimiter(object):
+    """Allow not more than 'rate' calls per minute from all threads"""
+
+    def __init__(self, rate=TESTRAIL_REQUESTS_PER_MINUTE):
+        self.interval = 60.0 / rate if rate else 0
+        self.__next_call = 0
+        self.__lock = threading.Lock()
+
+    def __call__(self, func, *args, **kwargs):
+        with self.__lock:
+            now = time.time()
+            delay = self.__next_call - now
+            self.__next_call = max(now, self.__next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+        return func(*args, **kwargs)
+
+
+testrail_limiter = RateLimiter()
+
+# Suggested directory for the on-disk cache, which is disabled by default
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'tcp-qa-report')
+# Time to keep the entities in the on-disk cache, sec
+CACHE_TTL = {
+    'defect': 12 * 3600,
+    'run_tests': 3600,
+}
+# Max number of issues requested from JIRA with one JQL search
+JIRA_BATCH_SIZE = 100
+# Max number of results added to TestRail with one request
+RESULTS_BATCH_SIZE = 250
+
+
+class DiskCache(object):
+    """Cache of JSON-serializable values in sqlite database
+
+    Each kind of entity has its own TTL from CACHE_TTL.
+    If cache_dir is None, nothing is cached.
+    scopes is a dict {kind: scope}, the scope (the server and the user
+    the entities are taken from) is a part of the keys of the kind,
+    so the entities of the different servers are not mixed up.
+    """
+
+    def __init__(self, cache_dir=None, ttl=None, scopes=None):
+        self.ttl = ttl or CACHE_TTL
+        self.scopes = scopes or {}
+        self.__lock = threading.Lock()
+        self.__db = None
+        if cache_dir is None:
+            return
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.__db = sqlite3.connect(os.path.join(cache_dir, 'cache.sqlite'),
+                                    check_same_thread=False)
+        with self.__db:
+            self.__db.execute(
+                "CREATE TABLE IF NOT EXISTS cache (kind TEXT, key TEXT, "
+                "value TEXT, ts REAL, PRIMARY KEY (kind, key))")
+
+    def get(self, kind, key):
+        """Returns the cached value or None if missing or expired"""
+        if self.__db is None:
+            return None
+        with self.__lock:
+            row = self.__db.execute(
+                "SELECT value, ts FROM cache WHERE kind = ? AND key = ?",
+                (kind, self.__key(kind, key))).fetchone()
+        if row is None or row[1] + self.ttl.get(kind, 0) < time.time():
+            return None
+        return json.loads(row[0])
+
+    def set(self, kind, key, value):
+        if self.__db is None:
+            return
+        with self.__lock:
+            with self.__db:
+                self.__db.execute(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                    (kind, self.__key(kind, key), json.dumps(value),
+                     time.time()))
+
+    def __key(self, kind, key):
+        return json.dumps([self.scopes.get(kind), str(key)])
+
+
+cache = DiskCache()
+
+
+def configure_cache(cache_dir=None, no_cache=False, testrail=None,
+                    jira=None):
+    """Set up the on-disk cache
+
+    :param testrail: (host, user) of TestRail
+    :param jira: (host, user) of JIRA
+    """
+    global cache
+    cache = DiskCache(None if no_cache else cache_dir,
+                      scopes={'run_tests': testrail, 'defect': jira})
+
+
+def map_ordered(func, items, max_workers=MAX_WORKERS):
+    """Call func for each item in a thread pool
+
+    Returns the list of results in the order of items
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    thread_pool = mp_pool.ThreadPool(min(max_workers, len(items)))
+    try:
+        return thread_pool.map(func, items)
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+
 
 def run_cli():
     cli = argparse.ArgumentParser(
@@ -70,6 +198,16 @@ def run_cli():
         "--push-to-testrail", dest="push_report_flag", action="store_true",
         default=False,
         help="Save report in plan description")
+    cli_process.add_argument(
+        "--max-workers", dest="max_workers", type=int, default=MAX_WORKERS,
+        help="Max number of TestRail runs processed at the same time")
+    cli_process.add_argument(
+        "--cache-dir", dest="cache_dir", default=None,
+        help="Directory for the cache of JIRA issues and TestRail tests, "
+             "e.g. {}. By default nothing is cached".format(DEFAULT_CACHE_DIR))
+    cli_process.add_argument(
+        "--no-cache", dest="no_cache", action="store_true", default=False,
+        help="Don't use the on-disk cache")
     cli_process.add_argument(
         "-j", "--jira-host", dest="jira_host",
         required=True,
@@ -115,6 +253,16 @@ def run_cli():
         "--push-to-testrail", dest="update_report_flag", action="store_true",
         default=False,
         help="Save report in plan description")
+    cli_process_link.add_argument(
+        "--max-workers", dest="max_workers", type=int, default=MAX_WORKERS,
+        help="Max number of TestRail runs processed at the same time")
+    cli_process_link.add_argument(
+        "--cache-dir", dest="cache_dir", default=None,
+        help="Directory for the cache of JIRA issues and TestRail tests, "
+             "e.g. {}. By default nothing is cached".format(DEFAULT_CACHE_DIR))
+    cli_process_link.add_argument(
+        "--no-cache", dest="no_cache", action="store_true", default=False,
+        help="Don't use the on-disk cache")
 
     if len(sys.argv) == 1:
         cli.print_help()
@@ -139,14 +287,55 @@ def get_runs(t_client, plan_name, run_name):
     return ret
 
 
-def get_all_results(t_client, list_of_runs):
+def has_defects(result):
+    return (result.raw_data()['status_id'] is not None and
+            result.raw_data()['defects'] is not None)
+
+
+def failed_results_filter(result_type):
+    """Get the filter of the results for get_failed_results()"""
+    if result_type == '5':
+        return lambda r: (r.raw_data()['status_id'] is int(result_type) and
+                          r.raw_data()['defects'] is None)
+    return has_defects
+
+
+def fetch_run_results(t_client, run, result_filter=None):
+    """Get the results of the run and the tests for them
+
+    Is called in the worker threads, so only fetches the data
+    without logging, to keep the output order. The tests are fetched
+    only for the results accepted by result_filter.
+
+    returned result format:
+    [(result(id,status,defects...), test(id,name..)), ...]
+    """
+    results = testrail_limiter(t_client.results, run)
+    if result_filter is not None:
+        results = [result for result in results if result_filter(result)]
+    return [(result,
+             fetch_test(result.api, result.raw_data()['test_id'], run.id))
+            for result in results]
+
+
+def fetch_all_run_results(t_client, list_of_runs, max_workers=MAX_WORKERS,
+                          result_filter=None):
+    return map_ordered(
+        lambda run: fetch_run_results(t_client, run, result_filter),
+        list_of_runs, max_workers=max_workers)
+
+
+def get_all_results(t_client, list_of_runs, max_workers=MAX_WORKERS):
     ret = []
-    for run in list_of_runs:
-        ret.extend(get_results(t_client, run))
+    all_results = fetch_all_run_results(t_client, list_of_runs, max_workers,
+                                        result_filter=has_defects)
+    for run, results in zip(list_of_runs, all_results):
+        ret.extend(get_results(t_client, run, results))
     return ret
 
 
-def get_all_failed_results(t_client, list_of_runs, result_type):
+def get_all_failed_results(t_client, list_of_runs, result_type,
+                           max_workers=MAX_WORKERS):
     """
     returned result format:
     [[run(id,name), result(id,status,defects...), test(id,name..)],
@@ -154,51 +343,80 @@ def get_all_failed_results(t_client, list_of_runs, result_type):
                                                                 ...]
     """
     ret = []
-    for run in list_of_runs:
-        ret.extend(get_failed_results(t_client, run, result_type))
+    all_results = fetch_all_run_results(
+        t_client, list_of_runs, max_workers,
+        result_filter=failed_results_filter(result_type))
+    for run, results in zip(list_of_runs, all_results):
+        ret.extend(get_failed_results(t_client, run, result_type, results))
     return ret
 
 
-@lru_cache()
+# Tests of the runs: {run_id: {test_id: Test}}
+_run_tests_index = {}
+_run_tests_locks = defaultdict(threading.Lock)
+
+
+def get_run_tests(api, run_id):
+    """Get all the tests of the run with one bulk request
+
+    Returns dict {test_id: Test}, which is fetched once per run.
+    """
+    if run_id not in _run_tests_index:
+        with _run_tests_locks[run_id]:
+            if run_id not in _run_tests_index:
+                tests = cache.get('run_tests', run_id)
+                if tests is None:
+                    tests = testrail_limiter(api.tests, run_id)
+                    cache.set('run_tests', run_id, tests)
+                _run_tests_index[run_id] = dict(
+                    (test['id'], Test(test)) for test in tests)
+    return _run_tests_index[run_id]
+
+
 def fetch_test(api, test_id, run_id):
-    return Test(api.test_with_id(test_id, run_id))
+    test = get_run_tests(api, run_id).get(test_id)
+    if test is None:
+        # The test was added to the run after the index was built
+        test = Test(testrail_limiter(api.test_with_id, test_id))
+        _run_tests_index[run_id][test_id] = test
+    return test
 
 
-def get_results(t_client, run):
+def get_results(t_client, run, results=None):
+    """
+    :param results: results with tests from fetch_run_results(),
+                    fetched if None
+    """
     LOG.info("Get results for run - {}".format(run.name))
-    results = t_client.results(run)
-    ret = [(run.id, r) for r in results
-           if r.raw_data()['status_id'] is not None and
-           r.raw_data()['defects'] is not None]
-    for r in ret:
-        run_id, result = r
-        test = fetch_test(result.api, result.raw_data()['test_id'], run_id)
-        LOG.info("Test {} - {} - {}".format(test.title, result.status.name,
-                                            ','.join(result.defects)))
+    if results is None:
+        results = fetch_run_results(t_client, run, has_defects)
+    ret = []
+    for result, test in results:
+        if has_defects(result):
+            LOG.info("Test {} - {} - {}".format(test.title,
+                                                result.status.name,
+                                                ','.join(result.defects)))
+            ret.append((run.id, result))
     return ret
 
 
-def get_failed_results(t_client, run, result_type):
+def get_failed_results(t_client, run, result_type, results=None):
     """
+    :param results: results with tests from fetch_run_results(),
+                    fetched if None
+
     returned result format:
     [run(id,name),
      result(id,status,defects...),
      test(id,name..)]
     """
     LOG.info("Get results for run - {}".format(run.name))
-    results = t_client.results(run)
+    result_filter = failed_results_filter(result_type)
+    if results is None:
+        results = fetch_run_results(t_client, run, result_filter)
     results_with_test = []
-    if result_type == '5':
-        ret = [(run, r) for r in results
-               if r.raw_data()['status_id'] is int(result_type) and
-               r.raw_data()['defects'] is None]
-    else:
-        ret = [(run, r) for r in results
-               if r.raw_data()['status_id'] is not None and
-               r.raw_data()['defects'] is not None]
-    for r in ret:
-        run, result = r
-        test = fetch_test(result.api, result.raw_data()['test_id'], run.id)
+    ret = [(r, t) for r, t in results if result_filter(r)]
+    for result, test in ret:
         LOG.info("Test {} - {} - {} - {}"
                  .format(test.title, result.status.name,
                          result.raw_data()['status_id'],
@@ -231,21 +449,36 @@ def mark_failed_results(t_cl, marked_res, failed_res, t_h):
     # def check_if_marked():
     #     if ret.count()
 
+    marked_index = defaultdict(list)
+    for m_run, m_result, m_test in marked_res:
+        marked_index[(m_run.name, m_test.title)].append((m_result, m_test))
+
     ret = []
     for run, result, test in failed_res:
-        for m_run, m_result, m_test in marked_res:
-            if run.name == m_run.name \
-             and test.title == m_test.title:
-                LOG.info(" MARKED FOUND: Run:{} test: .. {}-{}"
-                         .format(run.id, test.title[-72:],
-                                 m_result.defects[0]))
-                ret.append([generate_result(t_cl, test, m_result,
-                                            m_test), run.id])
+        for m_result, m_test in marked_index.get((run.name, test.title), []):
+            LOG.info(" MARKED FOUND: Run:{} test: .. {}-{}"
+                     .format(run.id, test.title[-72:],
+                             m_result.defects[0]))
+            ret.append([generate_result(t_cl, test, m_result,
+                                        m_test), run.id])
     return ret
 
 
-@lru_cache()
+def defect_info(issue):
+    return {
+        'id': issue.key,
+        'title': issue.fields.summary,
+        'project': issue.fields.project.key,
+        'priority': issue.fields.priority.name,
+        'status': issue.fields.status.name,
+        'url': issue.permalink()
+    }
+
+
 def get_defect_info(j_client, defect):
+    info = cache.get('defect', defect)
+    if info is not None:
+        return info
     LOG.info("Get info about issue {}".format(defect))
     try:
         issue = j_client.issue(defect)
@@ -262,23 +495,59 @@ def get_defect_info(j_client, defect):
             }
         else:
             raise
-    return {
-        'id': issue.key,
-        'title': issue.fields.summary,
-        'project': issue.fields.project.key,
-        'priority': issue.fields.priority.name,
-        'status': issue.fields.status.name,
-        'url': issue.permalink()
-    }
+    info = defect_info(issue)
+    cache.set('defect', defect, info)
+    return info
+
+
+def get_defects_info(j_client, defects):
+    """Get info about the defects with batched JQL searches
+
+    Returns dict {defect: info}. Defects that are not returned by
+    the search (moved or missing issues) are requested one by one.
+    """
+    ret = {}
+    missing = []
+    for defect in sorted(set(defects)):
+        info = cache.get('defect', defect)
+        if info is None:
+            missing.append(defect)
+        else:
+            ret[defect] = info
+
+    for i in range(0, len(missing), JIRA_BATCH_SIZE):
+        batch = missing[i:i + JIRA_BATCH_SIZE]
+        LOG.info("Get info about issues {}".format(', '.join(batch)))
+        jql = 'key in ({})'.format(', '.join(
+            '"{}"'.format(defect) for defect in batch))
+        try:
+            issues = j_client.search_issues(
+                jql, maxResults=len(batch), validate_query=False,
+                fields='summary,project,priority,status')
+        except jira.exceptions.JIRAError as e:
+            LOG.warning("Search of the issues failed: {}".format(e))
+            continue
+        for issue in issues:
+            if issue.key in batch:
+                ret[issue.key] = defect_info(issue)
+                cache.set('defect', issue.key, ret[issue.key])
+
+    for defect in missing:
+        if defect not in ret:
+            ret[defect] = get_defect_info(j_client, defect)
+    return ret
 
 
 def get_defects_table(jira_client, list_of_results, sort_by):
     LOG.info("Collect report table")
     table = defaultdict(dict)
+    defects_info = get_defects_info(
+        jira_client,
+        [defect for _, result in list_of_results for defect in result.defects])
     for run_id, result in list_of_results:
         for defect in result.defects:
             if defect not in table:
-                info = get_defect_info(jira_client, defect)
+                info = defects_info[defect]
 
                 table[defect].update(info)
                 table[defect]['results'] = set([(run_id, result)])
@@ -455,12 +724,39 @@ def update_report(t_client, plan_name, tests_table):
              + "\n===\nList tests to udate:")
     plan = t_client.plan(plan_name)
     if plan:
-        for r_test, run in tests_table:
-            t_client.add(r_test)
-            print(r_test.test.title)
+        results_by_run = OrderedDict()
+        for r_test, run_id in tests_table:
+            results_by_run.setdefault(run_id, []).append(r_test)
+        for run_id, results in results_by_run.items():
+            add_results(t_client, run_id, results)
     LOG.info("\n===\nUpdate plan finished - {}".format(plan_name))
 
 
+def add_results(t_client, run_id, results):
+    """Add the results to the run with bulk requests
+
+    If a bulk request fails, the results of its batch are added
+    one by one, like before the bulk requests were used.
+    """
+    for i in range(0, len(results), RESULTS_BATCH_SIZE):
+        batch = [r_test.raw_data()
+                 for r_test in results[i:i + RESULTS_BATCH_SIZE]]
+        for data in batch:
+            print(fetch_test(t_client.api, data['test_id'], run_id).title)
+        try:
+            testrail_limiter(t_client.api.add_results, batch, run_id)
+        except Exception as e:
+            LOG.warning("Can't add the results to the run {} with one "
+                        "request, adding them one by one: {}"
+                        .format(run_id, e))
+            # add_result() looks for the test in the tests of the run
+            # cached by the API object, which may be not loaded if the
+            # tests were taken from the on-disk cache
+            testrail_limiter(t_client.api.tests, run_id)
+            for data in batch:
+                testrail_limiter(t_client.api.add_result, data)
+
+
 def create_report(**kwargs):
     j_host = kwargs.get('jira_host')
     j_user = kwargs.get('jira_user_id')
@@ -474,6 +770,9 @@ def create_report(**kwargs):
     o_type = kwargs.get('out_type')
     push_report_flag = kwargs.get('push_report_flag')
     sort_by = kwargs.get('sort_by')
+    max_workers = kwargs.get('max_workers', MAX_WORKERS)
+    configure_cache(kwargs.get('cache_dir'), kwargs.get('no_cache', False),
+                    testrail=(t_host, t_user), jira=(j_host, j_user))
 
     t_client = TestRail(email=t_user, key=t_user_key, url=t_host)
     t_client.set_project_id(t_client.project(t_project).id)
@@ -481,7 +780,7 @@ def create_report(**kwargs):
     j_client = jira.JIRA(j_host, basic_auth=(j_user, j_user_pwd))
 
     runs = get_runs(t_client, t_plan, t_a_run)
-    results = get_all_results(t_client, runs)
+    results = get_all_results(t_client, runs, max_workers)
     table = get_defects_table(j_client, results, sort_by)
     out_table(o_type, table)
     if push_report_flag:
@@ -499,6 +798,9 @@ def mark_fails(**kwargs):
     if testrail_active_run == '':
         testrail_active_run = None
     update_report_flag = kwargs.get('update_report_flag')
+    max_workers = kwargs.get('max_workers', MAX_WORKERS)
+    configure_cache(kwargs.get('cache_dir'), kwargs.get('no_cache', False),
+                    testrail=(testrail_host, testrail_user))
 
     testrail_client = TestRail(email=testrail_user, key=testrail_user_key,
                                url=testrail_host)
@@ -514,11 +816,12 @@ def mark_fails(**kwargs):
 
     # Get list (failed, prod_failed, test_failed,skipped..) tests with defects
     marked_results = get_all_failed_results(testrail_client, marked_runs,
-                                            '2,3,4,5,6,7,8,9')
+                                            '2,3,4,5,6,7,8,9', max_workers)
 
     # Get list (failed) tests without defects to mark
     failed_results = get_all_failed_results(testrail_client,
-                                            runs, '5')  # 5-failed
+                                            runs, '5',  # 5-failed
+                                            max_workers)
 
     # Generate list tests to update based on compare (defected
     # results for tests with failed and not defected)
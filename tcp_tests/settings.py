@@ -53,6 +53,26 @@ SSH_NODE_CREDENTIALS = {"login": SSH_LOGIN,
 SSH_SERVER_ALIVE_INTERVAL = int(
     os.environ.get('SSH_SERVER_ALIVE_INTERVAL', 60))
 
+# Reuse SSH connections to the underlay nodes between remote() calls.
+SSH_POOL_ENABLED = get_var_as_bool('SSH_POOL_ENABLED', True)
+# Pooled SSH connections that were not used for more than
+# SSH_POOL_IDLE_TIMEOUT seconds are closed.
+SSH_POOL_IDLE_TIMEOUT = int(os.environ.get('SSH_POOL_IDLE_TIMEOUT', 600))
+# Pooled SSH connections that were not used for more than
+# SSH_POOL_CHECK_INTERVAL seconds are probed with a short command before
+# reuse, to detect connections broken by node reboots or snapshot reverts.
+SSH_POOL_CHECK_INTERVAL = int(
+    os.environ.get('SSH_POOL_CHECK_INTERVAL', 30))
+# Default number of nodes to run commands on in parallel,
+# see UnderlaySSHManager.check_call_many()
+SSH_MAX_WORKERS = int(os.environ.get('SSH_MAX_WORKERS', 10))
+# Read the output of 'cmd' steps line by line while the command is running,
+# keeping only the last STREAM_OUTPUT_TAIL_LINES lines for error reports.
+# Disabled by default, can be enabled for a step with 'stream: true'.
+STREAM_COMMANDS_OUTPUT = get_var_as_bool('STREAM_COMMANDS_OUTPUT', False)
+STREAM_OUTPUT_TAIL_LINES = int(os.environ.get('STREAM_OUTPUT_TAIL_LINES',
+                                              200))
+
 # public_iface = IFACES[0]
 # private_iface = IFACES[1]
 IFACES = [
@@ -62,6 +82,35 @@ IFACES = [
 
 SALT_USER = os.environ.get('SALT_USER', 'salt')
 SALT_PASSWORD = os.environ.get('SALT_PASSWORD', 'hovno12345!')
+# Salt jobs submitted with local_async are polled every
+# SALT_ASYNC_POLL_INTERVAL seconds, minions that didn't return in
+# SALT_ASYNC_JOB_TIMEOUT seconds (if 'timeout' is not set for the step)
+# are considered as failed.
+SALT_ASYNC_POLL_INTERVAL = int(os.environ.get('SALT_ASYNC_POLL_INTERVAL', 5))
+SALT_ASYNC_JOB_TIMEOUT = int(os.environ.get('SALT_ASYNC_JOB_TIMEOUT', 3600))
+# Minions that didn't return the async job are checked with
+# saltutil.find_job every SALT_FIND_JOB_INTERVAL seconds, the minions which
+# don't run the job anymore or don't respond in SALT_FIND_JOB_TIMEOUT seconds
+# are not waited for.
+SALT_FIND_JOB_INTERVAL = int(os.environ.get('SALT_FIND_JOB_INTERVAL', 60))
+SALT_FIND_JOB_TIMEOUT = int(os.environ.get('SALT_FIND_JOB_TIMEOUT', 10))
+# Pillars and grains fetched with SaltManager are cached for
+# SALT_CACHE_TTL seconds. The cache is dropped after saltutil.refresh_pillar,
+# saltutil.refresh_grains, state runs and the shell commands which look like
+# changing them, but the changes made by other means are not noticed.
+# Disabled by default, set to a positive number to enable the cache.
+SALT_CACHE_TTL = int(os.environ.get('SALT_CACHE_TTL', 0))
+
+# Wait for k8s resources using the watch API instead of periodic reads.
+# Polling is still used as a fallback if the watch fails.
+K8S_WATCH_ENABLED = get_var_as_bool('K8S_WATCH_ENABLED', True)
+# Comma-separated names of the K8sCluster managers ('pods', 'services', ...)
+# which keep all their resources in a local cache updated with the watch API.
+K8S_INFORMERS = [name.strip() for name in
+                 os.environ.get('K8S_INFORMERS', '').split(',')
+                 if name.strip()]
+# Max number of k8s resources waited for in parallel by K8sCluster.wait_all()
+K8S_WAIT_MAX_WORKERS = int(os.environ.get('K8S_WAIT_MAX_WORKERS', 20))
 
 DOCKER_REGISTRY = os.environ.get('DOCKER_REGISTRY',
                                  'docker-prod-local.artifactory.mirantis.com')
@@ -179,7 +179,7 @@ class TestMCPK8sActions(object):
         show_step(4)
         for sample in samples:
             sample.expose('LoadBalancer')
-            sample.wait_ready()
+        k8s_deployed.wait_sample_deployments(samples)
 
         show_step(5)
         for sample in samples:
@@ -244,8 +244,8 @@ class TestMCPK8sActions(object):
         LOG.info("Calico network: {}".format(calico_network))
 
         show_step(2)
-        assert k8s_deployed.api.pods.list(
-            namespace="kube-system", name_prefix="kube-flannel-") > 0
+        assert len(k8s_deployed.api.pods.list(
+            namespace="kube-system", name_prefix="kube-flannel-")) > 0
 
         show_step(3)
         flannel_pod = k8s_deployed.api.pods.create(
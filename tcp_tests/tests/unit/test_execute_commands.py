@@ -0,0 +1,269 @@
+import mock
+import pytest
+
+from tcp_tests.managers import execute_commands
+
+
+class FakeSalt(object):
+    """Salt jobs that return after the number of polls from the args"""
+
+    def __init__(self, lost=()):
+        self.started = []
+        self.targets = []
+        self.polls = {}
+        self.lost = set(lost)  # minions which never return
+
+    def target_minions(self, tgt):
+        if tgt.startswith('L@'):
+            tgt = tgt[len('L@'):]
+        return tgt.split(',')
+
+    def run_async(self, tgt, fun, args=None, kwargs=None, timeout=None):
+        name, polls = args
+        self.started.append(name)
+        self.targets.append(tgt)
+        self.polls[name] = polls
+        return name, self.target_minions(tgt)
+
+    def get_async_result(self, jid, minions):
+        self.polls[jid] -= 1
+        if self.polls[jid] > 0:
+            return {'return': [{}]}, minions
+        returned = [m for m in minions if m not in self.lost]
+        return ({'return': [dict((m, True) for m in returned)]},
+                sorted(set(minions) - set(returned)))
+
+    def get_lost_minions(self, jid, minions):
+        r, missing = self.get_async_result(jid, minions)
+        return r, missing, set(missing)
+
+
+def parallel_step(name, target, polls=1, requires=None, **kwargs):
+    step = {
+        'description': name,
+        'do': 'runState',
+        'state': 'cmd.run',
+        'args': [name, polls],
+        'target': target,
+        'parallel': True,
+    }
+    if requires:
+        step['requires'] = requires
+    step.update(kwargs)
+    return step, name
+
+
+def run_parallel(steps, salt=None):
+    commands = execute_commands.ExecuteCommandsMixin(config=None,
+                                                     underlay=None)
+    commands._salt = salt or FakeSalt()
+    with mock.patch.multiple(execute_commands.settings,
+                             SALT_ASYNC_POLL_INTERVAL=0,
+                             SALT_FIND_JOB_INTERVAL=0):
+        commands.command2_parallel(steps)
+    return commands._salt.started
+
+
+def test_command2_parallel_keeps_order_on_the_same_minions():
+    # 'ctl-2' waits for the slow 'cmp', 'ctl-3' should not run before it
+    started = run_parallel([
+        parallel_step('ctl-1', 'ctl01'),
+        parallel_step('ctl-2', 'ctl01', requires=['cmp']),
+        parallel_step('cmp', 'cmp01', polls=2),
+        parallel_step('ctl-3', 'ctl01,ctl02'),
+        parallel_step('ctl02', 'ctl02'),
+    ])
+    assert started == ['ctl-1', 'cmp', 'ctl-2', 'ctl-3', 'ctl02']
+
+
+def test_command2_parallel_runs_required_step_first():
+    started = run_parallel([
+        parallel_step('ctl-1', 'ctl01', requires=['ctl-2']),
+        parallel_step('ctl-2', 'ctl01', requires=['ctl-3']),
+        parallel_step('ctl-3', 'ctl01'),
+        parallel_step('cmp', 'cmp01'),
+    ])
+    assert started == ['ctl-3', 'cmp', 'ctl-2', 'ctl-1']
+
+
+def test_command2_parallel_fails_on_missing_minions():
+    with pytest.raises(Exception) as e:
+        run_parallel([parallel_step('ctl', 'ctl01,ctl02',
+                                    check_missing=True)],
+                     FakeSalt(lost=['ctl02']))
+    assert "Step 'ctl' failed" in str(e.value)
+
+
+def test_command2_parallel_retries_missing_minions():
+    salt = FakeSalt(lost=['ctl02'])
+    retry = {'count': 2, 'delay': 0}
+    with pytest.raises(Exception):
+        run_parallel([parallel_step('ctl', 'ctl01,ctl02', retry=retry,
+                                    check_missing=True)], salt)
+    assert salt.targets == ['ctl01,ctl02', 'L@ctl02']
+
+
+def test_command2_parallel_ignores_missing_minions_by_default():
+    started = run_parallel([parallel_step('ctl', 'ctl01,ctl02')],
+                           FakeSalt(lost=['ctl02']))
+    assert started == ['ctl']
+
+
+def test_command2_parallel_unknown_requires():
+    with pytest.raises(ValueError):
+        run_parallel([parallel_step('ctl', 'ctl01', requires=['unknown'])])
+
+
+@pytest.mark.parametrize('all_fails,missing,expected', [
+    ([{'ctl01': ['task']}], None, 'L@ctl01'),
+    ([{'ctl02': ['task']}, {'ctl01': ['task']}], [], 'L@ctl01,ctl02'),
+    ([{'ctl01': ['task']}], ['cmp01', 'ctl01'], 'L@cmp01,ctl01'),
+    ([], ['cmp01'], 'L@cmp01'),
+])
+def test_failed_minions_target(all_fails, missing, expected):
+    target = execute_commands.ExecuteCommandsMixin.failed_minions_target(
+        all_fails, missing)
+    assert target == expected
+
+
+@pytest.mark.parametrize('expected,returns,missing', [
+    (None, [{'ctl01': True}], None),
+    (['ctl01', 'ctl02'], [{'ctl01': True, 'ctl02': True}], []),
+    (['ctl01', 'ctl02'], [{'ctl01': True}, {'ctl02': True}],
+     ['ctl01', 'ctl02']),
+    (['ctl01', 'ctl02'], ['No minions matched'], ['ctl01', 'ctl02']),
+])
+def test_missing_minions(expected, returns, missing):
+    command_ret = [({'return': [r]}, None) for r in returns]
+    assert execute_commands.ExecuteCommandsMixin.missing_minions(
+        expected, command_ret) == missing
+
+
+def run_sync(target_minions, returns, check_missing=True):
+    """Run the sync step with two tries, return the targets of the tries"""
+    salt = mock.Mock()
+    salt._map = {'runState': 'run_state'}
+    salt.target_minions.side_effect = target_minions
+    salt.run_state.side_effect = [({'return': [r]}, f) for r, f in returns]
+    commands = execute_commands.ExecuteCommandsMixin(config=None,
+                                                     underlay=None)
+    commands._salt = salt
+    step = {
+        'do': 'runState',
+        'state': 'cmd.run',
+        'target': 'ctl*',
+        'retry': {'count': 2, 'delay': 0},
+        'check_missing': check_missing,
+    }
+    with mock.patch.object(execute_commands.time, 'sleep'):
+        commands.command2(step, 'msg')
+    assert salt.target_minions.called == check_missing
+    return [c[1]['tgt'] for c in salt.run_state.call_args_list]
+
+
+def test_command2_retries_minions_which_did_not_return():
+    targets = run_sync([['ctl01', 'ctl02'], ['ctl02']],
+                       [({'ctl01': True}, None), ({'ctl02': True}, None)])
+    assert targets == ['ctl*', 'L@ctl02']
+
+
+def test_command2_ignores_missing_minions_by_default():
+    targets = run_sync(None, [({'ctl01': True}, None)], check_missing=False)
+    assert targets == ['ctl*']
+
+
+def test_command2_retries_only_failed_minions_by_default():
+    targets = run_sync(None, [({'ctl01': False, 'ctl02': True},
+                               {'ctl01': ['task']}),
+                              ({'ctl01': True}, None)],
+                       check_missing=False)
+    assert targets == ['ctl*', 'L@ctl01']
+
+
+def test_command2_retries_whole_target_if_minions_are_unknown():
+    targets = run_sync(Exception('salt-api is not available'),
+                       [({'ctl01': False}, {'ctl01': ['task']}),
+                        ({'ctl01': True}, None)])
+    assert targets == ['ctl*', 'ctl*']
+
+
+@pytest.mark.parametrize('line,failed', [
+    ('Failed:    2', 2),
+    ('Succeeded: 10', 0),
+    ('ctl01:\n    Minion did not return. [No response]', 1),
+    ('[CRITICAL] Unable to connect', 1),
+    ('Fatal error', 1),
+    ('', 0),
+])
+def test_count_failures(line, failed):
+    assert execute_commands.count_failures(line) == failed
+
+
+class FakeChannel(object):
+    """Channel returning the chunks of output after the exit status"""
+
+    def __init__(self, stdout, stderr=None, exit_code=0):
+        self.stdout = list(stdout)
+        self.stderr = list(stderr or [])
+        self.exit_code = exit_code
+        self.closed = False
+
+    def recv_ready(self):
+        # The output is received only in the drain after the exit
+        return False
+
+    def recv_stderr_ready(self):
+        return False
+
+    def exit_status_ready(self):
+        return True
+
+    def recv(self, size):
+        return self.stdout.pop(0) if self.stdout else ''
+
+    def recv_stderr(self, size):
+        return self.stderr.pop(0) if self.stderr else ''
+
+    def recv_exit_status(self):
+        return self.exit_code
+
+    def close(self):
+        self.closed = True
+
+
+def make_remote(chan):
+    remote = mock.Mock()
+    remote.execute_async.return_value = chan, None, None, None
+    remote.execute.return_value = {'exit_code': 0, 'stderr_str': ''}
+    return remote
+
+
+def test_execute_stream_reads_output_after_exit():
+    chan = FakeChannel(
+        [execute_commands.STREAM_PID_MARKER + '42\nSucceeded: 3\nFai',
+         'led:    1\n'],
+        stderr=['warning'], exit_code=0)
+
+    result = execute_commands.execute_stream(make_remote(chan), 'salt')
+
+    assert result.exit_code == 0
+    assert result.failed == 1
+    assert result.pid == '42'
+    assert list(result.stdout_tail) == ['Succeeded: 3', 'Failed:    1']
+    assert list(result.stderr_tail) == ['warning']
+    assert chan.closed
+
+
+def test_execute_stream_kills_aborted_command():
+    chan = FakeChannel([execute_commands.STREAM_PID_MARKER + '42\n'
+                        'Minion did not return. [Not connected]\n'
+                        'Succeeded: 3\n'])
+    chan.recv_ready = lambda: bool(chan.stdout)
+    remote = make_remote(chan)
+
+    result = execute_commands.execute_stream(
+        remote, 'salt', abort_on=['Not connected'])
+
+    assert result.exit_code == -1
+    assert result.aborted_on == 'Minion did not return. [Not connected]'
+    remote.execute.assert_called_once_with('kill -TERM -- -42')
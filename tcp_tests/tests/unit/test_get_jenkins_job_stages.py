@@ -0,0 +1,49 @@
+import threading
+
+import mock
+
+from tcp_tests.utils import get_jenkins_job_stages
+
+
+def semaphore(fetcher):
+    return fetcher._WorkflowFetcher__semaphore
+
+
+def test_fetchers_share_semaphore_per_host_and_limit():
+    fetcher = get_jenkins_job_stages.WorkflowFetcher
+    first = fetcher(mock.Mock(), 'http://share', 'job', 1, max_workers=2)
+    second = fetcher(mock.Mock(), 'http://share', 'job', 2, max_workers=2)
+    other_host = fetcher(mock.Mock(), 'http://other', 'job', 1,
+                         max_workers=2)
+
+    assert semaphore(first) is semaphore(second)
+    assert semaphore(first) is not semaphore(other_host)
+
+
+def test_fetch_many_honours_own_limit_on_shared_host():
+    lock = threading.Lock()
+    active = [0]
+    peak = [0]
+    barrier = threading.Event()
+
+    def get_workflow(job_name, build_number, enode, mode):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+            if active[0] == 4:
+                barrier.set()
+        barrier.wait(1)
+        with lock:
+            active[0] -= 1
+        return {'id': enode}
+
+    jenkins = mock.Mock(get_workflow=get_workflow)
+    fetcher = get_jenkins_job_stages.WorkflowFetcher
+    # The first fetcher for the host must not cap the later ones
+    fetcher(jenkins, 'http://limits', 'job', 1, max_workers=1)
+    wide = fetcher(jenkins, 'http://limits', 'job', 1, max_workers=4)
+
+    wide.fetch_many([(str(n), 'describe') for n in range(4)])
+
+    assert peak[0] == 4
+    assert wide.get('3') == {'id': '3'}
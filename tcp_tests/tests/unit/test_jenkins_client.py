@@ -0,0 +1,216 @@
+import itertools
+
+from devops import error
+import mock
+import pytest
+from requests.exceptions import ConnectionError
+
+from tcp_tests.managers.jenkins import client
+
+
+def test_polling_intervals_grow_up_to_max():
+    polling = client.PollingStrategy(first_interval=1, factor=2,
+                                     max_interval=5, jitter=0)
+    intervals = list(itertools.islice(polling.intervals(), 6))
+    assert intervals == [1, 2, 4, 5, 5, 5]
+
+
+def test_polling_intervals_jitter():
+    polling = client.PollingStrategy(first_interval=10, factor=1,
+                                     max_interval=10, jitter=0.1)
+    for interval in itertools.islice(polling.intervals(), 100):
+        assert 9 <= interval <= 11
+
+
+# Only the time module used by the client is replaced, the threads
+# of the other libraries may sleep at the same time
+@mock.patch('tcp_tests.managers.jenkins.client.time')
+def test_polling_wait_returns_predicate_result(time_mock):
+    time_mock.time.return_value = 0
+    polling = client.PollingStrategy(first_interval=1, factor=2, jitter=0)
+    predicate = mock.Mock(side_effect=[None, False, 'done'])
+
+    assert polling.wait(predicate, timeout=600) == 'done'
+    assert [c[0][0] for c in time_mock.sleep.call_args_list] == [1, 2]
+
+
+@mock.patch('tcp_tests.managers.jenkins.client.time')
+def test_polling_wait_timeout(time_mock):
+    time_mock.time.side_effect = [0, 1, 8, 11]
+    polling = client.PollingStrategy(first_interval=5, factor=1, jitter=0)
+
+    with pytest.raises(error.TimeoutError):
+        polling.wait(lambda: False, timeout=10, timeout_msg='msg')
+    # The last sleep doesn't exceed the timeout
+    assert [c[0][0] for c in time_mock.sleep.call_args_list] == [5, 2]
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for chunk in self.content:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def close(self):
+        pass
+
+
+def download(tmpdir, responses, build_id=7):
+    jenkins = client.JenkinsClient(host='http://jenkins')
+    jenkins.job_info = mock.Mock(return_value={'lastBuild': {'number': 7}})
+    send_request = mock.Mock(side_effect=responses)
+    jenkins._JenkinsClient__send_request = send_request
+    destination = str(tmpdir.join('artifact'))
+    with mock.patch('tcp_tests.managers.jenkins.client.time.sleep'):
+        size = jenkins.download_artifact('job', build_id, 'artifact.txt',
+                                         destination)
+    with open(destination) as f:
+        content = f.read()
+    return size, content, [c[1]['headers'] for c in
+                           send_request.call_args_list]
+
+
+def test_download_artifact_resumes_with_if_range(tmpdir):
+    size, content, headers = download(tmpdir, [
+        FakeResponse(200, [b'abc', ConnectionError()], {'ETag': '"v1"'}),
+        FakeResponse(206, [b'def']),
+    ], build_id='lastBuild')
+
+    assert (size, content) == (6, 'abcdef')
+    assert headers == [{}, {'Range': 'bytes=3-', 'If-Range': '"v1"'}]
+    assert tmpdir.listdir() == [tmpdir.join('artifact')]
+
+
+def test_download_artifact_starts_over_on_full_response(tmpdir):
+    tmpdir.join('artifact.7.part').write('old')
+    size, content, headers = download(tmpdir, [
+        FakeResponse(200, [b'new content']),
+    ])
+
+    assert (size, content) == (11, 'new content')
+    assert headers == [{'Range': 'bytes=3-'}]
+
+
+def make_metadata_client(username, response):
+    jenkins = client.JenkinsClient(host='http://jenkins', username=username)
+    jenkins._JenkinsClient__send_request = send_request = mock.Mock()
+    send_request.return_value.status_code = 200
+    send_request.return_value.headers = {}
+    send_request.return_value.json.return_value = response
+    return jenkins, send_request
+
+
+def test_metadata_cache_is_shared_by_clients():
+    client.JenkinsClient._JenkinsClient__metadata.clear()
+    jobs = {'jobs': [{'name': 'deploy', 'url': 'u', 'color': 'blue'}]}
+    jenkins1, send_request1 = make_metadata_client('admin', jobs)
+    jenkins2, send_request2 = make_metadata_client('admin', jobs)
+    jenkins3, send_request3 = make_metadata_client('other', jobs)
+
+    for jenkins in (jenkins1, jenkins2, jenkins3):
+        assert [job['fullname'] for job in jenkins.jobs()] == ['deploy']
+
+    assert send_request1.call_count == 1
+    assert send_request2.call_count == 0
+    assert send_request3.call_count == 1
+
+    jenkins2.invalidate_metadata()
+    jenkins1.jobs()
+    assert send_request1.call_count == 2
+
+
+def test_metadata_revalidated_with_etag():
+    client.JenkinsClient._JenkinsClient__metadata.clear()
+    jobs = {'jobs': [{'name': 'deploy', 'url': 'u', 'color': 'blue'}]}
+    jenkins, send_request = make_metadata_client('admin', jobs)
+    send_request.return_value.headers = {'ETag': '"v1"'}
+    jenkins.metadata_ttl = 0
+    jenkins.jobs()
+    old_entry = list(client.JenkinsClient._JenkinsClient__metadata.values())
+
+    send_request.return_value.status_code = 304
+    send_request.return_value.json.side_effect = AssertionError
+    with mock.patch('tcp_tests.managers.jenkins.client.time') as time_mock:
+        time_mock.time.return_value = old_entry[0]['expires'] + 1
+        assert [job['fullname'] for job in jenkins.jobs()] == ['deploy']
+
+    assert send_request.call_args[1]['headers'] == {'If-None-Match': '"v1"'}
+    entry, = client.JenkinsClient._JenkinsClient__metadata.values()
+    assert entry['expires'] == old_entry[0]['expires'] + 1
+    assert entry is not old_entry[0]
+
+
+def test_polling_jitter_bounds_while_growing():
+    polling = client.PollingStrategy(first_interval=2, factor=2,
+                                     max_interval=16, jitter=0.25)
+    expected = [2, 4, 8, 16, 16, 16]
+    for _ in range(20):
+        intervals = itertools.islice(polling.intervals(), len(expected))
+        for interval, base in zip(intervals, expected):
+            assert base * 0.75 <= interval <= base * 1.25
+
+
+def test_polling_max_interval_not_less_than_first():
+    polling = client.PollingStrategy(first_interval=10, max_interval=5,
+                                     jitter=0)
+    assert list(itertools.islice(polling.intervals(), 3)) == [10, 10, 10]
+
+
+def console_response(text_size, more_data):
+    response = mock.Mock(content=b'line\n')
+    response.headers = {'X-Text-Size': str(text_size)}
+    if more_data:
+        response.headers['X-More-Data'] = 'true'
+    return response
+
+
+@mock.patch('tcp_tests.managers.jenkins.client.time')
+def test_wait_end_of_build_console_driven(time_mock):
+    time_mock.time.return_value = 0
+    jenkins = client.JenkinsClient(host='http://jenkins')
+    jenkins.get_progressive_build_output = mock.Mock(side_effect=[
+        console_response(10, True),
+        console_response(20, True),
+        console_response(30, False),
+    ])
+    jenkins.build_info = mock.Mock(return_value={'building': False,
+                                                 'result': 'SUCCESS'})
+
+    info = jenkins.wait_end_of_build('deploy', 5, timeout=600,
+                                     console_driven=True)
+
+    assert info['result'] == 'SUCCESS'
+    # The build info is requested only after the log is closed
+    jenkins.build_info.assert_called_once_with('deploy', 5)
+    assert [c[1]['start'] for c in
+            jenkins.get_progressive_build_output.call_args_list] == [
+        0, 10, 20]
+
+
+@mock.patch('tcp_tests.managers.jenkins.client.time')
+def test_wait_end_of_build_console_closed_before_build_completed(time_mock):
+    time_mock.time.return_value = 0
+    jenkins = client.JenkinsClient(host='http://jenkins')
+    jenkins.get_progressive_build_output = mock.Mock(
+        return_value=console_response(10, False))
+    jenkins.build_info = mock.Mock(side_effect=[
+        {'building': True, 'result': None},
+        {'building': False, 'result': 'FAILURE'},
+    ])
+
+    info = jenkins.wait_end_of_build('deploy', 5, timeout=600,
+                                     console_driven=True)
+
+    assert info['result'] == 'FAILURE'
+    assert jenkins.get_progressive_build_output.call_count == 1
+    assert jenkins.build_info.call_count == 2
@@ -0,0 +1,308 @@
+import base64
+import io
+import json
+import tarfile
+
+from devops import error
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+import mock
+import pytest
+
+from tcp_tests.managers.k8s import cluster
+from tcp_tests.managers.k8s import daemonsets
+
+
+def make_cluster():
+    return cluster.K8sCluster(user='admin', password='secret',
+                              host='k8s.local',
+                              ca=base64.b64encode(b'ca').decode())
+
+
+def make_pods(k8s, *names):
+    pods = [k8s.pods.get(name=name, namespace='default') for name in names]
+    for pod in pods:
+        pod.wait = mock.Mock(return_value=pod)
+    return pods
+
+
+def test_wait_all_uses_default_condition():
+    k8s = make_cluster()
+    pods = make_pods(k8s, 'pod1', 'pod2')
+
+    assert k8s.wait_all(pods, timeout=10) == pods
+    for pod in pods:
+        assert pod.wait.call_args[0][0] == pod._is_ready
+
+
+def test_wait_all_requires_condition():
+    k8s = make_cluster()
+    namespace = k8s.namespaces.get(name='default')
+    namespace.wait = mock.Mock()
+
+    with pytest.raises(ValueError):
+        k8s.wait_all(make_pods(k8s, 'pod1') + [namespace], timeout=10)
+    assert not namespace.wait.called
+
+    condition = mock.Mock(return_value=True)
+    k8s.wait_all([namespace], condition=condition, timeout=10)
+    assert namespace.wait.call_args[0][0] is condition
+
+
+def test_wait_all_timeout():
+    k8s = make_cluster()
+    pods = make_pods(k8s, 'pod1', 'pod2')
+    pods[1].wait.side_effect = error.TimeoutError('pod2 is not ready')
+
+    with pytest.raises(error.TimeoutError) as e:
+        k8s.wait_all(pods, timeout=10)
+    assert '1 of 2 resources' in str(e.value)
+    assert 'pod2 is not ready' in str(e.value)
+
+
+def test_wait_all_raises_other_errors():
+    k8s = make_cluster()
+    pods = make_pods(k8s, 'pod1', 'pod2')
+    pods[0].wait.side_effect = error.TimeoutError('pod1 is not ready')
+    pods[1].wait.side_effect = ApiException(status=403, reason='Forbidden')
+
+    with pytest.raises(ApiException):
+        k8s.wait_all(pods, timeout=10)
+
+
+@pytest.mark.parametrize('generation,status,ready', [
+    # Just created, the controller has not counted the pods yet
+    (1, {'desired_number_scheduled': 0, 'number_ready': 0}, False),
+    (1, {'observed_generation': 1, 'desired_number_scheduled': 2,
+         'updated_number_scheduled': 2, 'number_ready': 1}, False),
+    (1, {'observed_generation': 1, 'desired_number_scheduled': 2,
+         'updated_number_scheduled': 2, 'number_ready': 2}, True),
+    # Updated, the old pods are still ready
+    (2, {'observed_generation': 1, 'desired_number_scheduled': 2,
+         'updated_number_scheduled': 2, 'number_ready': 2}, False),
+    (2, {'observed_generation': 2, 'desired_number_scheduled': 2,
+         'updated_number_scheduled': 1, 'number_ready': 2}, False),
+    # No nodes match the node selector
+    (1, {'observed_generation': 1, 'desired_number_scheduled': 0,
+         'number_ready': 0}, True),
+])
+def test_daemonset_is_ready(generation, status, ready):
+    ds = client.V1DaemonSet(
+        metadata=client.V1ObjectMeta(generation=generation),
+        status=client.V1DaemonSetStatus(
+            current_number_scheduled=0, number_misscheduled=0, **status))
+    assert daemonsets.K8sDaemonSet._is_ready(ds) is ready
+
+
+def make_pod_list(names, next_page=None):
+    return client.V1PodList(
+        items=[client.V1Pod(metadata=client.V1ObjectMeta(
+            namespace='default', name=name)) for name in names],
+        metadata=client.V1ListMeta(_continue=next_page))
+
+
+def test_list_pages_and_selectors():
+    k8s = make_cluster()
+    k8s.pods._list = mock.Mock(side_effect=[
+        make_pod_list(['web-1', 'db-1'], next_page='page2'),
+        make_pod_list(['web-2']),
+    ])
+
+    pods = k8s.pods.list(name_prefix='web', label_selector='app=web',
+                         field_selector='status.phase=Running', limit=2)
+
+    assert [pod.name for pod in pods] == ['web-1', 'web-2']
+    selectors = {'label_selector': 'app=web',
+                 'field_selector': 'status.phase=Running'}
+    assert k8s.pods._list.call_args_list == [
+        mock.call(namespace='default', limit=2, **selectors),
+        mock.call(namespace='default', limit=2, _continue='page2',
+                  **selectors),
+    ]
+
+
+def test_iter_list_is_lazy():
+    k8s = make_cluster()
+    k8s.pods._list_all = mock.Mock(side_effect=[
+        make_pod_list(['pod-1'], next_page='page2'),
+        make_pod_list(['pod-2']),
+    ])
+
+    pods = k8s.pods.iter_list_all(limit=1)
+    assert next(pods).name == 'pod-1'
+    assert k8s.pods._list_all.call_count == 1
+    assert [pod.name for pod in pods] == ['pod-2']
+
+
+def test_list_without_limit_gets_one_page():
+    k8s = make_cluster()
+    k8s.pods._list = mock.Mock(return_value=make_pod_list(
+        ['pod-1'], next_page='ignored'))
+
+    assert [pod.name for pod in k8s.pods.list(limit=0)] == ['pod-1']
+    k8s.pods._list.assert_called_once_with(namespace='default')
+
+
+def test_list_starts_again_on_expired_continue_token():
+    k8s = make_cluster()
+    k8s.pods._list = mock.Mock(side_effect=[
+        make_pod_list(['pod-1', 'pod-2'], next_page='expired'),
+        ApiException(status=410, reason='Gone'),
+        make_pod_list(['pod-1', 'pod-2'], next_page='page2'),
+        make_pod_list(['pod-3']),
+    ])
+
+    pods = k8s.pods.list(limit=2)
+
+    assert [pod.name for pod in pods] == ['pod-1', 'pod-2', 'pod-3']
+    assert [c[1].get('_continue') for c in k8s.pods._list.call_args_list] == [
+        None, 'expired', None, 'page2']
+
+
+def test_list_gives_up_on_expired_continue_token():
+    k8s = make_cluster()
+    k8s.pods.list_restarts = 1
+    k8s.pods._list = mock.Mock(side_effect=[
+        make_pod_list(['pod-1'], next_page='expired'),
+        ApiException(status=410, reason='Gone'),
+        make_pod_list(['pod-1'], next_page='expired'),
+        ApiException(status=410, reason='Gone'),
+    ])
+
+    with pytest.raises(ApiException):
+        k8s.pods.list(limit=1)
+    assert k8s.pods._list.call_count == 4
+
+
+class FakeExecStream(object):
+    def __init__(self, stdout_chunks, stderr='', status=None):
+        self.chunks = list(stdout_chunks)
+        self.stdout = ''
+        self.stderr = stderr
+        self.status = status or {'status': 'Success'}
+        self.closed = False
+
+    def is_open(self):
+        return bool(self.chunks)
+
+    def update(self, timeout=0):
+        self.stdout += self.chunks.pop(0)
+
+    def peek_stdout(self):
+        return bool(self.stdout)
+
+    def read_stdout(self):
+        data, self.stdout = self.stdout, ''
+        return data
+
+    def peek_stderr(self):
+        return False
+
+    def read_stderr(self):
+        data, self.stderr = self.stderr, ''
+        return data
+
+    def read_channel(self, channel):
+        return json.dumps(self.status)
+
+    def close(self):
+        self.closed = True
+
+
+def exit_status(code):
+    return {'status': 'Failure', 'details': {
+        'causes': [{'reason': 'ExitCode', 'message': str(code)}]}}
+
+
+@mock.patch('tcp_tests.managers.k8s.cluster.stream')
+def test_execute_runs_command_without_shell(stream):
+    k8s = make_cluster()
+    stream.return_value = resp = FakeExecStream(['line1\nli', 'ne2\n'])
+
+    result = k8s.execute('default', 'pod1', 'echo "a b" c',
+                         container='main')
+
+    assert stream.call_args[1]['command'] == ['echo', 'a b', 'c']
+    assert stream.call_args[1]['container'] == 'main'
+    assert result['stdout'] == ('line1\n', 'line2\n')
+    assert result['exit_code'] == 0
+    assert resp.closed
+
+
+@mock.patch('tcp_tests.managers.k8s.cluster.stream')
+def test_execute_exit_code(stream):
+    k8s = make_cluster()
+    stream.return_value = FakeExecStream(
+        [], stderr='not found\n', status=exit_status(2))
+
+    with pytest.raises(error.DevopsCalledProcessError):
+        k8s.execute('default', 'pod1', ['ls', '/missing'])
+
+    stream.return_value = FakeExecStream(
+        [], stderr='not found\n', status=exit_status(2))
+    result = k8s.execute('default', 'pod1', ['ls', '/missing'],
+                         expected=[0, 2])
+    assert result['exit_code'] == 2
+    assert result['stderr'] == ('not found\n',)
+
+
+def make_tar(members):
+    data = io.BytesIO()
+    tar = tarfile.open(fileobj=data, mode='w')
+    for name, content in members:
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+    tar.close()
+    return data.getvalue()
+
+
+def encoded_chunks(data, size=100):
+    encoded = base64.b64encode(data).decode()
+    # base64 utility wraps the lines at 76 characters
+    encoded = '\n'.join(encoded[i:i + 76]
+                        for i in range(0, len(encoded), 76))
+    return [encoded[i:i + size] for i in range(0, len(encoded), size)]
+
+
+@mock.patch('tcp_tests.managers.k8s.cluster.stream')
+def test_copy_from_pod(stream, tmpdir):
+    k8s = make_cluster()
+    stream.return_value = FakeExecStream(encoded_chunks(make_tar([
+        ('./report.xml', b'<xml/>'), ('./logs/run.log', b'ok\n')])))
+    dest = tmpdir.join('out')
+
+    names = k8s.copy_from_pod('default', 'pod1', '/root/report/', str(dest))
+
+    assert names == ['./report.xml', './logs/run.log']
+    assert dest.join('report.xml').read() == '<xml/>'
+    assert dest.join('logs', 'run.log').read() == 'ok\n'
+    command = stream.call_args[1]['command']
+    assert command[:2] == ['/bin/sh', '-c']
+    assert 'tar cf - -C /root report' in command[2]
+
+
+@pytest.mark.parametrize('name', ['/etc/passwd', '../escape', 'a/../../b'])
+@mock.patch('tcp_tests.managers.k8s.cluster.stream')
+def test_copy_from_pod_rejects_unsafe_paths(stream, name, tmpdir):
+    k8s = make_cluster()
+    stream.return_value = FakeExecStream(encoded_chunks(make_tar([
+        ('safe', b'1'), (name, b'2')])))
+
+    with pytest.raises(ValueError):
+        k8s.copy_from_pod('default', 'pod1', '/root', str(tmpdir))
+    assert tmpdir.listdir() == []
+
+
+@mock.patch('tcp_tests.managers.k8s.cluster.stream')
+def test_copy_from_pod_nothing_copied(stream, tmpdir):
+    k8s = make_cluster()
+    stream.return_value = FakeExecStream(
+        [], stderr='tar: /missing: No such file\n', status=exit_status(2))
+
+    with pytest.raises(error.DevopsCalledProcessError):
+        k8s.copy_from_pod('default', 'pod1', '/missing', str(tmpdir))
+
+    stream.return_value = FakeExecStream([], status=exit_status(2))
+    assert k8s.copy_from_pod('default', 'pod1', '/missing', str(tmpdir),
+                             raise_on_err=False) == []
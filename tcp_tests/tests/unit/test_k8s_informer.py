@@ -0,0 +1,145 @@
+import base64
+
+from kubernetes.client import models
+import mock
+
+from tcp_tests.managers.k8s import cluster
+from tcp_tests.managers.k8s import informer
+
+
+def make_pod(namespace, name, labels=None, node_name=None, version='1'):
+    return models.V1Pod(
+        metadata=models.V1ObjectMeta(namespace=namespace, name=name,
+                                     labels=labels,
+                                     resource_version=version),
+        spec=models.V1PodSpec(containers=[], node_name=node_name))
+
+
+def make_informer(pods):
+    manager = mock.Mock(resource_type='pod')
+    manager._list_all.return_value = models.V1PodList(
+        items=pods, metadata=models.V1ListMeta(resource_version='1'))
+    pod_informer = informer.K8sInformer(manager)
+    pod_informer._K8sInformer__relist()
+    return pod_informer
+
+
+def names(items):
+    return [(item.metadata.namespace, item.metadata.name) for item in items]
+
+
+def resource_names(resources):
+    return [(resource.namespace, resource.name) for resource in resources]
+
+
+pods = [
+    make_pod('kube-system', 'coredns-1', {'app': 'coredns'}, 'ctl01'),
+    make_pod('kube-system', 'coredns-2', {'app': 'coredns'}, 'ctl02'),
+    make_pod('kube-system', 'calico-1', {'app': 'calico'}, 'ctl01'),
+    make_pod('default', 'coredns-test', {'app': 'test'}, 'cmp01'),
+    make_pod('kube-public', 'web'),
+]
+
+
+def test_informer_list_data():
+    pod_informer = make_informer(pods)
+
+    assert names(pod_informer.list_data()) == [
+        ('default', 'coredns-test'),
+        ('kube-public', 'web'),
+        ('kube-system', 'calico-1'),
+        ('kube-system', 'coredns-1'),
+        ('kube-system', 'coredns-2'),
+    ]
+    assert names(pod_informer.list_data(namespace='kube-system',
+                                        name_prefix='coredns')) == [
+        ('kube-system', 'coredns-1'), ('kube-system', 'coredns-2')]
+    assert names(pod_informer.list_data(name_prefix='coredns')) == [
+        ('default', 'coredns-test'),
+        ('kube-system', 'coredns-1'),
+        ('kube-system', 'coredns-2'),
+    ]
+    assert names(pod_informer.list_data(namespace='kube')) == []
+    assert names(pod_informer.list_data(labels={'app': 'coredns'},
+                                        node_name='ctl01')) == [
+        ('kube-system', 'coredns-1')]
+    assert names(pod_informer.list_data(labels={'app': 'unknown'})) == []
+
+
+def test_informer_applies_events():
+    pod_informer = make_informer(pods)
+    apply_event = pod_informer._K8sInformer__apply
+
+    apply_event({'type': 'DELETED', 'object': pods[0]})
+    apply_event({'type': 'MODIFIED', 'object': make_pod(
+        'kube-system', 'coredns-2', {'app': 'dns'}, 'ctl03', version='5')})
+    apply_event({'type': 'ADDED', 'object': make_pod(
+        'kube-system', 'coredns-3', {'app': 'coredns'}, 'ctl01')})
+
+    assert names(pod_informer.list_data(labels={'app': 'coredns'})) == [
+        ('kube-system', 'coredns-3')]
+    assert names(pod_informer.list_data(node_name='ctl03')) == [
+        ('kube-system', 'coredns-2')]
+    assert names(pod_informer.list_data(namespace='kube-system')) == [
+        ('kube-system', 'calico-1'),
+        ('kube-system', 'coredns-2'),
+        ('kube-system', 'coredns-3'),
+    ]
+
+
+def make_cluster_with_informer(manager_name, items):
+    k8s = cluster.K8sCluster(user='admin', password='secret',
+                             host='k8s.local',
+                             ca=base64.b64encode(b'ca').decode())
+    manager = getattr(k8s, manager_name)
+    item_list = getattr(models, type(items[0]).__name__ + 'List')
+    manager._list_all = mock.Mock(return_value=item_list(
+        items=items, metadata=models.V1ListMeta(resource_version='1')))
+    manager._list = mock.Mock()
+    cache = informer.K8sInformer(manager)
+    cache._K8sInformer__relist()
+    k8s.get_informer = mock.Mock(return_value=cache)
+    return k8s, manager
+
+
+def test_informer_lists_cluster_scoped_resources():
+    nodes = [models.V1Node(metadata=models.V1ObjectMeta(name=name))
+             for name in ('cmp01', 'ctl01')]
+    k8s, manager = make_cluster_with_informer('nodes', nodes)
+
+    assert [node.name for node in manager.list()] == ['cmp01', 'ctl01']
+    assert [node.name for node in manager.list(name_prefix='ctl')] == [
+        'ctl01']
+    assert not manager._list.called
+
+
+def test_informer_serves_equality_selectors():
+    k8s, manager = make_cluster_with_informer('pods', pods)
+
+    found = manager.list(namespace='kube-system',
+                         label_selector='app=coredns',
+                         field_selector='spec.nodeName=ctl02')
+    assert resource_names(found) == [('kube-system', 'coredns-2')]
+    found = manager.list_all(label_selector='app == coredns')
+    assert resource_names(found) == [
+        ('kube-system', 'coredns-1'), ('kube-system', 'coredns-2')]
+    assert not manager._list.called
+    assert manager._list_all.call_count == 1
+
+
+def test_informer_skipped_for_other_selectors():
+    k8s, manager = make_cluster_with_informer('pods', pods)
+    manager._list.return_value = models.V1PodList(
+        items=pods[:1], metadata=models.V1ListMeta())
+
+    for label_selector, field_selector in [
+            ('app!=coredns', None),
+            ('app in (coredns)', None),
+            ('app', None),
+            (None, 'status.phase=Running'),
+            (None, 'spec.nodeName='),
+    ]:
+        assert resource_names(manager.list(
+            namespace='kube-system', label_selector=label_selector,
+            field_selector=field_selector)) == [('kube-system', 'coredns-1')]
+    assert manager._list.call_count == 5
@@ -0,0 +1,86 @@
+import mock
+
+from tcp_tests.managers import k8smanager
+
+
+IP_A = [
+    '1: lo: <LOOPBACK,UP,LOWER_UP> mtu 65536 qdisc noqueue\n',
+    '    inet 127.0.0.1/8 scope host lo\n',
+    '    inet6 ::1/128 scope host\n',
+    '3: eth0@if4: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500\n',
+    '    inet 10.233.64.5/32 scope global eth0\n',
+    '5: net1@if6: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500\n',
+    '    inet 10.244.0.7/24 brd 10.244.0.255 scope global net1\n',
+]
+
+
+def make_manager():
+    manager = k8smanager.K8SManager(config=mock.Mock(), underlay=mock.Mock(),
+                                    salt=mock.Mock())
+    manager._api = mock.Mock()
+    manager.controller_check_call = mock.Mock()
+    return manager
+
+
+def test_get_pod_ips_from_container():
+    manager = make_manager()
+    manager.api.execute.return_value = {'stdout': IP_A}
+
+    assert manager.get_pod_ips_from_container('pod1') == [
+        '10.233.64.5', '10.244.0.7']
+    assert manager.get_pod_ips_from_container(
+        'pod1', exclude_local=False, namespace='kube-system') == [
+        '127.0.0.1', '10.233.64.5', '10.244.0.7']
+    manager.api.execute.assert_called_with('kube-system', 'pod1',
+                                           ['ip', 'a'])
+    assert not manager.controller_check_call.called
+
+
+def test_kubectl_execute_over_api():
+    manager = make_manager()
+    pod = mock.Mock(namespace='kube-system', name='virtlet-1')
+    pod.name = 'virtlet-1'
+
+    result = manager.kubectl.execute(pod, 'virsh list --uuid --name',
+                                     container='libvirt')
+
+    assert result is manager.api.execute.return_value
+    manager.api.execute.assert_called_once_with(
+        'kube-system', 'virtlet-1', 'virsh list --uuid --name',
+        container='libvirt')
+    assert not manager.controller_check_call.called
+
+
+def test_kubectl_execute_pipeline_on_controller():
+    manager = make_manager()
+    pod = mock.Mock(namespace='default')
+    pod.name = 'pod1'
+
+    result = manager.kubectl.execute(pod, 'ip a | grep inet')
+
+    assert result is manager.controller_check_call.return_value
+    manager.controller_check_call.assert_called_once_with(
+        'kubectl -n default exec --container= pod1 -- ip a | grep inet')
+    assert not manager.api.execute.called
+
+
+def test_kubectl_wrappers_use_api():
+    manager = make_manager()
+    resource = mock.Mock()
+
+    assert manager.kubectl.run('default', 'web', 'nginx', 80,
+                               replicas=2) is manager.api.run.return_value
+    manager.api.run.assert_called_once_with('default', 'web', 'nginx', 80,
+                                            replicas=2)
+
+    assert manager.kubectl.expose(
+        resource, service_name='web-s1', port=80,
+        service_type='NodePort') is manager.api.expose.return_value
+    manager.api.expose.assert_called_once_with(
+        resource, service_name='web-s1', port=80, service_type='NodePort')
+
+    assert manager.kubectl.annotate(
+        resource, 'a=1', overwrite=True) is manager.api.annotate.return_value
+    manager.api.annotate.assert_called_once_with(resource, 'a=1',
+                                                 overwrite=True)
+    assert not manager.controller_check_call.called
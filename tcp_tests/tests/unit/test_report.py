@@ -0,0 +1,208 @@
+import mock
+
+from tcp_tests import report
+
+
+def make_result(test_id, status_id, defects=None):
+    result = mock.Mock()
+    result.raw_data.return_value = {'test_id': test_id,
+                                    'status_id': status_id,
+                                    'defects': defects}
+    return result
+
+
+@mock.patch('tcp_tests.report.time')
+def test_rate_limiter_spreads_calls(time_mock):
+    # Only the time module used by report is replaced, the threads
+    # of the other libraries may sleep at the same time
+    time_mock.time.return_value = 100
+    limiter = report.RateLimiter(rate=60)
+    func = mock.Mock(return_value='result')
+
+    assert [limiter(func, i) for i in range(3)] == ['result'] * 3
+    assert [c[0][0] for c in time_mock.sleep.call_args_list] == [1, 2]
+    assert func.call_args_list == [mock.call(0), mock.call(1), mock.call(2)]
+
+
+@mock.patch('tcp_tests.report.time')
+def test_rate_limiter_disabled(time_mock):
+    time_mock.time.return_value = 100
+    limiter = report.RateLimiter(rate=0)
+    for i in range(3):
+        limiter(mock.Mock())
+    assert not time_mock.sleep.called
+
+
+@mock.patch('tcp_tests.report.fetch_test')
+def test_fetch_run_results_fetches_tests_of_filtered_results(fetch_test):
+    fetch_test.side_effect = lambda api, test_id, run_id: 'test%s' % test_id
+    results = [make_result(1, 5), make_result(2, 1), make_result(3, 5, 'B-1')]
+    t_client = mock.Mock()
+    t_client.results.return_value = results
+    run = mock.Mock(id=10)
+
+    fetched = report.fetch_run_results(
+        t_client, run, report.failed_results_filter('5'))
+
+    assert fetched == [(results[0], 'test1')]
+    assert fetch_test.call_count == 1
+
+    fetched = report.fetch_run_results(t_client, run, report.has_defects)
+    assert fetched == [(results[2], 'test3')]
+
+
+def test_disk_cache(tmpdir):
+    cache = report.DiskCache(str(tmpdir.join('cache')),
+                             ttl={'defect': 100})
+
+    assert cache.get('defect', 'PROD-1') is None
+    cache.set('defect', 'PROD-1', {'status': 'Open'})
+    cache.set('run_tests', 1, [{'id': 1}])
+    assert cache.get('defect', 'PROD-1') == {'status': 'Open'}
+    # Kinds without TTL are expired at once
+    assert cache.get('run_tests', 1) is None
+
+    # The values are kept between the processes
+    cache = report.DiskCache(str(tmpdir.join('cache')),
+                             ttl={'defect': 100})
+    assert cache.get('defect', 'PROD-1') == {'status': 'Open'}
+
+    with mock.patch('tcp_tests.report.time.time',
+                    return_value=report.time.time() + 101):
+        assert cache.get('defect', 'PROD-1') is None
+
+
+def test_disk_cache_disabled():
+    cache = report.DiskCache(None)
+    cache.set('defect', 'PROD-1', {'status': 'Open'})
+    assert cache.get('defect', 'PROD-1') is None
+
+
+def test_disk_cache_scopes(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    first = report.DiskCache(cache_dir, ttl={'run_tests': 100},
+                             scopes={'run_tests': ('https://tr1', 'qa')})
+    first.set('run_tests', 1, [{'id': 1}])
+
+    other_host = report.DiskCache(cache_dir, ttl={'run_tests': 100},
+                                  scopes={'run_tests': ('https://tr2', 'qa')})
+    other_user = report.DiskCache(cache_dir, ttl={'run_tests': 100},
+                                  scopes={'run_tests': ('https://tr1', 'ci')})
+    same = report.DiskCache(cache_dir, ttl={'run_tests': 100},
+                            scopes={'run_tests': ('https://tr1', 'qa')})
+    assert other_host.get('run_tests', 1) is None
+    assert other_user.get('run_tests', 1) is None
+    assert same.get('run_tests', 1) == [{'id': 1}]
+
+
+def test_configure_cache_disabled_by_default(tmpdir):
+    with mock.patch.object(report, 'cache'):
+        report.configure_cache(testrail=('https://tr', 'qa'))
+        report.cache.set('run_tests', 1, [{'id': 1}])
+        assert report.cache.get('run_tests', 1) is None
+
+        report.configure_cache(str(tmpdir), testrail=('https://tr', 'qa'),
+                               jira=('https://jira', 'qa'))
+        assert report.cache.scopes == {'run_tests': ('https://tr', 'qa'),
+                                       'defect': ('https://jira', 'qa')}
+
+
+def make_update(test_id):
+    result = mock.Mock()
+    result.raw_data.return_value = {'test_id': test_id, 'status_id': 5,
+                                    'defects': 'PROD-1'}
+    return result
+
+
+@mock.patch('tcp_tests.report.fetch_test')
+@mock.patch.object(report, 'RESULTS_BATCH_SIZE', 2)
+def test_add_results_in_batches(fetch_test):
+    t_client = mock.Mock()
+    results = [make_update(i) for i in range(3)]
+
+    report.add_results(t_client, 10, results)
+
+    assert t_client.api.add_results.call_args_list == [
+        mock.call([r.raw_data() for r in results[:2]], 10),
+        mock.call([results[2].raw_data()], 10),
+    ]
+    assert not t_client.api.add_result.called
+
+
+@mock.patch('tcp_tests.report.fetch_test')
+def test_add_results_falls_back_to_single_results(fetch_test):
+    t_client = mock.Mock()
+    t_client.api.add_results.side_effect = Exception('Bad request')
+    results = [make_update(i) for i in range(2)]
+
+    report.add_results(t_client, 10, results)
+
+    t_client.api.tests.assert_called_once_with(10)
+    assert t_client.api.add_result.call_args_list == [
+        mock.call(r.raw_data()) for r in results]
+
+
+def make_issue(key):
+    issue = mock.Mock(key=key)
+    issue.fields.summary = 'Summary of ' + key
+    issue.fields.project.key = key.split('-')[0]
+    issue.fields.priority.name = 'High'
+    issue.fields.status.name = 'Open'
+    issue.permalink.return_value = 'https://jira/browse/' + key
+    return issue
+
+
+@mock.patch.object(report, 'cache', report.DiskCache(None))
+@mock.patch.object(report, 'JIRA_BATCH_SIZE', 2)
+def test_get_defects_info_in_batches():
+    j_client = mock.Mock()
+    # The search returns the issues in its own order
+    j_client.search_issues.side_effect = lambda jql, **kwargs: [
+        make_issue(key) for key in reversed(jql[8:-1].replace(
+            '"', '').split(', '))]
+
+    info = report.get_defects_info(
+        j_client, ['PROD-3', 'PROD-1', 'PROD-2', 'PROD-1'])
+
+    assert [c[0][0] for c in j_client.search_issues.call_args_list] == [
+        'key in ("PROD-1", "PROD-2")',
+        'key in ("PROD-3")',
+    ]
+    assert [c[1]['maxResults']
+            for c in j_client.search_issues.call_args_list] == [2, 1]
+    assert sorted(info) == ['PROD-1', 'PROD-2', 'PROD-3']
+    for key, defect in info.items():
+        assert defect['id'] == key
+        assert defect['title'] == 'Summary of ' + key
+        assert defect['url'] == 'https://jira/browse/' + key
+    assert not j_client.issue.called
+
+
+@mock.patch.object(report, 'cache', report.DiskCache(None))
+def test_get_defects_info_requests_missing_issues():
+    j_client = mock.Mock()
+    # PROD-2 was moved to another key, which the search returns
+    j_client.search_issues.return_value = [make_issue('PROD-1'),
+                                           make_issue('NEW-2')]
+    j_client.issue.return_value = make_issue('NEW-2')
+
+    info = report.get_defects_info(j_client, ['PROD-1', 'PROD-2'])
+
+    j_client.issue.assert_called_once_with('PROD-2')
+    assert info['PROD-1']['id'] == 'PROD-1'
+    assert info['PROD-2']['id'] == 'NEW-2'
+    assert 'NEW-2' not in info
+
+
+def test_get_defects_info_uses_cache(tmpdir):
+    cache = report.DiskCache(str(tmpdir))
+    cache.set('defect', 'PROD-1', {'id': 'PROD-1'})
+    j_client = mock.Mock()
+    j_client.search_issues.return_value = [make_issue('PROD-2')]
+
+    with mock.patch.object(report, 'cache', cache):
+        info = report.get_defects_info(j_client, ['PROD-1', 'PROD-2'])
+
+    assert info['PROD-1'] == {'id': 'PROD-1'}
+    assert j_client.search_issues.call_args[0][0] == 'key in ("PROD-2")'
+    assert cache.get('defect', 'PROD-2')['id'] == 'PROD-2'
@@ -0,0 +1,52 @@
+import mock
+
+from tcp_tests.utils import run_jenkins_job
+
+
+@mock.patch('tcp_tests.utils.run_jenkins_job.JenkinsClient')
+def test_run_jobs_same_job_twice(client_cls):
+    jenkins = client_cls.return_value
+    jenkins.make_defults_params.side_effect = lambda name: {'A': 1}
+    builds = [('deploy', 1), ('deploy', 2), ('test', 5)]
+    jenkins.run_builds.return_value = builds
+    jenkins.wait_end_of_builds.return_value = {
+        ('deploy', 1): {'result': 'SUCCESS'},
+        ('deploy', 2): {'result': 'FAILURE'},
+        ('test', 5): {'result': 'SUCCESS'},
+    }
+
+    results = run_jenkins_job.run_jobs('host', 'user', 'pass', [
+        {'job_name': 'deploy', 'job_output_prefix': 'first '},
+        {'job_name': 'deploy', 'job_parameters': {'A': 2},
+         'job_output_prefix': 'second '},
+        {'job_name': 'test'},
+    ])
+
+    jenkins.run_builds.assert_called_once_with(
+        [('deploy', {'A': 1}), ('deploy', {'A': 2}), ('test', {'A': 1})],
+        verbose=False, timeout=1800)
+    prefixes = jenkins.wait_end_of_builds.call_args[1]['job_output_prefix']
+    assert prefixes == {('deploy', 1): 'first ',
+                        ('deploy', 2): 'second ',
+                        ('test', 5): ''}
+    assert list(results.items()) == [
+        (('deploy', 1), {'result': 'SUCCESS', 'exit_code': 0}),
+        (('deploy', 2), {'result': 'FAILURE', 'exit_code': 3}),
+        (('test', 5), {'result': 'SUCCESS', 'exit_code': 0}),
+    ]
+
+
+@mock.patch('tcp_tests.utils.run_jenkins_job.JenkinsClient')
+def test_run_job(client_cls):
+    jenkins = client_cls.return_value
+    jenkins.make_defults_params.return_value = {'A': 1}
+    jenkins.run_builds.return_value = [('deploy', 3)]
+    jenkins.wait_end_of_builds.return_value = {
+        ('deploy', 3): {'result': 'UNSTABLE'}}
+
+    result = run_jenkins_job.run_job('host', 'user', 'pass', 'deploy',
+                                     job_output_prefix='[{build_number}] ')
+
+    assert result == 'UNSTABLE'
+    prefixes = jenkins.wait_end_of_builds.call_args[1]['job_output_prefix']
+    assert prefixes == {('deploy', 3): '[{build_number}] '}
@@ -0,0 +1,195 @@
+import mock
+import pytest
+import requests
+
+from tcp_tests.managers import saltmanager
+
+
+def make_salt():
+    return saltmanager.SaltManager(config=mock.Mock(), underlay=mock.Mock())
+
+
+@mock.patch.multiple(saltmanager.settings, SALT_ASYNC_POLL_INTERVAL=0,
+                     SALT_FIND_JOB_INTERVAL=0)
+def test_run_and_wait_gives_up_on_lost_minions():
+    salt = make_salt()
+    salt.run_async = mock.Mock(return_value=('1', ['ctl01', 'ctl02']))
+    returns = {'ctl01': {}}
+    salt.lookup_result = mock.Mock(return_value={'return': [returns]})
+    # ctl02 doesn't run the job, it will never return
+    salt.local = mock.Mock(return_value={'return': [{'ctl02': {}}]})
+
+    r, missing = salt.run_and_wait('ctl*', 'state.sls', args='linux',
+                                   timeout=3600)
+
+    assert r == {'return': [returns]}
+    assert missing == ['ctl02']
+    salt.local.assert_called_once_with(
+        tgt='L@ctl02', fun='saltutil.find_job', args='1',
+        timeout=saltmanager.settings.SALT_FIND_JOB_TIMEOUT)
+
+
+@mock.patch.multiple(saltmanager.settings, SALT_ASYNC_POLL_INTERVAL=0,
+                     SALT_FIND_JOB_INTERVAL=0)
+def test_run_and_wait_waits_for_running_minions():
+    salt = make_salt()
+    salt.run_async = mock.Mock(return_value=('1', ['ctl01', 'ctl02']))
+    salt.lookup_result = mock.Mock(side_effect=[
+        {'return': [{'ctl01': {}}]},
+        {'return': [{'ctl01': {}}]},
+        {'return': [{'ctl01': {}}]},
+        {'return': [{'ctl01': {}, 'ctl02': {}}]},
+    ])
+    salt.local = mock.Mock(
+        return_value={'return': [{'ctl02': {'jid': '1', 'fun': 'state.sls'}}]})
+
+    r, missing = salt.run_and_wait('ctl*', 'state.sls', args='linux',
+                                   timeout=3600)
+
+    assert missing == []
+    assert salt.local.call_count == 1
+
+
+def test_pillar_cache_is_disabled_by_default():
+    salt = make_salt()
+    salt._SaltManager__api = api = mock.Mock()
+    api.local.return_value = {'return': [{'ctl01': 'value'}]}
+
+    salt.get_pillar('ctl01', 'key')
+    salt.get_pillar('ctl01', 'key')
+
+    assert api.local.call_count == 2
+
+
+@pytest.mark.parametrize('fun,args,invalidated', [
+    ('state.sls', 'linux', True),
+    ('saltutil.refresh_pillar', None, True),
+    ('saltutil.sync_all', None, True),
+    ('cmd.run', 'salt-call saltutil.refresh_pillar', True),
+    ('cmd.run', ['reclass-salt --top'], True),
+    ('cmd.run', 'hostname', False),
+    ('test.ping', None, False),
+])
+@mock.patch.object(saltmanager.settings, 'SALT_CACHE_TTL', 300)
+def test_pillar_cache_invalidation(fun, args, invalidated):
+    salt = make_salt()
+    salt._SaltManager__api = api = mock.Mock()
+    api.local.return_value = {'return': [{'ctl01': 'value'}]}
+
+    salt.get_pillar('ctl01', 'key')
+    salt.local('ctl01', fun, args)
+    salt.get_pillar('ctl01', 'key')
+
+    pillar_calls = [c for c in api.local.call_args_list
+                    if c[0][1] == 'pillar.get']
+    assert len(pillar_calls) == (2 if invalidated else 1)
+
+
+def make_response(status_code, data=None):
+    resp = mock.Mock(status_code=status_code, ok=status_code < 400)
+    resp.json.return_value = data
+    resp.iter_lines.return_value = [
+        'tag: salt/job', 'data: {"tag": "salt/job", "data": {}}']
+    return resp
+
+
+def login_response(token, lifetime=600):
+    return make_response(200, {'return': [
+        {'token': token, 'start': 1000, 'expire': 1000 + lifetime}]})
+
+
+def make_api_client():
+    session = mock.Mock()
+    with mock.patch.object(saltmanager.requests, 'Session',
+                           return_value=session):
+        api = saltmanager.SaltApiClient('http://salt:6969', 'salt', 'pass',
+                                        refresh_margin=60)
+    return api, session
+
+
+def sent_tokens(session):
+    return [c[1]['headers'].get('X-Auth-Token')
+            for c in session.post.call_args_list]
+
+
+@mock.patch.object(saltmanager.time, 'time')
+def test_salt_api_refreshes_token_before_expiry(time_mock):
+    api, session = make_api_client()
+    session.post.side_effect = [
+        login_response('t1'), make_response(200, {'return': [1]}),
+        make_response(200, {'return': [2]}),
+        login_response('t2'), make_response(200, {'return': [3]}),
+    ]
+
+    time_mock.return_value = 0
+    assert api.req('/', {'fun': 'test.ping'}) == {'return': [1]}
+    # The token lives 600 sec and is refreshed 60 sec before that
+    time_mock.return_value = 539
+    assert api.req('/', {'fun': 'test.ping'}) == {'return': [2]}
+    time_mock.return_value = 540
+    assert api.req('/', {'fun': 'test.ping'}) == {'return': [3]}
+
+    assert sent_tokens(session) == [None, 't1', 't1', None, 't2']
+    assert api.stats == {'logins': 2, 'refreshes': 1}
+
+
+def test_salt_api_logs_in_again_on_401():
+    api, session = make_api_client()
+    session.post.side_effect = [
+        login_response('t1'), make_response(401),
+        login_response('t2'), make_response(200, {'return': [1]}),
+    ]
+
+    assert api.req('/', {'fun': 'test.ping'}) == {'return': [1]}
+    assert sent_tokens(session) == [None, 't1', None, 't2']
+
+
+def test_salt_api_events_logs_in_again_on_401():
+    api, session = make_api_client()
+    session.post.side_effect = [login_response('t1'), login_response('t2')]
+    rejected = make_response(401)
+    session.get.side_effect = [rejected, make_response(200)]
+
+    events = list(api.events())
+
+    assert events == [{'tag': 'salt/job', 'data': {}}]
+    assert rejected.close.called
+    assert [c[1]['headers']['X-Auth-Token']
+            for c in session.get.call_args_list] == ['t1', 't2']
+
+
+def test_salt_api_events_denied():
+    api, session = make_api_client()
+    session.post.side_effect = [login_response('t1'), login_response('t2')]
+    session.get.return_value = make_response(401)
+
+    with pytest.raises(saltmanager.libpepper.PepperException):
+        api.events()
+    assert session.get.call_count == 2
+
+
+def quiet_stream():
+    # salt-api doesn't send anything until the read timeout
+    raise requests.Timeout('Read timed out')
+    yield
+
+
+@mock.patch.multiple(saltmanager.settings, SALT_ASYNC_POLL_INTERVAL=5,
+                     SALT_FIND_JOB_INTERVAL=60)
+def test_run_and_wait_events_checks_job_on_quiet_bus():
+    salt = make_salt()
+    salt._SaltManager__api = api = mock.Mock()
+    api.events.side_effect = lambda timeout: quiet_stream()
+    salt.run_async = mock.Mock(return_value=('1', ['ctl01']))
+    # The return event was missed, the job is checked after the timeout
+    salt.lookup_result = mock.Mock(side_effect=[
+        {'return': [{}]}, {'return': [{'ctl01': {}}]}])
+
+    r, missing = salt.run_and_wait('ctl*', 'state.sls', args='linux',
+                                   timeout=3, events=True)
+
+    assert missing == []
+    timeouts = [c[1]['timeout'] for c in api.events.call_args_list]
+    assert len(timeouts) == 2
+    # Not longer than the time left until the deadline
+    assert all(1 <= t <= 3 for t in timeouts)
@@ -0,0 +1,285 @@
+import mock
+import pytest
+
+from tcp_tests.managers import underlay_ssh_manager
+
+
+def make_pool():
+    pool = underlay_ssh_manager.SSHConnectionPool(idle_timeout=10,
+                                                  check_interval=5)
+    auth = mock.Mock(username='root')
+    return pool, auth
+
+
+@mock.patch('tcp_tests.managers.underlay_ssh_manager.time.time')
+@mock.patch('tcp_tests.managers.underlay_ssh_manager.ssh_client.SSHClient')
+def test_ssh_pool_reuses_client(ssh_client_cls, time_mock):
+    time_mock.return_value = 100
+    pool, auth = make_pool()
+
+    remote1 = pool.get('10.0.0.1', 22, auth)
+    del remote1
+    remote2 = pool.get('10.0.0.1', 22, auth)
+
+    assert ssh_client_cls.call_count == 1
+    assert remote2._ssh is ssh_client_cls.return_value._ssh
+    assert pool.stats['hits'] == 1
+    assert pool.stats['misses'] == 1
+
+
+@mock.patch('tcp_tests.managers.underlay_ssh_manager.time.time')
+@mock.patch('tcp_tests.managers.underlay_ssh_manager.ssh_client.SSHClient')
+def test_ssh_pool_keeps_checked_out_client(ssh_client_cls, time_mock):
+    pool, auth = make_pool()
+    client = mock.Mock()
+    ssh_client_cls.return_value = client
+
+    time_mock.return_value = 100
+    remote = pool.get('10.0.0.1', 22, auth)
+    # Other connection is requested while the first one is still used
+    # for longer than idle_timeout
+    time_mock.return_value = 200
+    pool.get('10.0.0.2', 22, auth)
+
+    assert not client.close.called
+    assert pool.stats['evictions'] == 0
+
+    # Idle time is counted from the release
+    del remote
+    time_mock.return_value = 205
+    pool.get('10.0.0.2', 22, auth)
+    assert not client.close.called
+
+    time_mock.return_value = 211
+    pool.get('10.0.0.2', 22, auth)
+    assert client.close.called
+    assert pool.stats['evictions'] == 1
+
+
+@mock.patch('tcp_tests.managers.underlay_ssh_manager.time.time')
+@mock.patch('tcp_tests.managers.underlay_ssh_manager.ssh_client.SSHClient')
+def test_ssh_pool_context_manager(ssh_client_cls, time_mock):
+    time_mock.return_value = 100
+    pool, auth = make_pool()
+    client = ssh_client_cls.return_value
+
+    with pool.get('10.0.0.1', 22, auth) as remote:
+        remote.check_call('hostname')
+
+    client.check_call.assert_called_once_with('hostname')
+    assert client.__exit__.called
+
+
+def ssh_item(node_name, host, address_pool=None, roles=None,
+             minion_id=None):
+    return {
+        'node_name': node_name,
+        'minion_id': minion_id or node_name + '.local',
+        'host': host,
+        'login': 'root',
+        'password': 'r00tme',
+        'address_pool': address_pool,
+        'roles': roles or [],
+    }
+
+
+# The same node may have addresses in several pools and the same host
+# may be registered for several nodes
+config_ssh = [
+    ssh_item('cfg01', '10.0.0.15', 'admin-pool01', ['salt_master']),
+    ssh_item('cfg01', '172.16.10.15', 'private-pool01', ['salt_master']),
+    ssh_item('ctl01', '10.0.0.11', 'admin-pool01', ['k8s_controller']),
+    ssh_item('ctl02', '10.0.0.12', 'admin-pool01', ['k8s_controller']),
+    ssh_item('ctl01', '172.16.10.11', 'private-pool01', ['k8s_controller']),
+    ssh_item('ctl', '10.0.0.10', 'admin-pool01'),
+    ssh_item('cmp001', '10.0.0.101', 'admin-pool01', ['compute']),
+    ssh_item('cmp001', '10.0.0.101', None, ['compute'], 'cmp1.local'),
+    ssh_item('gtw01', '10.0.0.110', 'admin-pool01', ['compute', 'gtw']),
+]
+
+
+def linear_ssh_data(config, node_name=None, host=None, address_pool=None,
+                    node_role=None, minion_id=None):
+    """Lookup from UnderlaySSHManager before the indexes were added"""
+    ssh_data = None
+    if host is not None:
+        for ssh in config:
+            if host == ssh['host']:
+                ssh_data = ssh
+                break
+    else:
+        for key, match in ((node_name, lambda ssh: ssh['node_name']),
+                           (node_role, lambda ssh: ssh['roles']),
+                           (minion_id, lambda ssh: ssh['minion_id'])):
+            if key is None:
+                continue
+            for ssh in config:
+                value = match(ssh)
+                if key == value or (isinstance(value, list) and
+                                    key in value):
+                    if address_pool is not None:
+                        if address_pool == ssh['address_pool']:
+                            ssh_data = ssh
+                            break
+                    else:
+                        ssh_data = ssh
+            break
+    return ssh_data
+
+
+def linear_names(config, field, prefix=''):
+    names = []
+    for ssh in config:
+        if ssh[field] not in names and ssh[field].startswith(prefix):
+            names.append(ssh[field])
+    return names
+
+
+def make_underlay(config):
+    underlay_config = mock.Mock()
+    underlay_config.underlay.ssh = [dict(ssh) for ssh in config]
+    return underlay_ssh_manager.UnderlaySSHManager(underlay_config)
+
+
+def check_lookups(underlay, config):
+    pools = [None, 'admin-pool01', 'private-pool01', 'unknown-pool']
+    lookups = (
+        ('node_name', underlay.host_by_node_name,
+         linear_names(config, 'node_name') + ['unknown']),
+        ('node_role', underlay.host_by_node_role,
+         ['salt_master', 'k8s_controller', 'compute', 'gtw', 'unknown']),
+        ('minion_id', underlay.host_by_minion_id,
+         linear_names(config, 'minion_id') + ['unknown']),
+    )
+    for arg, method, keys in lookups:
+        for key in keys:
+            for pool in pools:
+                expected = linear_ssh_data(config, address_pool=pool,
+                                           **{arg: key})
+                if expected is None:
+                    with pytest.raises(Exception):
+                        method(key, address_pool=pool)
+                else:
+                    assert method(key, address_pool=pool) == \
+                        expected['host'], (arg, key, pool)
+
+    assert underlay.node_names() == linear_names(config, 'node_name')
+    assert underlay.minion_ids() == linear_names(config, 'minion_id')
+    for prefix in ('', 'c', 'ctl', 'ctl0', 'ctl01', 'cmp', 'cmp1.', 'x'):
+        assert underlay.get_target_node_names(prefix) == \
+            linear_names(config, 'node_name', prefix), prefix
+        assert underlay.get_target_minion_ids(prefix) == \
+            linear_names(config, 'minion_id', prefix), prefix
+
+
+def test_underlay_lookups_match_linear_search():
+    underlay = make_underlay(config_ssh)
+    check_lookups(underlay, config_ssh)
+
+
+def test_underlay_lookups_after_config_changes():
+    underlay = make_underlay(config_ssh[:5])
+    underlay.add_config_ssh(config_ssh[5:])
+    check_lookups(underlay, config_ssh)
+
+    # The first items of the nodes are removed, so their order changes
+    removed = [config_ssh[0], config_ssh[2], config_ssh[5]]
+    underlay.remove_config_ssh(removed)
+    config = [ssh for ssh in config_ssh if ssh not in removed]
+    check_lookups(underlay, config)
+
+    underlay.add_config_ssh(removed)
+    check_lookups(underlay, config + removed)
+
+
+@pytest.mark.parametrize('words,prefix,expected', [
+    (['ctl01', 'ctl02', 'ctl'], 'ctl', ['ctl01', 'ctl02', 'ctl']),
+    (['ctl01', 'ctl02', 'ctl'], 'ctl0', ['ctl01', 'ctl02']),
+    (['ctl01', 'ctl02', 'ctl'], 'ctl03', []),
+    (['b', 'a', 'ab', 'a'], '', ['b', 'a', 'ab']),
+    ([], '', []),
+])
+def test_prefix_trie_startswith(words, prefix, expected):
+    trie = underlay_ssh_manager.PrefixTrie()
+    for word in words:
+        trie.add(word)
+    assert trie.startswith(prefix) == expected
+
+
+def fake_check_call(failed_nodes):
+    def check_call(cmd, node_name=None, **kwargs):
+        if node_name in failed_nodes:
+            raise Exception('exit code 1')
+        return {'node_name': node_name, 'exit_code': 0}
+    return mock.Mock(side_effect=check_call)
+
+
+def test_check_call_many_by_roles():
+    underlay = make_underlay(config_ssh)
+    underlay.check_call = fake_check_call([])
+
+    results = underlay.check_call_many('hostname', roles=['compute'])
+
+    assert sorted(results) == ['cmp001', 'gtw01']
+    assert results['gtw01'] == {'node_name': 'gtw01', 'exit_code': 0}
+
+
+def test_check_call_many_sudo_by_prefix():
+    underlay = make_underlay(config_ssh)
+    underlay.sudo_check_call = fake_check_call([])
+
+    results = underlay.check_call_many('hostname', prefix='ctl0', sudo=True)
+
+    assert sorted(results) == ['ctl01', 'ctl02']
+
+
+def test_check_call_many_aggregates_errors():
+    underlay = make_underlay(config_ssh)
+    underlay.check_call = fake_check_call(['ctl01', 'ctl02'])
+    node_names = ['cfg01', 'ctl01', 'ctl02']
+
+    with pytest.raises(Exception) as e:
+        underlay.check_call_many('hostname', node_names=node_names)
+    # All the nodes are called, the failures are reported together
+    assert underlay.check_call.call_count == 3
+    assert 'failed on 2 of 3 nodes' in str(e.value)
+    assert 'ctl01: exit code 1' in str(e.value)
+    assert 'ctl02: exit code 1' in str(e.value)
+
+    results = underlay.check_call_many('hostname', node_names=node_names,
+                                       raise_on_err=False)
+    assert results['cfg01']['exit_code'] == 0
+    assert isinstance(results['ctl01'], Exception)
+
+
+def test_check_call_many_requires_nodes():
+    underlay = make_underlay(config_ssh)
+    with pytest.raises(ValueError):
+        underlay.check_call_many('hostname')
+    assert underlay.check_call_many('hostname', prefix='unknown') == {}
+
+
+@mock.patch('tcp_tests.managers.underlay_ssh_manager.ssh_client.SSHAuth')
+@mock.patch('tcp_tests.managers.underlay_ssh_manager.rsakey.RSAKey')
+def test_config_ssh_reassignment_drops_auth_caches(rsa_key, ssh_auth):
+    rsa_key.side_effect = lambda file_obj: mock.Mock()
+    ssh_auth.side_effect = lambda **kwargs: mock.Mock(**kwargs)
+    config = [dict(ssh_item('ctl01', '10.0.0.11'), keys=['KEY']),
+              dict(ssh_item('ctl02', '10.0.0.12'), keys=['KEY'])]
+    underlay = make_underlay(config)
+    ssh_auth_of = underlay._UnderlaySSHManager__ssh_auth
+
+    # Both nodes have the same credentials, the key is parsed once
+    assert rsa_key.call_count == 1
+    assert ssh_auth.call_count == 1
+    auth = ssh_auth_of(underlay.config_ssh[1])
+    assert auth is ssh_auth_of(underlay.config_ssh[0])
+
+    # Like in SaltManager.update_ssh_data_from_minions()
+    underlay.config_ssh = []
+    underlay.add_config_ssh(config)
+
+    assert rsa_key.call_count == 2
+    assert ssh_auth.call_count == 2
+    assert ssh_auth_of(underlay.config_ssh[0]) is not auth
+    assert underlay.node_names() == ['ctl01', 'ctl02']
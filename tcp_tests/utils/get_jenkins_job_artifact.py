@@ -73,23 +73,25 @@ def load_params():
                         help='Local filename for the saving artifact',
                         default=None,
                         type=str)
+    parser.add_argument('--checksum',
+                        help='Expected sha256 checksum of the artifact',
+                        default=None,
+                        type=str)
     return parser
 
 
 def download_artifact(host, username, password,
                       job_name, build_number,
-                      artifact_path, destination_name):
+                      artifact_path, destination_name, checksum=None):
 
     jenkins = JenkinsClient(
         host=host,
         username=username,
         password=password)
 
-    content = jenkins.get_artifact(job_name, build_number,
-                                   artifact_path, destination_name)
-
-    with open(destination_name, 'wb') as f:
-        f.write(content)
+    jenkins.download_artifact(job_name, build_number,
+                              artifact_path, destination_name,
+                              checksum=checksum)
 
 
 def main(args=None):
@@ -109,7 +111,8 @@ def main(args=None):
             opts.job_name,
             opts.build_number,
             opts.artifact_path,
-            opts.destination_name)
+            opts.destination_name,
+            opts.checksum)
 
 
 if __name__ == "__main__":
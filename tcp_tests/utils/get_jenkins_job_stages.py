@@ -13,8 +13,10 @@
 #    under the License.
 
 import argparse
+from multiprocessing import pool as mp_pool
 import os
 import sys
+import threading
 import time
 
 sys.path.append(os.getcwd())
@@ -66,10 +68,102 @@ def load_params():
                         metavar='BUILD_NUMBER',
                         help='Jenkins job build number',
                         default=env_build_number)
+    parser.add_argument('--max-workers',
+                        help='Max number of concurrent requests to Jenkins',
+                        default=WorkflowFetcher.max_requests_per_host,
+                        type=int)
     return parser
 
 
-def get_deployment_result(host, username, password, job_name, build_number):
+class WorkflowFetcher(object):
+    """Fetch the workflow nodes of the pipeline build concurrently
+
+    The nodes are fetched breadth-first: all the nodes of the same
+    depth are requested at once, with the number of concurrent requests
+    to the same Jenkins host limited by max_workers (max_requests_per_host
+    by default). Fetchers with the same host and limit share the limit.
+    Results are memoized, so each node is requested only once.
+    """
+    max_requests_per_host = 8
+
+    __host_semaphores = {}
+    __host_lock = threading.Lock()
+
+    def __init__(self, jenkins, host, job_name, build_number,
+                 max_workers=None):
+        self.__jenkins = jenkins
+        self.__job_name = job_name
+        self.__build_number = build_number
+        self.__max_workers = max_workers or self.max_requests_per_host
+        self.__semaphore = self.__host_semaphore(host, self.__max_workers)
+        self.__cache = {}
+
+    @classmethod
+    def __host_semaphore(cls, host, limit):
+        with cls.__host_lock:
+            key = (host, limit)
+            if key not in cls.__host_semaphores:
+                cls.__host_semaphores[key] = threading.BoundedSemaphore(
+                    limit)
+            return cls.__host_semaphores[key]
+
+    def __fetch(self, key):
+        enode, mode = key
+        with self.__semaphore:
+            return self.__jenkins.get_workflow(self.__job_name,
+                                               self.__build_number,
+                                               enode, mode=mode)
+
+    def fetch_many(self, keys):
+        """Fetch the (enode, mode) keys which are not in the cache yet"""
+        keys = [key for key in set(keys) if key not in self.__cache]
+        if not keys:
+            return
+        if len(keys) == 1:
+            self.__cache[keys[0]] = self.__fetch(keys[0])
+            return
+        thread_pool = mp_pool.ThreadPool(min(self.__max_workers, len(keys)))
+        try:
+            results = thread_pool.map(self.__fetch, keys)
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+        self.__cache.update(zip(keys, results))
+
+    def get(self, enode, mode='describe'):
+        key = (enode, mode)
+        if key not in self.__cache:
+            self.fetch_many([key])
+        return self.__cache[key]
+
+    def fetch_tree(self, nodes):
+        """Fetch the descriptions and logs of all failed nodes in the tree
+
+        :param nodes: list of the top-level stages
+        """
+        level = [int(node['id']) for node in nodes
+                 if node['status'] != 'SUCCESS']
+        while level:
+            self.fetch_many([(enode, 'describe') for enode in level])
+            next_level = []
+            logs = []
+            for enode in level:
+                wf = self.get(enode)
+                if wf is None:
+                    continue
+                if 'stageFlowNodes' in wf:
+                    next_level.extend(
+                        int(node['id']) for node in wf['stageFlowNodes']
+                        if node['status'] != 'SUCCESS')
+                elif '_links' in wf and 'log' in wf['_links']:
+                    logs.append((enode, 'log'))
+            self.fetch_many(logs)
+            level = [enode for enode in set(next_level)
+                     if (enode, 'describe') not in self.__cache]
+
+
+def get_deployment_result(host, username, password, job_name, build_number,
+                          max_workers=None):
     """Get the pipeline job result from Jenkins
 
     Get all the stages resutls from the specified job,
@@ -78,6 +172,8 @@ def get_deployment_result(host, username, password, job_name, build_number):
     jenkins = client.JenkinsClient(host=host,
                                    username=username,
                                    password=password)
+    fetcher = WorkflowFetcher(jenkins, host, job_name, build_number,
+                              max_workers=max_workers)
 
     def get_stages(nodes, indent=0, show_status=True):
         res = []
@@ -90,17 +186,13 @@ def get_deployment_result(host, username, password, job_name, build_number):
                 res.append(msg)
 
             if node['status'] != 'SUCCESS':
-                wf = jenkins.get_workflow(job_name, build_number,
-                                          int(node['id']))
+                wf = fetcher.get(int(node['id']))
                 if wf is not None:
                     if 'stageFlowNodes' in wf:
                         res += get_stages(wf['stageFlowNodes'], indent + 2,
                                           show_status=False)
                     elif '_links' in wf and 'log' in wf['_links']:
-                        log = jenkins.get_workflow(job_name,
-                                                   build_number,
-                                                   int(node['id']),
-                                                   mode='log')
+                        log = fetcher.get(int(node['id']), mode='log')
                         if "text" in log:
                             prefix = " " * (indent + 2)
                             res.append("\n".join(
@@ -117,6 +209,7 @@ def get_deployment_result(host, username, password, job_name, build_number):
 
     build_description = ("[" + info['fullDisplayName'] + "] " +
                          info['url'] + " : " + (info['result'] or 'No result'))
+    fetcher.fetch_tree(wf['stages'])
     stages = get_stages(wf['stages'], 0)
     if not stages:
         msg = wf['status'] + ":\n\n"
@@ -138,7 +231,8 @@ def main(args=None):
             opts.username,
             opts.password,
             opts.job_name,
-            opts.build_number)
+            opts.build_number,
+            opts.max_workers)
         print(build_description)
         print('\n'.join(stages))
 
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import argparse
+import collections
 import os
 import sys
 
@@ -118,40 +119,71 @@ def run_job(host, username, password,
             job_name, job_parameters=None, job_output_prefix='',
             start_timeout=1800, build_timeout=3600 * 4, verbose=False):
 
+    results = run_jobs(host, username, password,
+                       [{'job_name': job_name,
+                         'job_parameters': job_parameters,
+                         'job_output_prefix': job_output_prefix}],
+                       start_timeout=start_timeout,
+                       build_timeout=build_timeout,
+                       verbose=verbose)
+    return list(results.values())[0]['result']
+
+
+def run_jobs(host, username, password, jobs,
+             start_timeout=1800, build_timeout=3600 * 4, verbose=False):
+    """Run several jobs at the same time and wait for all of them
+
+    :param jobs: list of dicts with the keys 'job_name' and optional
+                 'job_parameters', 'job_output_prefix'. The same job
+                 may be listed several times.
+    :returns: OrderedDict {(job_name, build_number): {
+                  'result': str, 'exit_code': int}}, in the order of jobs
+    """
     jenkins = JenkinsClient(
         host=host,
         username=username,
         password=password)
 
-    job_params = jenkins.make_defults_params(job_name)
-    if job_parameters is not None:  # job_parameters = {}
-        job_params.update(job_parameters)
+    jobs_params = []
+    for job in jobs:
+        job_params = jenkins.make_defults_params(job['job_name'])
+        job_params.update(job.get('job_parameters') or {})
+        jobs_params.append((job['job_name'], job_params))
 
-    build = jenkins.run_build(job_name,
-                              job_params,
-                              verbose=verbose,
-                              timeout=start_timeout)
+    builds = jenkins.run_builds(jobs_params,
+                                verbose=verbose,
+                                timeout=start_timeout)
     if verbose:
-        print_build_header(build, job_params, build_timeout)
-
+        for build, (_, job_params) in zip(builds, jobs_params):
+            print_build_header(build, job_params, build_timeout)
+
+    # The same job may be started several times, so the prefixes
+    # are bound to the builds rather than to the job names
+    output_prefixes = dict(
+        (build, job.get('job_output_prefix', ''))
+        for build, job in zip(builds, jobs))
     try:
-        jenkins.wait_end_of_build(
-            name=build[0],
-            build_id=build[1],
+        builds_info = jenkins.wait_end_of_builds(
+            builds,
             timeout=build_timeout,
             interval=1,
             verbose=verbose,
-            job_output_prefix=job_output_prefix)
+            job_output_prefix=output_prefixes,
+            console_driven=verbose)
     except Exception as e:
         print(str(e))
         raise
 
-    result = jenkins.build_info(name=build[0],
-                                build_id=build[1])['result']
-    if verbose:
-        print_build_footer(build, result, host)
-
-    return result
+    results = collections.OrderedDict()
+    for build in builds:
+        result = builds_info[build]['result']
+        if verbose:
+            print_build_footer(build, result, host)
+        results[build] = {
+            'result': result,
+            'exit_code': EXIT_CODES.get(result, 2),
+        }
+    return results
 
 
 def main(args=None):